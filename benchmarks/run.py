@@ -0,0 +1,305 @@
+# Times the library's hot paths against synthetic archives of a few sizes and saves the
+# results as JSON, so runs from different commits can be compared offline:
+#
+#   python benchmarks/run.py --scales 1000 10000 --output results/$(git rev-parse --short HEAD).json
+#   python benchmarks/run.py --compare results/old.json results/new.json
+#
+# Every benchmark runs in a fresh process, so its peak RSS isn't polluted by the others.
+
+import argparse
+from datetime import datetime, timezone
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from horsewords import fimfarchive, synthetic
+from horsewords.index import SNAPSHOT_DIRNAME, open_snapshot
+
+QUERIES = [
+    'comedy',
+    'genre:sad, -character:rainbow',
+    'twilight | pinkie, -content:sex',
+    '.likes > 100',
+    '.ratio > 10, .wordcount > 20000',
+    '.date_published > "2016", .status = "complete"',
+    'max(.likes, .dislikes) > 50 | adventure',
+    'genre:comedy order by .likes desc limit 100',
+]
+TEMPLATE = ('{.title} by {.author.name}\n{join .tags.name with ", "}\n'
+            '{join "## " .chapters.title "\\n" chapter_text with "\\n\\n"}')
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds = time.perf_counter() - self.start
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def remove_txt_cache(path):
+    shutil.rmtree(os.path.join(path, 'txt'), ignore_errors=True)
+
+
+def sample_stories(archive, limit):
+    story_ids = list(archive.stories_by_id)
+    return story_ids if limit is None else story_ids[:limit]
+
+
+def bench_index_json(path, options):
+    with Timer() as timer:
+        archive = fimfarchive.Fimfarchive(path, use_snapshot=False)
+    return timer.seconds, len(archive.stories_by_id), os.path.getsize(os.path.join(path, 'index.json'))
+
+
+def bench_index_snapshot_build(path, options):
+    shutil.rmtree(os.path.join(path, SNAPSHOT_DIRNAME), ignore_errors=True)
+    with Timer() as timer:
+        archive = fimfarchive.Fimfarchive(path)
+    return timer.seconds, len(archive.stories_by_id), os.path.getsize(os.path.join(path, 'index.json'))
+
+
+def bench_index_snapshot_open(path, options):
+    open_snapshot(os.path.join(path, 'index.json'))
+    with Timer() as timer:
+        archive = fimfarchive.Fimfarchive(path)
+    return timer.seconds, len(archive.stories_by_id), os.path.getsize(os.path.join(path, 'index.json'))
+
+
+def bench_query_stories(path, options):
+    # plans are parsed before timing; results are evaluated from scratch for every query
+    archive = fimfarchive.Fimfarchive(path)
+    for query in QUERIES:
+        archive.query_stories(query)
+
+    seconds = 0.0
+    for _ in range(options['query_rounds']):
+        archive.query_stories.result_cache.clear()
+        with Timer() as timer:
+            for query in QUERIES:
+                archive.query_stories(query)
+        seconds += timer.seconds
+    return seconds, len(QUERIES) * options['query_rounds'], None
+
+
+def bench_template_parse(path, options):
+    archive = fimfarchive.Fimfarchive(path)
+    template = fimfarchive.TemplatedStoryString(archive, consistent_quotes=True)
+    story_ids = sample_stories(archive, options['template_stories'])
+
+    num_bytes = 0
+    with Timer() as timer:
+        for story_id in story_ids:
+            num_bytes += len(template.parse(TEMPLATE, story_id).encode('utf-8'))
+    return timer.seconds, len(story_ids), num_bytes
+
+
+def cache_epubs(path, options, fast_text):
+    archive = fimfarchive.Fimfarchive(path, fast_text=fast_text)
+    story_ids = sample_stories(archive, options['cache_stories'])
+    remove_txt_cache(path)
+    try:
+        with Timer() as timer:
+            for story_id in story_ids:
+                archive.cache_chapters(story_id)
+        num_chapters = sum(len(archive.stories_by_id[x]['chapters']) for x in story_ids)
+        num_bytes = sum(os.path.getsize(os.path.join(root, x))
+                        for root, _, files in os.walk(os.path.join(path, 'txt')) for x in files)
+    finally:
+        remove_txt_cache(path)
+    return timer.seconds, num_chapters, num_bytes
+
+
+def bench_cache_epub(path, options):
+    return cache_epubs(path, options, False)
+
+
+def bench_cache_epub_fast(path, options):
+    return cache_epubs(path, options, True)
+
+
+def bench_cache_html(path, options):
+    archive = fimfarchive.Fimfarchive(path)
+    story_ids = sample_stories(archive, options['cache_stories'])
+    num_chapters = 0
+    num_bytes = 0
+    with tempfile.TemporaryDirectory() as output_path:
+        with Timer() as timer:
+            for story_id in story_ids:
+                story_path = os.path.join(output_path, story_id)
+                os.makedirs(story_path)
+                chapter_paths = fimfarchive.get_html_chapters(os.path.join(path, 'html', story_id))
+                fimfarchive.cache_html_chapters(chapter_paths, story_path, archive.stories_by_id[story_id])
+        for root, _, files in os.walk(output_path):
+            num_chapters += len(files)
+            num_bytes += sum(os.path.getsize(os.path.join(root, x)) for x in files)
+    return timer.seconds, num_chapters, num_bytes
+
+
+BENCHMARKS = {
+    'index_json': bench_index_json,
+    'index_snapshot_build': bench_index_snapshot_build,
+    'index_snapshot_open': bench_index_snapshot_open,
+    'query_stories': bench_query_stories,
+    'template_parse': bench_template_parse,
+    'cache_epub': bench_cache_epub,
+    'cache_epub_fast': bench_cache_epub_fast,
+    'cache_html': bench_cache_html,
+}
+
+
+def run_benchmark(name, path, options):
+    baseline_rss = peak_rss_mb()
+    seconds, items, num_bytes = BENCHMARKS[name](path, options)
+    return {
+        'seconds': seconds,
+        'items': items,
+        'bytes': num_bytes,
+        'baseline_rss_mb': baseline_rss,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def prepare_archive(data_dir, scale, seed, words_per_chapter):
+    # archives are reused between runs as long as they were generated with the same settings
+    path = os.path.join(data_dir, f'synthetic-{scale}-seed{seed}-words{words_per_chapter}')
+    manifest = synthetic.read_manifest(path)
+    if manifest and manifest['version'] == synthetic.GENERATOR_VERSION:
+        return path, manifest, None
+
+    shutil.rmtree(path, ignore_errors=True)
+    with Timer() as timer:
+        manifest = synthetic.generate_archive(path, scale, seed, words_per_chapter)
+    return path, manifest, timer.seconds
+
+
+def git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def run(args):
+    options = {
+        'query_rounds': args.query_rounds,
+        'template_stories': args.template_stories,
+        'cache_stories': args.cache_stories,
+    }
+    names = args.benchmarks or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            raise Exception(f'unknown benchmark {name}: use one of {list(BENCHMARKS)}')
+
+    report = {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'options': dict(options, seed=args.seed, words_per_chapter=args.words_per_chapter, repeat=args.repeat),
+        'archives': {},
+        'results': [],
+    }
+
+    context = multiprocessing.get_context('spawn')
+    for scale in args.scales:
+        path, manifest, generate_seconds = prepare_archive(args.data_dir, scale, args.seed, args.words_per_chapter)
+        report['archives'][str(scale)] = dict(manifest, generate_seconds=generate_seconds)
+
+        for name in names:
+            runs = []
+            for _ in range(args.repeat):
+                with context.Pool(1) as pool:
+                    runs.append(pool.apply(run_benchmark, (name, path, options)))
+
+            # the fastest run is the least disturbed by everything else on the machine
+            best = min(runs, key=lambda x: x['seconds'])
+            result = {
+                'benchmark': name,
+                'scale': scale,
+                'seconds': best['seconds'],
+                'all_seconds': [x['seconds'] for x in runs],
+                'items': best['items'],
+                'items_per_second': best['items'] / best['seconds'] if best['seconds'] else None,
+                'mb_per_second': (best['bytes'] / best['seconds'] / 1e6
+                                  if best['bytes'] is not None and best['seconds'] else None),
+                'peak_rss_mb': max(x['peak_rss_mb'] for x in runs),
+                'baseline_rss_mb': min(x['baseline_rss_mb'] for x in runs),
+            }
+            report['results'].append(result)
+            print(f"{scale:>8} {name:<22} {result['seconds']:9.3f}s {result['items_per_second'] or 0:12.1f}/s "
+                  f"{result['peak_rss_mb']:8.1f} MB")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(report, f, indent=1)
+    return report
+
+
+def compare(old_path, new_path, threshold):
+    # prints new/old time ratios for every benchmark the two reports share
+    with open(old_path, encoding='utf8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf8') as f:
+        new = json.load(f)
+
+    old_results = dict(((x['benchmark'], x['scale']), x) for x in old['results'])
+    print(f"old: {old.get('commit')}  new: {new.get('commit')}")
+    regressions = 0
+    for result in new['results']:
+        previous = old_results.get((result['benchmark'], result['scale']))
+        if previous is None or not previous['seconds']:
+            continue
+        ratio = result['seconds'] / previous['seconds']
+        rss_ratio = result['peak_rss_mb'] / previous['peak_rss_mb']
+        flag = ''
+        if ratio > threshold or rss_ratio > threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        print(f"{result['scale']:>8} {result['benchmark']:<22} {previous['seconds']:9.3f}s -> {result['seconds']:9.3f}s "
+              f"x{ratio:5.2f}  rss x{rss_ratio:5.2f} {flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark horsewords against synthetic archives')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000], help='number of stories')
+    parser.add_argument('--benchmarks', nargs='+', help=f'subset of {", ".join(BENCHMARKS)}')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'horsewords-bench'),
+                        help='where synthetic archives are generated and kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--words-per-chapter', type=int, default=1500)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--query-rounds', type=int, default=5)
+    parser.add_argument('--template-stories', type=int, default=1000)
+    parser.add_argument('--cache-stories', type=int, default=300)
+    parser.add_argument('--output', help='where to save the json report')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two saved reports')
+    parser.add_argument('--threshold', type=float, default=1.1, help='slowdown ratio flagged by --compare')
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare(*args.compare, args.threshold)
+        sys.exit(1 if regressions else 0)
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+from contextlib import contextmanager
+import io
+import mmap
+import os
+import sys
+import tarfile
+
+import numpy as np
+
+from . import metrics
+from .cache import LRUCache
+from .store import CODEC_RAW, ChapterStore, is_store
+
+TAR_INDEX_SUFFIX = '.index.npy'
+# batch reads merge members this close together into one range
+MAX_READ_GAP = 1 << 20
+
+
+def store_key(path):
+    # 'txt/<story_id>/<chapter_index>.txt' -> (story_id, chapter_index)
+    parts = member_key(path).decode('utf8').split('/')
+    if len(parts) != 3 or parts[0] != 'txt' or not parts[2].endswith('.txt'):
+        raise KeyError(path)
+    try:
+        return int(parts[1]), int(parts[2][:-len('.txt')])
+    except ValueError:
+        raise KeyError(path)
+
+
+def member_key(path):
+    path = path.replace(os.sep, '/')
+    while path.startswith('./'):
+        path = path[2:]
+    return path.encode('utf8')
+
+
+def build_tar_index(tar_path):
+    entries = []
+    with tarfile.open(tar_path) as archive:
+        for member in archive:
+            if member.isfile():
+                entries.append((member_key(member.name), member.offset_data, member.size))
+
+    width = max([len(x[0]) for x in entries] + [1])
+    result = np.array(entries, dtype=[('name', f'S{width}'), ('offset', '<i8'), ('size', '<i8')])
+    result = result[np.argsort(result['name'], kind='stable')]
+    # a member appended later replaces earlier ones with the same name, as when extracting
+    last = np.ones(len(result), dtype=bool)
+    last[:-1] = result['name'][1:] != result['name'][:-1]
+    return result[last]
+
+
+def append_to_tar(tar_path, folder, paths):
+    # appends folder/<path> as <path> for each path that exists, then drops the tar index
+    # so the next open rebuilds it with the new members
+    with tarfile.open(tar_path, 'a') as archive:
+        for path in paths:
+            source = os.path.join(folder, path)
+            if os.path.exists(source):
+                archive.add(source, arcname=member_key(path).decode('utf8'))
+    try:
+        os.remove(tar_path + TAR_INDEX_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+
+def open_tar_index(tar_path):
+    # member name -> (offset, size), sorted by name so lookups are a binary search over
+    # a memory map instead of a scan over the tar headers
+    index_path = tar_path + TAR_INDEX_SUFFIX
+    try:
+        if os.path.getmtime(index_path) >= os.path.getmtime(tar_path):
+            return np.load(index_path, mmap_mode='r')
+    except OSError:
+        pass
+
+    index = build_tar_index(tar_path)
+    tmp_path = f'{index_path}.{os.getpid()}.npy'
+    try:
+        np.save(tmp_path, index)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        metrics.warn('tar_index_write', 'failed to write tar index:', e)
+    return index
+
+
+class ChapterCache:
+    # In-process cache of chapter texts bounded by a byte budget. With store_bytes the
+    # raw UTF-8 is kept and decoded on every hit, which is smaller for non-ASCII text.
+    def __init__(self, max_bytes=256 << 20, store_bytes=False):
+        self.max_bytes = max_bytes
+        self.store_bytes = store_bytes
+        size_fn = len if store_bytes else sys.getsizeof
+        self.entries = LRUCache(max_bytes, size_fn=size_fn)
+
+    def __reduce__(self):
+        # workers get an empty cache with the same settings
+        return (ChapterCache, (self.max_bytes, self.store_bytes))
+
+    def get_text(self, key, load):
+        value = self.entries.get(key)
+        if value is None:
+            data = load()
+            with metrics.timer('chapters.decode'):
+                if self.store_bytes:
+                    value = bytes(data)
+                    text = value.decode('utf-8')
+                else:
+                    value = text = str(data, 'utf-8')
+            self.entries.put(key, value)
+            return text
+
+        if self.store_bytes:
+            return value.decode('utf-8')
+        return value
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        stats = self.entries.stats()
+        return {
+            'hits': stats['hits'],
+            'misses': stats['misses'],
+            'evictions': stats['evictions'],
+            'entries': stats['entries'],
+            'bytes': stats['size'],
+            'max_bytes': self.max_bytes,
+        }
+
+
+class CachedChapters:
+    def __init__(self, cache_path, cache=None):
+        self.cache_path = cache_path
+        self.cache = cache
+        self.store = None
+        if cache_path.endswith('.tar'):
+            self.archive = open_mmap(cache_path)
+            self.members = open_tar_index(cache_path)
+            self.member_names = self.members['name']
+            self.folder = None
+        elif is_store(cache_path):
+            self.archive = None
+            self.store = ChapterStore(cache_path)
+            self.folder = None
+            # chapters cached after the store was last packed are still loose files in
+            # the archive directory next to it
+            self.loose_folder = os.path.dirname(os.path.abspath(cache_path))
+        elif os.path.isdir(cache_path):
+            self.archive = None
+            self.folder = cache_path
+        else:
+            raise Exception('invalid cache path: must be a tar archive, a chapter store or a directory')
+
+    def __reduce__(self):
+        return (CachedChapters, (self.cache_path, self.cache))
+
+    def member(self, path):
+        key = member_key(path)
+        if len(key) > self.member_names.dtype.itemsize:
+            raise KeyError(path)
+
+        position = int(np.searchsorted(self.member_names, key))
+        if position >= len(self.member_names) or self.member_names[position] != key:
+            raise KeyError(path)
+        return int(self.members['offset'][position]), int(self.members['size'][position])
+
+    @metrics.timed('chapters.read')
+    def read(self, path):
+        # tar members are returned as memoryviews into the shared page cache
+        if self.archive is not None:
+            offset, size = self.member(path)
+            return memoryview(self.archive)[offset:offset + size]
+        if self.store is not None:
+            try:
+                return self.store.read(*store_key(path))
+            except KeyError:
+                with open(os.path.join(self.loose_folder, path), 'rb') as f:
+                    return f.read()
+
+        with open(os.path.join(self.folder, path), 'rb') as f:
+            return f.read()
+
+    def exists(self, path):
+        try:
+            if self.archive is not None:
+                self.member(path)
+                return True
+            if self.store is not None and store_key(path) in self.store:
+                return True
+        except KeyError:
+            return False
+        folder = self.folder if self.store is None else self.loose_folder
+        return os.path.exists(os.path.join(folder, path))
+
+    def read_counted(self, path):
+        data = self.read(path)
+        metrics.add_bytes('chapters.read', len(data))
+        return data
+
+    def read_text(self, path):
+        if self.cache is not None:
+            # keyed by backend too, so a cache shared between archives never mixes them up
+            return self.cache.get_text((self.cache_path, path), lambda: self.read_counted(path))
+        data = self.read_counted(path)
+        with metrics.timer('chapters.decode'):
+            return str(data, 'utf-8')
+    
+    def position(self, path):
+        # sort key for where path is on disk; paths that can't be found sort last
+        try:
+            if self.archive is not None:
+                return (0, self.member(path)[0])
+            if self.store is not None:
+                segment, offset, _ = self.store.location(*store_key(path))
+                return (segment, offset)
+            return (os.stat(os.path.join(self.folder, os.path.dirname(path))).st_ino, path)
+        except (KeyError, OSError):
+            return (float('inf'), path)
+
+    def prefetch(self, paths):
+        # asks the kernel to start reading paths in the background
+        for path in paths:
+            try:
+                if self.archive is not None:
+                    advise_willneed(self.archive, *self.member(path))
+                    continue
+                if self.store is not None:
+                    try:
+                        segment, offset, length = self.store.location(*store_key(path))
+                        advise_willneed(self.store.segments[segment], offset, length)
+                        continue
+                    except KeyError:
+                        folder = self.loose_folder
+                else:
+                    folder = self.folder
+                fd = os.open(os.path.join(folder, path), os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+            except (KeyError, OSError, AttributeError):
+                pass
+
+    def locate(self, path):
+        # (mapped file, offset, length) of path's bytes, or None when it has to be read on
+        # its own (loose files and compressed store chunks); raises KeyError if missing
+        if self.archive is not None:
+            return (self.archive,) + self.member(path)
+        if self.store is not None:
+            try:
+                entry = self.store.index[self.store.position(*store_key(path))]
+            except KeyError:
+                return None
+            if entry['codec'] == CODEC_RAW:
+                return self.store.segments[int(entry['segment'])], int(entry['offset']), int(entry['length'])
+        return None
+
+    def read_ranges(self, paths):
+        # reads paths with members that are close together in the same file coalesced into
+        # one contiguous read, which is then sliced in memory. Returns {path: bytes}, and
+        # leaves out paths that can't be found.
+        results = {}
+        located = []
+        for path in paths:
+            try:
+                location = self.locate(path)
+                if location is None:
+                    results[path] = self.read(path)
+                    metrics.add_bytes('chapters.read', len(results[path]))
+                else:
+                    located.append((path,) + location)
+            except (KeyError, OSError):
+                pass
+
+        located.sort(key=lambda x: (id(x[1]), x[2]))
+        i = 0
+        while i < len(located):
+            _, mapped, start, _ = located[i]
+            end = start
+            j = i
+            while j < len(located) and located[j][1] is mapped and located[j][2] <= end + MAX_READ_GAP:
+                end = max(end, located[j][2] + located[j][3])
+                j += 1
+            with metrics.timer('chapters.read'):
+                data = memoryview(bytes(memoryview(mapped)[start:end]))
+            metrics.add_bytes('chapters.read', end - start)
+            for path, _, offset, length in located[i:j]:
+                results[path] = data[offset - start:offset - start + length]
+            i = j
+        return results
+
+    def read_batch(self, requests, order='physical', window=256):
+        # requests is a list of (key, [paths]). Yields (key, [texts]) with texts None when
+        # any path is missing. Requests are read in disk order, `window` at a time, while
+        # the next window is prefetched. With order='requested' each window is still read
+        # in disk order but yielded in the order given.
+        if order not in ('physical', 'requested'):
+            raise Exception(f'unknown batch order: {order}')
+
+        requests = [(key, paths, self.position(paths[0]) if paths else (0, 0)) for key, paths in requests]
+        if order == 'physical':
+            requests.sort(key=lambda x: x[2])
+        windows = [requests[i:i + window] for i in range(0, len(requests), window)]
+
+        if windows:
+            self.prefetch(path for _, paths, _ in windows[0] for path in paths)
+        for i, current in enumerate(windows):
+            if i + 1 < len(windows):
+                self.prefetch(path for _, paths, _ in windows[i + 1] for path in paths)
+
+            data = self.read_ranges([path for _, paths, _ in current for path in paths])
+            for key, paths, _ in current:
+                if not all(x in data for x in paths):
+                    yield key, None
+                    continue
+                with metrics.timer('chapters.decode'):
+                    texts = [str(data[x], 'utf-8') for x in paths]
+                yield key, texts
+
+    @contextmanager
+    def openfile(self, path):
+        if self.folder is None:
+            yield io.BytesIO(self.read(path))
+        else:
+            result = open(os.path.join(self.folder, path), 'rb')
+            yield result
+            result.close()
+
+
+def advise_willneed(mapped, offset, length):
+    if not length or not hasattr(mapped, 'madvise'):
+        return
+    start = offset - offset % mmap.PAGESIZE
+    mapped.madvise(mmap.MADV_WILLNEED, start, offset + length - start)
+
+
+def open_mmap(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
@@ -0,0 +1,166 @@
+from datetime import datetime, timezone
+import json
+import os
+
+import numpy as np
+
+NUMERIC_COLUMNS = ['num_likes', 'num_dislikes', 'num_words', 'num_views']
+DATE_COLUMNS = ['date_published', 'date_modified', 'date_updated']
+CATEGORICAL_COLUMNS = ['completion_status', 'content_rating']
+STORY_COLUMNS = NUMERIC_COLUMNS + DATE_COLUMNS + CATEGORICAL_COLUMNS
+# columns with presorted copies, so range comparisons on them are binary searches
+SORTED_COLUMNS = NUMERIC_COLUMNS + DATE_COLUMNS
+
+
+def parse_date(value):
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+def missing_values(values):
+    if np.issubdtype(values.dtype, np.datetime64):
+        return np.isnat(values)
+    return np.isnan(values)
+
+
+def sort_column(values):
+    # returns (ordinals, sorted values) for the stories that have a value, ties in
+    # ordinal order
+    values = np.asarray(values)
+    present = np.flatnonzero(~missing_values(values))
+    order = present[np.argsort(values[present], kind='stable')].astype(np.uint32)
+    return order, values[order]
+
+
+class ColumnBuilder:
+    def __init__(self):
+        self.values = dict((name, []) for name in STORY_COLUMNS)
+        self.categories = dict((name, {}) for name in CATEGORICAL_COLUMNS)
+
+    def add(self, story_data):
+        for name in NUMERIC_COLUMNS:
+            value = story_data.get(name)
+            self.values[name].append(value if isinstance(value, (int, float)) else np.nan)
+
+        for name in DATE_COLUMNS:
+            self.values[name].append(parse_date(story_data.get(name)))
+
+        for name in CATEGORICAL_COLUMNS:
+            codes = self.categories[name]
+            value = story_data.get(name)
+            self.values[name].append(codes.setdefault(value, len(codes)))
+
+    def arrays(self):
+        result = {}
+        for name in NUMERIC_COLUMNS:
+            result[name] = np.array(self.values[name], dtype=np.float64)
+        for name in DATE_COLUMNS:
+            seconds = [np.iinfo(np.int64).min if x is None else x for x in self.values[name]]
+            result[name] = np.array(seconds, dtype=np.int64).view('datetime64[s]')
+        for name in CATEGORICAL_COLUMNS:
+            result[name] = np.array(self.values[name], dtype=np.uint8)
+        return result
+
+    def labels(self):
+        return dict((name, list(codes)) for name, codes in self.categories.items())
+
+    def finish(self):
+        return StoryColumns(self.arrays(), self.labels())
+
+    def save(self, path):
+        self.finish().save(path)
+
+
+# One array per field, indexed by story ordinal. Numeric fields are float64 with NaN for
+# missing values, dates are datetime64[s] with NaT, and categorical fields are uint8 codes
+# into labels[name].
+class StoryColumns:
+    def __init__(self, arrays, labels, sorted_columns=None):
+        self.arrays = arrays
+        self.labels = labels
+        # name -> (ordinals, values) from sort_column, filled in on first use when the
+        # snapshot didn't provide them
+        self.sorted_columns = sorted_columns or {}
+
+    @classmethod
+    def load(cls, path):
+        arrays = {}
+        sorted_columns = {}
+        for name in STORY_COLUMNS:
+            arrays[name] = np.load(os.path.join(path, f'column_{name}.npy'), mmap_mode='r')
+        for name in SORTED_COLUMNS:
+            sorted_columns[name] = (
+                np.load(os.path.join(path, f'order_{name}.npy'), mmap_mode='r'),
+                np.load(os.path.join(path, f'sorted_{name}.npy'), mmap_mode='r'))
+        with open(os.path.join(path, 'column_labels.json'), encoding='utf8') as f:
+            labels = json.load(f)
+        return cls(arrays, labels, sorted_columns)
+
+    def save(self, path):
+        for name, array in self.arrays.items():
+            np.save(os.path.join(path, f'column_{name}.npy'), array)
+            if name in SORTED_COLUMNS:
+                order, values = self.sorted_column(name)
+                np.save(os.path.join(path, f'order_{name}.npy'), order)
+                np.save(os.path.join(path, f'sorted_{name}.npy'), values)
+        with open(os.path.join(path, 'column_labels.json'), 'w', encoding='utf8') as f:
+            json.dump(self.labels, f, ensure_ascii=False)
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __len__(self):
+        return len(self.arrays[NUMERIC_COLUMNS[0]])
+
+    def names(self):
+        return list(self.arrays.keys())
+
+    def is_categorical(self, name):
+        return name in self.labels
+
+    def code(self, name, label):
+        # returns a code that matches nothing if the label never occurs
+        try:
+            return self.labels[name].index(label)
+        except ValueError:
+            return len(self.labels[name])
+
+    def decoded(self, name):
+        labels = np.array(self.labels[name] + [None], dtype=object)
+        return labels[np.asarray(self.arrays[name])]
+
+    def values(self, name):
+        if self.is_categorical(name):
+            return self.decoded(name)
+        return self.arrays[name]
+
+    def sorted_column(self, name):
+        if name not in self.sorted_columns:
+            self.sorted_columns[name] = sort_column(self.arrays[name])
+        return self.sorted_columns[name]
+
+    def range_ordinals(self, name, comparator, value):
+        # ordinals (in value order) of the stories where `column comparator value` holds,
+        # found by binary search over the sorted column. Missing values never match, the
+        # same as NaN and NaT in a full comparison.
+        order, values = self.sorted_column(name)
+        if comparator == '>':
+            return order[np.searchsorted(values, value, 'right'):]
+        if comparator == '>=':
+            return order[np.searchsorted(values, value, 'left'):]
+        if comparator == '<':
+            return order[:np.searchsorted(values, value, 'left')]
+        if comparator == '<=':
+            return order[:np.searchsorted(values, value, 'right')]
+        start = np.searchsorted(values, value, 'left')
+        return order[start:np.searchsorted(values, value, 'right')]
@@ -0,0 +1,166 @@
+from datetime import datetime, timezone
+import json
+import os
+import shutil
+
+from . import metrics
+from .pipeline import JOURNAL_FILENAME, Journal
+
+# Carries the txt/ cache of a previous fimfarchive release over to a new one. Chapters are
+# matched by chapter id and date_modified, so a chapter that is unchanged (even if it moved
+# to a different position) is copied from the previous cache, and only added or modified
+# chapters are extracted again.
+
+MANIFEST_FILENAME = 'delta-manifest.json'
+
+
+def chapter_key(chapter):
+    return chapter['id'], chapter.get('date_modified')
+
+
+def diff_chapters(old_chapters, new_chapters):
+    # for each new chapter, the position of the identical old chapter, or None if it has to
+    # be extracted again
+    old_positions = dict((chapter_key(x), i) for i, x in enumerate(old_chapters))
+    return [old_positions.get(chapter_key(x)) for x in new_chapters]
+
+
+def diff_indexes(old_index, new_index):
+    # returns ({story_id: sources}, removed_story_ids) where sources comes from diff_chapters
+    # and is None for added stories. Stories are compared by their chapter hashes first,
+    # so only the ones whose chapters differ get decoded.
+    old_ordinals = dict((x, i) for i, x in enumerate(old_index.story_ids.tolist()))
+    old_hashes = old_index.chapter_hashes
+    plans = {}
+    new_ids = new_index.story_ids.tolist()
+    for ordinal, story_id in enumerate(new_ids):
+        old_ordinal = old_ordinals.get(story_id)
+        if old_ordinal is None:
+            plans[str(story_id)] = None
+        elif old_hashes[old_ordinal] == new_index.chapter_hashes[ordinal]:
+            plans[str(story_id)] = list(range(int(new_index.chapter_counts[ordinal])))
+        else:
+            metrics.count('delta.stories_decoded')
+            old_chapters = old_index.story(old_ordinal)['chapters']
+            plans[str(story_id)] = diff_chapters(old_chapters, new_index.story(ordinal)['chapters'])
+
+    new_ids = set(new_ids)
+    removed = [str(x) for x in old_index.story_ids.tolist() if x not in new_ids]
+    return plans, removed
+
+
+def story_status(sources):
+    if sources is None:
+        return 'added'
+    if all(x == i for i, x in enumerate(sources)):
+        return 'unchanged'
+    return 'changed'
+
+
+def copy_chapter(old_archive, story_id, old_position, target_path):
+    source = os.path.join('txt', story_id, f'{old_position}.txt')
+    if old_archive.chapter_texts.folder is not None:
+        try:
+            os.link(os.path.join(old_archive.chapter_texts.folder, source), target_path)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError:
+            # cross-device links
+            pass
+
+    try:
+        data = old_archive.chapter_texts.read(source)
+    except (KeyError, OSError):
+        return False
+    with open(target_path, 'wb') as f:
+        f.write(data)
+    return True
+
+
+def carry_over_story(old_archive, txt_path, story_id, sources):
+    # copies reusable chapters into txt_path/story_id and deletes stale ones; returns the
+    # chapter positions that still need to be extracted
+    story_path = os.path.join(txt_path, story_id)
+    os.makedirs(story_path, exist_ok=True)
+
+    for name in os.listdir(story_path):
+        position, ext = os.path.splitext(name)
+        if ext == '.txt' and position.isdigit() and int(position) >= len(sources):
+            os.remove(os.path.join(story_path, name))
+
+    pending = []
+    for position, old_position in enumerate(sources):
+        target_path = os.path.join(story_path, f'{position}.txt')
+        if os.path.exists(target_path):
+            continue
+        if old_position is None or not copy_chapter(old_archive, story_id, old_position, target_path):
+            pending.append(position)
+    return pending
+
+
+def update_cache(archive, old_archive, workers=None):
+    started = datetime.now(timezone.utc).isoformat()
+    txt_path = os.path.join(archive.unpacked_path, 'txt')
+    plans, removed = diff_indexes(old_archive.index, archive.index)
+
+    for story_id in removed:
+        shutil.rmtree(os.path.join(txt_path, story_id), ignore_errors=True)
+
+    stories = {}
+    complete = []
+    for story_id, sources in plans.items():
+        if sources is None:
+            num_chapters = int(archive.index.chapter_counts[archive.index.story_ordinal(story_id)])
+            pending = carry_over_story(old_archive, txt_path, story_id, [None] * num_chapters)
+        else:
+            pending = carry_over_story(old_archive, txt_path, story_id, sources)
+
+        status = story_status(sources)
+        if pending and status == 'unchanged':
+            # the previous cache was missing some of its chapters
+            status = 'changed'
+        if status != 'unchanged':
+            stories[story_id] = {'status': status, 'chapters': pending}
+        if not pending:
+            complete.append(story_id)
+
+    # stories with nothing left to extract count as cached, so build_cache skips them
+    journal = Journal(os.path.join(archive.unpacked_path, JOURNAL_FILENAME))
+    journal.record(sorted(set(complete) - journal.completed()))
+
+    pending_ids = [x for x, delta in stories.items() if delta['chapters']]
+    summary = archive.build_cache(workers=workers, story_ids=pending_ids)
+    for story_id in summary['failed']:
+        stories[story_id]['failed'] = True
+
+    for story_id in removed:
+        stories[story_id] = {'status': 'removed', 'chapters': []}
+
+    manifest = {
+        'previous': old_archive.unpacked_path,
+        'started': started,
+        'finished': datetime.now(timezone.utc).isoformat(),
+        'counts': dict((x, sum(1 for y in stories.values() if y['status'] == x))
+                       for x in ['added', 'changed', 'removed']),
+        'chapters_recomputed': sum(len(x['chapters']) for x in stories.values()),
+        'stories': stories,
+    }
+    write_manifest(archive.unpacked_path, manifest)
+    return manifest
+
+
+def write_manifest(unpacked_path, manifest):
+    path = os.path.join(unpacked_path, MANIFEST_FILENAME)
+    tmp_path = f'{path}.{os.getpid()}'
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def read_manifest(unpacked_path):
+    try:
+        with open(os.path.join(unpacked_path, MANIFEST_FILENAME), encoding='utf8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
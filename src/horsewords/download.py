@@ -0,0 +1,168 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+
+DEFAULT_BASE_URL = 'https://www.fimfiction.net'
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    # spaces calls at least 1/rate seconds apart across all threads; rate=None disables it
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def write_atomic(path, data):
+    # readers never see a partial file, and a failed download leaves nothing behind
+    tmp_path = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class Downloader:
+    # Fetches story epubs and chapter html over one keep-alive session. concurrency bounds
+    # the requests in flight and requests_per_second the rate they start at, both across
+    # every thread using this downloader. 429 and 5xx responses and connection errors are
+    # retried with jittered exponential backoff, honoring Retry-After up to max_retry_after
+    # seconds.
+    def __init__(self, base_url=DEFAULT_BASE_URL, concurrency=8, requests_per_second=4,
+                 retries=5, backoff=1.0, timeout=60, max_retry_after=60):
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.requests_per_second = requests_per_second
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_retry_after = max_retry_after
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.limiter = RateLimiter(requests_per_second)
+
+    def settings(self):
+        return (self.base_url, self.concurrency, self.requests_per_second,
+                self.retries, self.backoff, self.timeout, self.max_retry_after)
+
+    def __reduce__(self):
+        # sessions and locks stay in their process; a copy gets its own
+        return (self.__class__, self.settings())
+
+    def split(self, parts):
+        # a downloader for each of `parts` processes that together stay within these limits
+        base_url, concurrency, rps, retries, backoff, timeout, max_retry_after = self.settings()
+        return self.__class__(
+            base_url, max(1, concurrency // parts), rps / parts if rps else rps,
+            retries, backoff, timeout, max_retry_after)
+
+    def epub_url(self, story_id):
+        return f'{self.base_url}/story/download/{story_id}/epub'
+
+    def chapter_url(self, chapter_id):
+        return f'{self.base_url}/chapters/download/{chapter_id}/html'
+
+    def retry_delay(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                # a server asking for hours would otherwise stall this thread's slot
+                if int(retry_after) > self.max_retry_after:
+                    metrics.count('download.retry_after_clamped')
+                    return self.max_retry_after
+                return int(retry_after)
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def get(self, url):
+        # returns the response body, or None once retries run out or on any other error status
+        for attempt in range(self.retries + 1):
+            with metrics.timer('download.wait'):
+                self.limiter.wait()
+            response = None
+            try:
+                with self.slots, metrics.timer('download.request'):
+                    response = self.session.get(url, timeout=self.timeout)
+                    content = response.content
+            except requests.RequestException as e:
+                error = repr(e)
+            else:
+                if 200 <= response.status_code < 300:
+                    metrics.add_bytes('download', len(content))
+                    return content
+                if response.status_code not in RETRY_STATUSES:
+                    metrics.warn('download_failed', 'failed to fetch', url, response.status_code)
+                    return None
+                error = response.status_code
+
+            if attempt < self.retries:
+                metrics.count('download.retries')
+                time.sleep(self.retry_delay(attempt, response))
+        metrics.warn('download_failed', 'failed to fetch', url, error)
+        return None
+
+    def download(self, url, path):
+        if os.path.exists(path):
+            return True
+        data = self.get(url)
+        if data is None:
+            return False
+        write_atomic(path, data)
+        return True
+
+    def download_all(self, jobs):
+        # jobs is a list of (url, path); returns the paths that now exist
+        jobs = list(jobs)
+        with ThreadPoolExecutor(max(1, min(self.concurrency, len(jobs)))) as pool:
+            results = list(pool.map(lambda job: self.download(*job), jobs))
+        return [path for (_, path), ok in zip(jobs, results) if ok]
+
+    def epub_job(self, unpacked_path, story_id):
+        os.makedirs(os.path.join(unpacked_path, 'epub-delta'), exist_ok=True)
+        cache_path = os.path.join(unpacked_path, 'epub-delta', f'{story_id}.epub')
+        return self.epub_url(story_id), cache_path
+
+    def chapter_jobs(self, unpacked_path, story_id, chapters):
+        cache_dir = os.path.join(unpacked_path, 'html', f'{story_id}')
+        os.makedirs(cache_dir, exist_ok=True)
+        return [
+            (self.chapter_url(chapter['id']), os.path.join(cache_dir, f"{chapter['chapter_number']}.html"))
+            for chapter in chapters
+        ]
+
+    def fetch_epub(self, unpacked_path, story_id):
+        url, cache_path = self.epub_job(unpacked_path, story_id)
+        self.download(url, cache_path)
+        return cache_path
+
+    def fetch_epubs(self, unpacked_path, story_ids):
+        return self.download_all(self.epub_job(unpacked_path, x) for x in story_ids)
+
+    def fetch_chapters(self, unpacked_path, story_id, chapters):
+        self.download_all(self.chapter_jobs(unpacked_path, story_id, chapters))
+        return os.path.join(unpacked_path, 'html', f'{story_id}')
@@ -0,0 +1,122 @@
+import os
+import posixpath
+from urllib.parse import unquote
+import zipfile
+
+from ebooklib import epub
+from lxml import etree
+
+# Reads the chapters listed in an epub's NCX table of contents straight from the zip.
+# epub.read_epub decompresses and parses every item in the book (images, css, fonts)
+# before anything can be looked up; this only parses container.xml, the OPF and the
+# NCX, and chapter members are decompressed one at a time when their content is read.
+
+CONTAINER_NS = 'urn:oasis:names:tc:opendocument:xmlns:container'
+OPF_NS = 'http://www.idpf.org/2007/opf'
+NCX_NS = 'http://www.daisy.org/z3986/2005/ncx/'
+XHTML_MEDIA_TYPE = 'application/xhtml+xml'
+
+# same settings EbookLib parses package documents with
+XML_PARSER = etree.XMLParser(recover=True, resolve_entities=False)
+
+# EbookLib attaches every item to its book, and EpubHtml.get_content only uses that for
+# the page template and the default language
+BOOK = epub.EpubBook()
+
+
+class UnsupportedEpub(Exception):
+    # raised for books whose layout this reader doesn't replicate, like epub3 nav documents
+    pass
+
+
+class EpubChapter(epub.EpubHtml):
+    # EpubHtml that decompresses its member only while get_content() runs, so the text
+    # matches what read_epub's items produce
+    def __init__(self, zip_file, member, uid, file_name):
+        super().__init__(uid=uid, file_name=file_name, media_type=XHTML_MEDIA_TYPE)
+        self.zip_file = zip_file
+        self.member = member
+        self.book = BOOK
+
+    def get_content(self, default=None):
+        self.content = self.zip_file.read(self.member)
+        try:
+            return super().get_content(default)
+        finally:
+            self.content = None
+
+
+def read_xml(zip_file, name):
+    return etree.fromstring(zip_file.read(posixpath.normpath(name)), XML_PARSER)
+
+
+def find_opf_path(zip_file):
+    container = read_xml(zip_file, 'META-INF/container.xml')
+    opf_path = None
+    for root_file in container.iterfind(f'.//{{{CONTAINER_NS}}}rootfile[@media-type]'):
+        if root_file.get('media-type') == 'application/oebps-package+xml':
+            opf_path = root_file.get('full-path')
+    if opf_path is None:
+        raise UnsupportedEpub('no package document')
+    return opf_path
+
+
+def toc_links(ncx):
+    # (href, uid) for each top-level navPoint, like EbookLib's Link objects
+    nav_map = ncx.find(f'{{{NCX_NS}}}navMap')
+    result = []
+    for nav_point in nav_map.iterfind(f'{{{NCX_NS}}}navPoint'):
+        if nav_point.find(f'{{{NCX_NS}}}navPoint') is not None:
+            raise UnsupportedEpub('nested table of contents')
+        href = ''
+        for content in nav_point.iterfind(f'{{{NCX_NS}}}content'):
+            href = content.get('src', '')
+        result.append((href, nav_point.get('id', '')))
+    if not result:
+        raise UnsupportedEpub('empty table of contents')
+    return result
+
+
+def read_toc_chapters(epub_path):
+    # EpubChapter items in table of contents order. Entries before a toc.html entry are
+    # front matter and get dropped. Returns None if a listed chapter is missing.
+    if os.path.isdir(epub_path):
+        raise UnsupportedEpub('unpacked epub')
+
+    zip_file = zipfile.ZipFile(epub_path)
+    opf_path = find_opf_path(zip_file)
+    opf_dir = posixpath.dirname(opf_path)
+    opf = read_xml(zip_file, opf_path)
+
+    manifest = {}
+    for item in opf.find(f'{{{OPF_NS}}}manifest').iterfind(f'{{{OPF_NS}}}item'):
+        properties = item.get('properties', '').split()
+        if item.get('media-type') == XHTML_MEDIA_TYPE and 'nav' in properties:
+            raise UnsupportedEpub('epub3 navigation document')
+        manifest[item.get('id')] = (unquote(item.get('href')), item.get('media-type'), properties)
+
+    toc_id = opf.find(f'{{{OPF_NS}}}spine').get('toc', '')
+    if not toc_id:
+        return []
+    ncx = read_xml(zip_file, posixpath.join(opf_dir, manifest[toc_id][0]))
+
+    chapters = []
+    for href, uid in toc_links(ncx):
+        if href == 'toc.html':
+            chapters = []
+            continue
+        chapters.append(uid)
+
+    members = set(zip_file.namelist())
+    result = []
+    for uid in chapters:
+        if uid not in manifest:
+            return None
+        file_name, media_type, properties = manifest[uid]
+        if media_type != XHTML_MEDIA_TYPE or 'cover' in properties:
+            raise UnsupportedEpub(f'chapter {uid} is not a plain xhtml document')
+        member = posixpath.normpath(posixpath.join(opf_dir, file_name))
+        if member not in members:
+            return None
+        result.append(EpubChapter(zip_file, member, uid, file_name))
+    return result
@@ -0,0 +1,188 @@
+import multiprocessing
+import os
+import time
+
+from tqdm import tqdm
+
+from . import metrics, pipeline
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# One row per chapter, with the same fields the huggingface dataset has always had
+EXPORT_FIELDS = [
+    ('author', 'string'),
+    ('story', 'string'),
+    ('chapter', 'int64'),
+    ('story_tags', 'string'),
+    ('story_title', 'string'),
+    ('story_blurb', 'string'),
+    ('story_status', 'string'),
+    ('story_likes', 'int64'),
+    ('story_dislikes', 'int64'),
+    ('story_description', 'string'),
+    ('story_rating', 'string'),
+    ('created', 'string'),
+    ('updated', 'string'),
+    ('views', 'int64'),
+    ('text', 'string'),
+]
+EXPORT_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+
+def export_schema():
+    return pa.schema([(name, getattr(pa, kind)()) for name, kind in EXPORT_FIELDS])
+
+
+def story_rows(archive, story_id, chapters):
+    story = archive.stories_by_id[story_id]
+    story_fields = {
+        'author': story['author']['name'],
+        'story': story_id,
+        'story_tags': ','.join([x['name'] for x in story['tags']]),
+        'story_title': story['title'],
+        'story_blurb': story['short_description'],
+        'story_status': story['completion_status'],
+        'story_likes': story['num_likes'],
+        'story_dislikes': story['num_dislikes'],
+        'story_description': story['description_html'],
+        'story_rating': story['content_rating'],
+    }
+
+    chapter_metadata = sorted(story['chapters'], key=lambda x: x['chapter_number'])
+    for chapter, metadata in zip(chapters, chapter_metadata):
+        row = dict(story_fields)
+        row['chapter'] = metadata['chapter_number']
+        row['created'] = metadata['date_published']
+        row['updated'] = metadata['date_modified']
+        row['views'] = metadata['num_views']
+        row['text'] = chapter
+        yield row
+
+
+class ShardWriter:
+    # buffers rows column by column and writes a record batch (a parquet row group) whenever
+    # row_group_size rows or row_group_bytes of chapter text are buffered
+    def __init__(self, path, format, row_group_size, row_group_bytes):
+        self.path = path
+        self.tmp_path = f'{path}.{os.getpid()}.tmp'
+        self.schema = export_schema()
+        self.row_group_size = row_group_size
+        self.row_group_bytes = row_group_bytes
+        if format == 'parquet':
+            self.writer = pq.ParquetWriter(self.tmp_path, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(self.tmp_path, self.schema)
+        self.columns = dict((name, []) for name, _ in EXPORT_FIELDS)
+        self.buffered_rows = 0
+        self.buffered_bytes = 0
+        self.num_rows = 0
+        self.num_bytes = 0
+
+    def add(self, row):
+        for name, values in self.columns.items():
+            values.append(row[name])
+        self.buffered_rows += 1
+        self.buffered_bytes += len(row['text'].encode('utf-8'))
+        if self.buffered_rows >= self.row_group_size or self.buffered_bytes >= self.row_group_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered_rows:
+            return
+        batch = pa.RecordBatch.from_pydict(self.columns, schema=self.schema)
+        self.writer.write_batch(batch)
+        self.num_rows += self.buffered_rows
+        self.num_bytes += self.buffered_bytes
+        self.columns = dict((name, []) for name, _ in EXPORT_FIELDS)
+        self.buffered_rows = 0
+        self.buffered_bytes = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        os.replace(self.tmp_path, self.path)
+
+
+def export_shard(archive, path, story_ids, format, row_group_size, row_group_bytes):
+    writer = ShardWriter(path, format, row_group_size, row_group_bytes)
+    try:
+        # stories whose chapters aren't all cached are skipped
+        for story_id, chapters in archive.get_chapters_batch(story_ids, order='requested'):
+            if chapters is None:
+                continue
+            for row in story_rows(archive, story_id, chapters):
+                writer.add(row)
+        writer.close()
+    except BaseException:
+        writer.writer.close()
+        os.remove(writer.tmp_path)
+        raise
+    return path, writer.num_rows, writer.num_bytes
+
+
+def export_worker_shard(args):
+    return export_shard(pipeline.WORKER_ARCHIVE, *args), metrics.collect()
+
+
+def export(archive, output_path, query=None, workers=None, stories_per_shard=2000,
+           row_group_size=1000, row_group_bytes=64 << 20, format='parquet'):
+    # Writes every chapter of the matching stories into numbered shards under output_path.
+    # Shards cover consecutive ranges of story ids and are written by a process pool.
+    if pa is None:
+        raise Exception('exporting requires pyarrow')
+    if format not in EXPORT_FORMATS:
+        raise Exception(f'unknown export format: {format}')
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if query is None:
+        story_ids = list(archive.stories_by_id)
+    else:
+        story_ids = list(archive.query_stories(query))
+    story_ids.sort(key=int)
+
+    os.makedirs(output_path, exist_ok=True)
+    shards = []
+    for i, chunk in enumerate(pipeline.chunked(story_ids, stories_per_shard)):
+        path = os.path.join(output_path, f'part-{i:05d}{EXPORT_FORMATS[format]}')
+        shards.append((path, chunk, format, row_group_size, row_group_bytes))
+
+    num_rows = 0
+    num_bytes = 0
+    paths = []
+    start_time = time.monotonic()
+
+    pool = None
+    if workers == 1 or len(shards) <= 1:
+        results = (export_shard(archive, *x) for x in shards)
+    else:
+        initargs = pipeline.worker_initargs(archive, workers)
+        pool = multiprocessing.Pool(workers, initializer=pipeline.init_worker, initargs=initargs)
+        results = pipeline.merged_results(pool.imap(export_worker_shard, shards))
+
+    try:
+        with tqdm(total=len(shards), unit='shard') as progress:
+            for path, shard_rows, shard_bytes in results:
+                paths.append(path)
+                num_rows += shard_rows
+                num_bytes += shard_bytes
+                progress.update(1)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = time.monotonic() - start_time
+    print(f'exported {num_rows} chapters from {len(story_ids)} stories into {len(paths)} shards '
+          f'in {elapsed:.1f}s ({num_bytes / elapsed / 1e6 if elapsed else 0.0:.2f} MB/s of text)')
+    return {
+        'paths': paths,
+        'stories': len(story_ids),
+        'rows': num_rows,
+        'bytes': num_bytes,
+        'seconds': elapsed,
+    }
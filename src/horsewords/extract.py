@@ -0,0 +1,218 @@
+import re
+
+from bs4.builder import HTMLParserTreeBuilder
+from bs4.dammit import UnicodeDammit
+from bs4.element import CData
+
+try:
+    # private to bs4, so FAST_TEXT_SUPPORTED below also checks that it still drives the
+    # extractor the way it expects
+    from bs4.builder._htmlparser import BeautifulSoupHTMLParser
+except ImportError:
+    BeautifulSoupHTMLParser = None
+
+# Single-pass equivalent of BeautifulSoup(markup, 'html.parser') followed by
+# fimfarchive.chapter_soup_to_text. Tokenizing goes through the same parser adapter
+# BeautifulSoup uses, so entities, void elements and unclosed tags are handled the
+# same way, but no tree is built: text is appended to a flat list as it arrives and
+# each element only records the slice of that list it covers. The cleaning rules are
+# then applied by dropping slices.
+
+ROOT_TAG_NAME = '[document]'
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+BREAK = None
+
+BUILDER = HTMLParserTreeBuilder()
+
+
+class Element:
+    __slots__ = ['name', 'attrs', 'parent', 'start', 'end', 'removed', 'is_empty_element', 'h1_children']
+
+    def __init__(self, name, attrs, parent, start):
+        self.name = name
+        self.attrs = attrs
+        self.parent = parent
+        self.start = start
+        self.end = None
+        self.removed = False
+        self.is_empty_element = name in BUILDER.empty_element_tags
+        self.h1_children = []
+
+    def detached(self):
+        element = self
+        while element is not None:
+            if element.removed:
+                return True
+            element = element.parent
+        return False
+
+
+class ChapterTextExtractor:
+    def __init__(self):
+        self.builder = BUILDER
+        self.contains_replacement_characters = False
+        self.pieces = []
+        self.current_data = []
+        self.root = Element(ROOT_TAG_NAME, {}, None, 0)
+        self.stack = [self.root]
+        self.open_counts = {}
+        self.preserve_whitespace_stack = []
+        self.string_container_stack = []
+        self.headings = {'h1': [], 'h2': [], 'h3': []}
+        self.notes = []
+
+    def feed(self, markup):
+        if BeautifulSoupHTMLParser is None:
+            raise Exception('fast text extraction needs bs4.builder._htmlparser, which this beautifulsoup4 lacks')
+        if not isinstance(markup, str):
+            markup = UnicodeDammit(markup, is_html=True).unicode_markup
+
+        parser = BeautifulSoupHTMLParser(self, convert_charrefs=False)
+        parser.feed(markup)
+        parser.close()
+
+        self.endData()
+        while len(self.stack) > 1:
+            self.popTag()
+        self.root.end = len(self.pieces)
+        return self
+
+    # the methods below are the subset of the BeautifulSoup tree-builder interface that
+    # BeautifulSoupHTMLParser calls
+
+    def handle_starttag(self, name, namespace, nsprefix, attrs, sourceline=None, sourcepos=None, namespaces=None):
+        self.endData()
+        parent = self.stack[-1]
+
+        if name == 'p':
+            # clean_story inserts a <br> before every <p>, which becomes a newline
+            self.pieces.append(BREAK)
+        element = Element(name, attrs, parent, len(self.pieces))
+        if name == 'br':
+            self.pieces.append(BREAK)
+
+        if name in self.headings:
+            self.headings[name].append(element)
+        if name == 'h1':
+            parent.h1_children.append(element)
+        if name == 'div' and attrs.get('id') == 'authors-note':
+            self.notes.append((element, len(parent.h1_children)))
+
+        self.stack.append(element)
+        self.open_counts[name] = self.open_counts.get(name, 0) + 1
+        if name in self.builder.preserve_whitespace_tags:
+            self.preserve_whitespace_stack.append(element)
+        if name in self.builder.string_containers:
+            self.string_container_stack.append(element)
+        return element
+
+    def handle_endtag(self, name, nsprefix=None):
+        self.endData()
+        if name == ROOT_TAG_NAME:
+            return
+        for i in range(len(self.stack) - 1, 0, -1):
+            if not self.open_counts.get(name):
+                break
+            element = self.stack[i]
+            self.popTag()
+            if element.name == name:
+                break
+
+    def popTag(self):
+        element = self.stack.pop()
+        element.end = len(self.pieces)
+        self.open_counts[element.name] -= 1
+        if self.preserve_whitespace_stack and element is self.preserve_whitespace_stack[-1]:
+            self.preserve_whitespace_stack.pop()
+        if self.string_container_stack and element is self.string_container_stack[-1]:
+            self.string_container_stack.pop()
+
+    def handle_data(self, data):
+        self.current_data.append(data)
+
+    def endData(self, containerClass=None):
+        if not self.current_data:
+            return
+
+        current_data = ''.join(self.current_data)
+        self.current_data = []
+        if not self.preserve_whitespace_stack:
+            if all(x in ASCII_SPACES for x in current_data):
+                current_data = '\n' if '\n' in current_data else ' '
+
+        # get_text() only returns plain strings and CDATA: comments, doctypes and the
+        # contents of <script>, <style>, <template>, <rt> and <rp> are skipped
+        if containerClass is None:
+            if self.string_container_stack:
+                return
+        elif containerClass is not CData:
+            return
+        self.pieces.append(current_data)
+
+    # cleaning and output
+
+    def element_text(self, element):
+        return ''.join(x for x in self.pieces[element.start:element.end] if x is not BREAK)
+
+    def first_heading(self, name):
+        for element in self.headings[name]:
+            if not element.detached():
+                return element
+        return None
+
+    def heading_text(self, name):
+        # the text of the first <name> element before any cleaning, like soup.h3.getText()
+        headings = self.headings[name]
+        if not headings:
+            raise AttributeError("'NoneType' object has no attribute 'getText'")
+        return self.element_text(headings[0])
+
+    def clean(self):
+        for div, num_h1 in self.notes:
+            h1 = None
+            for candidate in reversed(div.parent.h1_children[:num_h1]):
+                if not candidate.removed:
+                    h1 = candidate
+                    break
+            if h1 is None:
+                raise AttributeError("'NoneType' object has no attribute 'name'")
+            assert self.element_text(h1) == "Author's Note"
+            h1.removed = True
+            div.removed = True
+
+        for name in ['h1', 'h2', 'h3']:
+            element = self.first_heading(name)
+            if element is not None:
+                element.removed = True
+
+    def text(self):
+        self.clean()
+
+        keep = bytearray(b'\x01') * len(self.pieces)
+        for elements in self.headings.values():
+            for element in elements:
+                if element.removed:
+                    keep[element.start:element.end] = bytes(element.end - element.start)
+        for div, _ in self.notes:
+            if div.removed:
+                keep[div.start:div.end] = bytes(div.end - div.start)
+
+        result = ''.join('\n' if x is BREAK else x for x, k in zip(self.pieces, keep) if k)
+        result = result.strip()
+        return re.sub(r'\n{4}\n*', '\n'*4, result)
+
+
+def html_to_text(markup):
+    return ChapterTextExtractor().feed(markup).text()
+
+
+def fast_text_supported():
+    # whether this beautifulsoup4 works with the extractor; Fimfarchive falls back to the
+    # soup path if not
+    try:
+        return html_to_text("<h1>x</h1><p>a &amp; b<br>c</p><b>d") == 'a & b\ncd'
+    except Exception:
+        return False
+
+
+FAST_TEXT_SUPPORTED = fast_text_supported()
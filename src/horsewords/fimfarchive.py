@@ -1,90 +1,245 @@
 import ast
-from contextlib import contextmanager
-import json
+import functools
 from lark import v_args
 from bs4 import BeautifulSoup
 from ebooklib import epub
 import re
 import os
-import requests
 import glob
-import tarfile
 
-from .query import QueryFilter
-from .template import TemplatedString
+import numpy as np
 
+from . import extract, metrics
+from .chapters import CachedChapters, append_to_tar
+from .delta import read_manifest, update_cache
+from .download import Downloader
+from .epubs import UnsupportedEpub, read_toc_chapters
+from .export import export
+from .extract import ChapterTextExtractor
+from .index import ArchiveIndex, attach_index, iter_stories, open_snapshot, publish_index
+from .pipeline import build_cache
+from .query import Feature, QueryFilter, column_feature, combine_features
+from .store import STORE_DIRNAME, ChapterStore, is_store, pack_chapters
+from .template import TemplatedString, create_embed_parser
+from .textindex import TEXT_INDEX_DIRNAME, build_text_index, open_text_index
 
-class CachedChapters:
-    def __init__(self, cache_path):
-        if cache_path.endswith('.tar'):
-            self.archive = tarfile.open(cache_path)
-            self.folder = None
-        elif os.path.isdir(cache_path):
-            self.archive = None
-            self.folder = cache_path
-        else:
-            raise Exception('invalid cache path: must be a tar archive or a directory')
-    
-    @contextmanager
-    def openfile(self, path):
-        if self.archive != None:
-            yield self.archive.extractfile(path)
-        else:
-            result = open(os.path.join(self.folder, path), 'rb')
-            yield result
-            result.close()
-    
 
 class Fimfarchive:
-    def __init__(self, unpacked_path):
+    def __init__(self, unpacked_path, use_snapshot=True, chapter_cache=None, fast_text=False, downloader=None,
+                 index_fields=None, index_tags=True, shared_index=None):
         self.unpacked_path = unpacked_path
+        self.use_snapshot = use_snapshot
+        # a partial index: story records keep only index_fields, and index_tags=False
+        # skips the tag tables. Partial indexes are streamed from index.json instead of
+        # using the snapshot.
+        self.index_fields = index_fields
+        self.index_tags = index_tags
+        # attaches to an index published by share_index() in another process instead of
+        # loading one
+        self.shared_index = shared_index
+        # fast_text extracts chapter text in one pass without building a soup
+        if fast_text and not extract.FAST_TEXT_SUPPORTED:
+            metrics.warn('fast_text', 'warning: fast_text does not work with this beautifulsoup4, using BeautifulSoup')
+            fast_text = False
+        self.fast_text = fast_text
+        self.downloader = downloader or Downloader()
+        self.load_index()
+
+        # stories added, changed or removed by the last update_from, by story id
+        manifest = read_manifest(unpacked_path)
+        self.delta_index = manifest['stories'] if manifest else {}
+
+        self.chapter_cache = chapter_cache
+        self.open_chapters()
+        self.open_text_index()
 
-        with open(f"{unpacked_path}/index.json", encoding='utf8') as index_file:
-            index = json.load(index_file)
-
-        self.tags_by_type = {}
-        self.tags_by_id = {}
-        self.tags_by_name = {}
-        self.stories_by_tag = {}
-        self.stories_by_id = {}
-        self.delta_index = {}
-
-        tar_path = os.path.join(unpacked_path, 'txt.tar')
-        if os.path.exists(tar_path):
-            self.chapter_texts = CachedChapters(tar_path)
-        else:
-            self.chapter_texts = CachedChapters(unpacked_path)
-
-        for story_id, story_data in index.items():
-            self.stories_by_id[story_id] = story_data
-            for tag_data in story_data['tags']:
-                tag_id = tag_data['id']
-                tag_name = tag_data['name'].lower()
-                tag_type = tag_data['type'].lower()
-
-                tag_bucket = self.tags_by_type.setdefault(tag_type, {})
-                tag_bucket[tag_id] = tag_name
-
-                story_bucket = self.stories_by_tag.setdefault(tag_id, set())
-                story_bucket.add(story_id)
-
-                reverse_bucket = self.tags_by_name.setdefault(tag_name, set())
-                reverse_bucket.add(tag_id)
-
-                self.tags_by_id[tag_id] = tag_data
-        
         self.query_tags = TagFilter(self)
         self.query_stories = StoryFilter(self)
+
+    @metrics.timed('index.load')
+    def load_index(self):
+        index_path = os.path.join(self.unpacked_path, 'index.json')
+
+        if self.shared_index is not None:
+            index = attach_index(self.shared_index)
+        elif self.index_fields is not None or not self.index_tags:
+            index = ArchiveIndex.from_json(index_path, self.index_fields, self.index_tags)
+        elif self.use_snapshot:
+            try:
+                index = open_snapshot(index_path)
+            except OSError as e:
+                metrics.warn('snapshot_open', 'failed to open index snapshot, loading index.json directly:', e)
+                index = ArchiveIndex.from_json(index_path)
+        else:
+            index = ArchiveIndex.from_json(index_path)
+        self.set_index(index)
+
+    def set_index(self, index):
+        self.index = index
+        self.tags_by_type = self.index.tags_by_type
+        self.tags_by_id = self.index.tags_by_id
+        self.tags_by_name = self.index.tags_by_name
+        self.stories_by_tag = self.index.stories_by_tag
+        self.stories_by_id = self.index.stories
+        self.story_columns = self.index.columns
+        self.tag_name_index = self.index.tag_names
+
+    def share_index(self, path=None):
+        # Publishes the index as read-only memory-mapped files (in /dev/shm unless path is
+        # given) and returns their directory. Pool workers and pickled copies of this
+        # archive attach to it rather than each loading the index, so memory stays flat
+        # as workers are added. Snapshot-backed indexes are already files and are shared
+        # as they are.
+        if self.index.path is None:
+            self.set_index(publish_index(self.index, path))
+            self.query_tags.reset(self.tags_by_id)
+            self.query_stories.reset(self.stories_by_id, self.story_columns)
+        return self.index.path
+
+    def __reduce__(self):
+        # e.g. for joblib's multiprocessing backend: the copy attaches to the shared index,
+        # once per process. Publishing is left to share_index(), so pickling never
+        # creates files behind the caller's back.
+        if self.index.path is None:
+            raise Exception('call share_index() before pickling an archive whose index is not backed by files')
+        return (attach_archive, (self.index.path, self.unpacked_path, self.use_snapshot, self.chapter_cache,
+                                 self.fast_text, self.downloader, self.index_fields, self.index_tags))
+
+    def open_chapters(self):
+        # prefers a packed chapter store, then txt.tar, then the txt/ directory. Reopening
+        # means chapters may have changed underneath, so cached texts are dropped.
+        if self.chapter_cache is not None and getattr(self, 'chapter_texts', None) is not None:
+            self.chapter_cache.clear()
+        store_path = os.path.join(self.unpacked_path, STORE_DIRNAME)
+        tar_path = os.path.join(self.unpacked_path, 'txt.tar')
+        if is_store(store_path):
+            self.chapter_texts = CachedChapters(store_path, self.chapter_cache)
+        elif os.path.exists(tar_path):
+            self.chapter_texts = CachedChapters(tar_path, self.chapter_cache)
+        else:
+            self.chapter_texts = CachedChapters(self.unpacked_path, self.chapter_cache)
+
+    def pack_chapters(self, compression=None):
+        # copies the txt/ cache (or txt.tar) into a chapter store under chapter-store/,
+        # which is read from from then on. Chapters already in the store are skipped, so
+        # this can be rerun after build_cache or update_from adds chapters. The txt/ files
+        # are left in place and can be deleted afterwards.
+        store_path = os.path.join(self.unpacked_path, STORE_DIRNAME)
+        tar_path = os.path.join(self.unpacked_path, 'txt.tar')
+        source = CachedChapters(tar_path if os.path.exists(tar_path) else self.unpacked_path)
+        existing = ChapterStore(store_path) if is_store(store_path) else None
+        stories = [(x, len(story['chapters'])) for x, story in self.stories_by_id.items()]
+
+        num_chapters, num_bytes = pack_chapters(source, store_path, stories, compression, existing)
+        print(f'packed {num_chapters} chapters ({num_bytes / 1e6:.1f} MB)')
+        self.open_chapters()
+        return num_chapters
+
+    def open_text_index(self):
+        self.text_index = open_text_index(os.path.join(self.unpacked_path, TEXT_INDEX_DIRNAME), self.index,
+                                          self.chapter_texts)
+
+    def build_text_index(self, workers=None, stories_per_run=200):
+        # indexes the cached chapter text so text:"..." queries work
+        build_text_index(self, os.path.join(self.unpacked_path, TEXT_INDEX_DIRNAME), workers, stories_per_run)
+        self.open_text_index()
+        self.query_stories.reset(self.stories_by_id, self.story_columns)
+
+    def refresh_text_index(self):
+        # after chapters were cached, since a text index that left them out is stale now
+        if self.text_index is not None:
+            self.open_text_index()
+            self.query_stories.reset(self.stories_by_id, self.story_columns)
+
+    def reload(self):
+        # picks up a changed index.json and drops cached query results
+        self.load_index()
+        self.open_chapters()
+        self.open_text_index()
+        self.query_tags.reset(self.tags_by_id)
+        self.query_stories.reset(self.stories_by_id, self.story_columns)
     
     def get_cached_chapters(self, story_id):
         result = []
         for chapter_index in range(len(self.stories_by_id[story_id]['chapters'])):
             cache_path = os.path.join('txt', story_id, f'{chapter_index}.txt')
-            with self.chapter_texts.openfile(cache_path) as input:
-                result.append(input.read().decode('utf-8'))
+            result.append(self.chapter_texts.read_text(cache_path))
         return result
     
+    def get_chapters_batch(self, story_ids, order='physical', window=256):
+        # yields (story_id, [chapter texts]) for many stories, reading them in the order
+        # they're stored on disk. Stories with missing chapters come back as None.
+        requests = []
+        for story_id in story_ids:
+            story_id = str(story_id)
+            num_chapters = len(self.stories_by_id[story_id]['chapters'])
+            requests.append((story_id, [os.path.join('txt', story_id, f'{i}.txt') for i in range(num_chapters)]))
+        return self.chapter_texts.read_batch(requests, order, window)
+
+    def build_cache(self, workers=None, chunk_size=64, story_ids=None, journal_path=None):
+        # caches chapters for every story (or story_ids) across a process pool, skipping
+        # stories already recorded in the journal
+        summary = build_cache(self, workers, chunk_size, story_ids, journal_path)
+        self.refresh_text_index()
+        return summary
+
+    def text_extraction_documents(self, story_ids=None):
+        # every epub chapter and downloaded html chapter for the given stories
+        if story_ids is None:
+            story_ids = list(self.stories_by_id)
+        for story_id in story_ids:
+            story_id = str(story_id)
+            epub_path = os.path.join(self.unpacked_path, self.stories_by_id[story_id]['archive']['path'])
+            for i, item in enumerate(get_epub_chapters(epub_path, self.stories_by_id[story_id]['chapters']) or []):
+                yield f'{epub_path}:{i}', item.get_content()
+            for chapter_path in get_html_chapters(os.path.join(self.unpacked_path, 'html', story_id)):
+                with open(chapter_path, encoding='utf8') as f:
+                    yield chapter_path, f.read()
+
+    def check_text_extraction(self, story_ids=None):
+        # compares fast_text extraction against BeautifulSoup over the archive's own chapters
+        return check_text_extraction(self.text_extraction_documents(story_ids))
+
+    def export(self, output_path, query=None, workers=None, stories_per_shard=2000,
+               row_group_size=1000, row_group_bytes=64 << 20, format='parquet'):
+        # writes one row per cached chapter into parquet (or arrow) shards, optionally only
+        # for stories matching a query_stories expression
+        return export(self, output_path, query, workers, stories_per_shard, row_group_size, row_group_bytes, format)
+
+    def update_from(self, previous_path, workers=None):
+        # fills this release's txt cache from a previous release's, extracting only added
+        # and modified chapters, and records the changes in delta-manifest.json
+        previous = Fimfarchive(previous_path, self.use_snapshot)
+        manifest = update_cache(self, previous, workers)
+        self.delta_index = manifest['stories']
+
+        # a packed store and txt.tar are both read before the txt/ files, and still have the
+        # previous text of every chapter that changed or moved, so those stories are
+        # written to them again
+        stories = [(x, len(self.stories_by_id[x]['chapters'])) for x, delta in manifest['stories'].items()
+                   if delta['status'] != 'removed']
+        store_path = os.path.join(self.unpacked_path, STORE_DIRNAME)
+        if is_store(store_path):
+            pack_chapters(CachedChapters(self.unpacked_path), store_path, stories,
+                          ChapterStore(store_path).compression)
+        tar_path = os.path.join(self.unpacked_path, 'txt.tar')
+        if os.path.exists(tar_path):
+            paths = [os.path.join('txt', x, f'{i}.txt') for x, count in stories for i in range(count)]
+            append_to_tar(tar_path, self.unpacked_path, paths)
+        self.open_chapters()
+        self.refresh_text_index()
+        return manifest
+
+    def fetch_epubs(self, story_ids):
+        # downloads missing epubs into epub-delta/ concurrently, within the downloader's limits
+        return self.downloader.fetch_epubs(self.unpacked_path, story_ids)
+
     def cache_chapters(self, story_id):
+        # sampled stories run under the profiler when metrics.enable_profiling is on
+        with metrics.timer('cache.story'), metrics.profile(story_id):
+            self.cache_story_chapters(story_id)
+
+    def cache_story_chapters(self, story_id):
         epub_relpath = self.stories_by_id[story_id]['archive']['path']
         epub_path = os.path.join(self.unpacked_path, epub_relpath)
         retrieved_chapters = get_epub_chapters(epub_path, self.stories_by_id[story_id]['chapters'])
@@ -93,70 +248,61 @@ class Fimfarchive:
         os.makedirs(txt_cache_path, exist_ok=True)
 
         if not retrieved_chapters:
-            epub_path = fetch_epub(self.unpacked_path, story_id)
+            with metrics.timer('cache.fetch_epub'):
+                epub_path = self.downloader.fetch_epub(self.unpacked_path, story_id)
             retrieved_chapters = get_epub_chapters(epub_path, self.stories_by_id[story_id]['chapters'])
         
         if retrieved_chapters:
             if len(retrieved_chapters) == len(self.stories_by_id[story_id]['chapters']):
-                cache_epub_chapters(retrieved_chapters, txt_cache_path)
+                cache_epub_chapters(retrieved_chapters, txt_cache_path, self.fast_text)
+                metrics.count('cache.epub_stories')
                 return
 
         chapters = self.stories_by_id[story_id]['chapters']
-        html_path = fetch_chapters(self.unpacked_path, story_id, chapters)
+        with metrics.timer('cache.fetch_chapters'):
+            html_path = self.downloader.fetch_chapters(self.unpacked_path, story_id, chapters)
         retrieved_chapters = get_html_chapters(html_path)
 
         if retrieved_chapters:
             if len(retrieved_chapters) == len(self.stories_by_id[story_id]['chapters']):
-                cache_html_chapters(retrieved_chapters, txt_cache_path, self.stories_by_id[story_id])
+                cache_html_chapters(retrieved_chapters, txt_cache_path, self.stories_by_id[story_id], self.fast_text)
+                metrics.count('cache.html_stories')
                 return
         
+        metrics.count('cache.failed_stories')
         if not retrieved_chapters:
-            print('cannot get chapters for story:', self.stories_by_id[story_id]['url'])
+            metrics.warn('no_chapters', 'cannot get chapters for story:', self.stories_by_id[story_id]['url'])
 
         if len(retrieved_chapters) != len(self.stories_by_id[story_id]['chapters']):
-            print('invalid chapter count:', self.stories_by_id[story_id]['url'])
+            metrics.warn('chapter_count', 'invalid chapter count:', self.stories_by_id[story_id]['url'])
             print(' -- goes in', epub_path)
 
 
-def fetch_epub(unpacked_path, story_id):
-    os.makedirs(os.path.join(unpacked_path, 'epub-delta'), exist_ok=True)
-    cache_path = os.path.join(unpacked_path, 'epub-delta', f'{story_id}.epub')
-    if os.path.exists(cache_path):
-        return cache_path
-    
-    epub_url = f'https://www.fimfiction.net/story/download/{story_id}/epub'
+# archives unpickled in this process, by shared index and options
+ATTACHED_ARCHIVES = {}
 
-    try:
-        page = requests.get(epub_url, stream=True)
-        epub_data = page.raw.read()
-        with open(cache_path, 'wb') as output:
-            output.write(epub_data)
-    except:
-        print('failed to fetch', epub_url)
-    
-    return cache_path
 
-def fetch_chapters(unpacked_path, story_id, chapters):
-    cache_dir = os.path.join(unpacked_path, 'html', f'{story_id}')
-    os.makedirs(cache_dir, exist_ok=True)
-    
-    for chapter in chapters:
-        chapter_path = os.path.join(cache_dir, f"{chapter['chapter_number']}.html")
-        if os.path.exists(chapter_path):
-            continue
+def attach_archive(shared_index, unpacked_path, use_snapshot=True, chapter_cache=None, fast_text=False,
+                   downloader=None, index_fields=None, index_tags=True):
+    fields = tuple(index_fields) if index_fields is not None else None
+    key = (shared_index, unpacked_path, use_snapshot, fast_text, fields, index_tags)
+    archive = ATTACHED_ARCHIVES.get(key)
+    if archive is None or archive.index is not attach_index(shared_index):
+        archive = Fimfarchive(unpacked_path, use_snapshot, chapter_cache, fast_text, downloader, index_fields,
+                              index_tags, shared_index)
+        ATTACHED_ARCHIVES[key] = archive
+    return archive
 
-        id = chapter['id']
-        html_url = f'https://www.fimfiction.net/chapters/download/{id}/html'
-        stream = requests.get(html_url, stream=True)
-        if stream.status_code < 200 or stream.status_code >= 400:
-            print('failed to fetch', html_url)
-            continue
 
-        html_data = stream.content
-        with open(chapter_path, 'wb') as f:
-            f.write(html_data)
-    
-    return cache_dir
+def iter_index(unpacked_path, fields=None):
+    # (story_id, story_data) for every story in index.json, streamed in constant memory
+    return iter_stories(os.path.join(unpacked_path, 'index.json'), fields)
+
+def fetch_epub(unpacked_path, story_id, downloader=None):
+    return (downloader or Downloader()).fetch_epub(unpacked_path, story_id)
+
+def fetch_chapters(unpacked_path, story_id, chapters, downloader=None):
+    return (downloader or Downloader()).fetch_chapters(unpacked_path, story_id, chapters)
 
 def get_html_chapters(html_cache_dir):
     chapter_paths = glob.glob(f'{html_cache_dir}/*')
@@ -172,7 +318,7 @@ def get_html_chapters(html_cache_dir):
     return result
         
 
-def cache_html_chapters(chapter_paths, story_cache_path, story_index_data):
+def cache_html_chapters(chapter_paths, story_cache_path, story_index_data, fast_text=False):
     for i, chapter_path in enumerate(chapter_paths):
         chapter_cache_path = os.path.join(story_cache_path, f'{i}.txt')
         if os.path.exists(chapter_cache_path):
@@ -180,19 +326,41 @@ def cache_html_chapters(chapter_paths, story_cache_path, story_index_data):
         
         with open(chapter_path, encoding='utf8') as f:
             chapter_data = f.read()
-        soup = BeautifulSoup(chapter_data, 'html.parser')
+        metrics.add_bytes('html.read', len(chapter_data))
+        with metrics.timer('html.extract'):
+            if fast_text:
+                extractor = ChapterTextExtractor().feed(chapter_data)
+                title = extractor.heading_text('h3')
+            else:
+                with metrics.timer('text.parse'):
+                    soup = BeautifulSoup(chapter_data, 'html.parser')
+                title = soup.h3.getText()
+            chapter_text = extractor.text() if fast_text else chapter_soup_to_text(soup)
 
-        title = soup.h3.getText()
         chapter = list(filter(lambda x: x['chapter_number'] == i+1, story_index_data['chapters']))[0]
         if title != chapter['title']:
-            print(f"title mismatch: found [{title} expected {chapter['title']}] in story_cache_path [{i}.txt]")
+            metrics.warn('title_mismatch', f"title mismatch: found [{title} expected {chapter['title']}] in story_cache_path [{i}.txt]")
         
-        chapter_text = chapter_soup_to_text(soup)
-        with open(chapter_cache_path, 'w', encoding='utf8') as f:
-            f.write(chapter_text)
+        data = chapter_text.encode('utf-8')
+        metrics.add_bytes('cache.text', len(data))
+        with open(chapter_cache_path, 'wb') as f:
+            f.write(data)
 
 
+@metrics.timed('epub.read')
 def get_epub_chapters(epub_path, expected_chapters):
+    try:
+        return read_toc_chapters(epub_path)
+    except UnsupportedEpub:
+        metrics.count('epub.ebooklib_fallback')
+        return read_epub_chapters(epub_path)
+    except:
+        metrics.warn('epub_read', 'failed to read', epub_path)
+        return None
+
+
+def read_epub_chapters(epub_path):
+    # slower path through EbookLib for books read_toc_chapters doesn't handle
     chapters = []
 
     try:
@@ -203,7 +371,7 @@ def get_epub_chapters(epub_path, expected_chapters):
                 continue
             chapters.append(item.uid)
     except:
-        print('failed to read', epub_path)
+        metrics.warn('epub_read', 'failed to read', epub_path)
         return None
 
     items = dict([(x.id, x) for x in pub.get_items()])
@@ -215,29 +383,65 @@ def get_epub_chapters(epub_path, expected_chapters):
         return None
 
 
-def cache_epub_chapters(epub_chapters, story_cache_path):
+def cache_epub_chapters(epub_chapters, story_cache_path, fast_text=False):
     for chapter_index, chapter in enumerate(epub_chapters):
         cache_path = os.path.join(story_cache_path, f'{chapter_index}.txt')
         if os.path.exists(cache_path):
             continue
 
-        cache = epub_item_to_text(chapter)
-        with open(cache_path, 'w', encoding='utf8') as output:
-            output.write(cache)
+        with metrics.timer('epub.extract'):
+            cache = epub_item_to_text(chapter, fast_text)
+        data = cache.encode('utf-8')
+        metrics.add_bytes('cache.text', len(data))
+        with open(cache_path, 'wb') as output:
+            output.write(data)
     
 
-def epub_item_to_text(item):
-    soup = BeautifulSoup(item.get_content(), 'html.parser')
+def epub_item_to_text(item, fast_text=False):
+    with metrics.timer('epub.get_content'):
+        content = item.get_content()
+    metrics.add_bytes('epub.content', len(content))
+    if fast_text:
+        return ChapterTextExtractor().feed(content).text()
+    with metrics.timer('text.parse'):
+        soup = BeautifulSoup(content, 'html.parser')
     chapter_text = chapter_soup_to_text(soup)
     return chapter_text
 
 def chapter_soup_to_text(soup):
-    clean_story(soup)
+    with metrics.timer('text.clean'):
+        clean_story(soup)
     chapter_text = soup.getText().strip()
     chapter_text = re.sub(r'\n{4}\n*', '\n'*4, chapter_text)
     return chapter_text
 
 
+def extract_text_both_ways(markup):
+    # runs both extractors on one chapter, turning errors into their type so that
+    # matching failures also count as agreement
+    results = []
+    for fast_text in [False, True]:
+        try:
+            if fast_text:
+                results.append(ChapterTextExtractor().feed(markup).text())
+            else:
+                results.append(chapter_soup_to_text(BeautifulSoup(markup, 'html.parser')))
+        except Exception as e:
+            results.append(type(e))
+    return results
+
+def check_text_extraction(documents):
+    # documents yields (name, markup) pairs; returns the names where the fast extractor
+    # disagrees with BeautifulSoup
+    mismatches = []
+    for name, markup in documents:
+        soup_text, fast_text = extract_text_both_ways(markup)
+        if soup_text != fast_text:
+            print('text extraction mismatch:', name)
+            mismatches.append(name)
+    return mismatches
+
+
 def clean_story(soup):
     # for h1 in soup.findChildren('h1'):
         # print(h1.getText())
@@ -272,11 +476,15 @@ STORY_FILTER_CUSTOMIZATIONS = r'''
 %import common.ESCAPED_STRING
 
 flag : CATEGORY ":" pattern -> categorized_tag
+     | "text" ":" pattern   -> text_search
      | pattern              -> standalone_tag             
 CATEGORY : "character" | "genre" | "series" | "content" | "warning"
-?pattern : PATTERN
-         | ESCAPED_STRING -> esc_string
-PATTERN : /\w[\w ]*/
+// a quoted pattern in parentheses is a pattern, not a string feature
+?pattern.2 : PATTERN
+           | ESCAPED_STRING -> esc_string
+// tag patterns stop before an "order by" or "limit" clause, and aren't followed by
+// anything that makes them a number, keyword or category
+PATTERN.2 : /\w(?:(?! +(?:order +by|limit)\b)[\w ])*(?!\w)(?![\s)]*[-+*\/^<>=.:(])/
 
 ?feature : ".ratio"      -> ratio_feature
         | ".status"     -> status_feature
@@ -292,69 +500,68 @@ PATTERN : /\w[\w ]*/
 class StoryFilter(QueryFilter):
     def __init__(self, archive):
         self.archive = archive
-        super().__init__(STORY_FILTER_CUSTOMIZATIONS, archive.stories_by_id)
+        super().__init__(STORY_FILTER_CUSTOMIZATIONS, archive.stories_by_id, columns=archive.story_columns)
+
+    def __reduce__(self):
+        # the copy is the attached archive's own filter
+        return (getattr, (self.archive, 'query_stories'))
     
     def esc_string(self, string):
         return ast.literal_eval(string)
     
     def standalone_tag(self, tag):
-        result = set()
         pattern = tag.lower()
+        matching_tags = self.archive.tag_name_index.search(pattern)
 
-        found_match = False
-        for tag_name, tag_ids in self.archive.tags_by_name.items():
-            if pattern in tag_name:
-                found_match = True
-                for id in tag_ids:
-                    result.update(self.archive.stories_by_tag[id])
-
-        if not found_match:
-            print(f'warning: no match for tag pattern {pattern}')
+        if not matching_tags:
+            metrics.warn('unmatched_tag', f'warning: no match for tag pattern {pattern}')
         
-        return result
+        return self.stories_with_tags(matching_tags)
     
     def categorized_tag(self, category, tag):
-        result = set()
         category = category.lower()
         pattern = tag.lower()
 
         if category not in self.archive.tags_by_type:
-            print(f'warning: {category} is not a valid tag type... use one of {self.archive.tags_by_type.keys()}')
-            return result
+            metrics.warn('tag_type', f'warning: {category} is not a valid tag type... use one of {self.archive.tags_by_type.keys()}')
+            return self.stories_with_tags([])
 
-        relevant_tags = self.archive.tags_by_type[category]
-
-        found_match = False
-        for tag_id, tag_name in self.archive.tags_by_type[category].items():
-            if pattern in tag_name:
-                found_match = True
-                result.update(self.archive.stories_by_tag[tag_id])
-    
-        if not found_match:
-            print(f'warning: no match for tag pattern {category}:{pattern}')
+        matching_tags = self.archive.tag_name_index.search(pattern, category)
+        if not matching_tags:
+            metrics.warn('unmatched_tag', f'warning: no match for tag pattern {category}:{pattern}')
         
-        return result
+        return self.stories_with_tags(matching_tags)
+
+    def text_search(self, text):
+        if self.archive.text_index is None:
+            raise Exception('text queries need a text index: run build_text_index() first')
+        return self.result_from_ordinals(self.archive.text_index.search(text))
+
+    def stories_with_tags(self, tag_ids):
+        return self.result_from_ordinals(self.archive.index.stories_for_tags(tag_ids))
     
     def status_feature(self):
-        return lambda x: x['completion_status']
+        return column_feature('completion_status')
     
     def likes_feature(self):
-        return lambda x: x['num_likes']
+        return column_feature('num_likes')
     
     def dislikes_feature(self):
-        return lambda x: x['num_dislikes']
+        return column_feature('num_dislikes')
     
     def ratio_feature(self):
-        return lambda x: max(x['num_likes'], 0.5) / max(x['num_dislikes'], 0.5)
+        return Feature(
+            lambda x: max(x['num_likes'], 0.5) / max(x['num_dislikes'], 0.5),
+            lambda columns: np.maximum(columns['num_likes'], 0.5) / np.maximum(columns['num_dislikes'], 0.5))
     
     def wordcount_feature(self):
-        return lambda x: x['num_words']
+        return column_feature('num_words')
     
     def max(self, args):
-        return lambda x: max(*[f(x) for f in args])
+        return combine_features(max, lambda *values: functools.reduce(np.maximum, values), *args)
     
     def min(self, args):
-        return lambda x: min(*[f(x) for f in args])
+        return combine_features(min, lambda *values: functools.reduce(np.minimum, values), *args)
 
 
 TAG_FILTER_CUSTOMIZATIONS = r'''
@@ -362,10 +569,13 @@ TAG_FILTER_CUSTOMIZATIONS = r'''
 
 flag : CATEGORY ":" pattern -> categorized_tag
      | pattern              -> standalone_tag             
-?pattern : PATTERN
-         | ESCAPED_STRING -> esc_string
+// a quoted pattern in parentheses is a pattern, not a string feature
+?pattern.2 : PATTERN
+           | ESCAPED_STRING -> esc_string
 CATEGORY : "character" | "genre" | "series" | "content" | "warning"
-PATTERN : /\w[\w ]*/
+// tag patterns stop before an "order by" or "limit" clause, and aren't followed by
+// anything that makes them a number, keyword or category
+PATTERN.2 : /\w(?:(?! +(?:order +by|limit)\b)[\w ])*(?!\w)(?![\s)]*[-+*\/^<>=.:(])/
 
 ?feature : json_feature
 '''
@@ -375,43 +585,32 @@ class TagFilter(QueryFilter):
     def __init__(self, archive):
         self.archive = archive
         super().__init__(TAG_FILTER_CUSTOMIZATIONS, archive.tags_by_id)
+
+    def __reduce__(self):
+        return (getattr, (self.archive, 'query_tags'))
     
     def esc_string(self, string):
         return ast.literal_eval(string)
     
     def standalone_tag(self, tag):
-        result = set()
         pattern = tag.lower()
+        result = set(self.archive.tag_name_index.search(pattern))
 
-        found_match = False
-        for tag_name, tag_ids in self.archive.tags_by_name.items():
-            if pattern in tag_name:
-                found_match = True
-                for id in tag_ids:
-                    result.add(id)
-
-        if not found_match:
-            print(f'warning: no match for tag pattern {pattern}')
+        if not result:
+            metrics.warn('unmatched_tag', f'warning: no match for tag pattern {pattern}')
         
         return result
     
     def categorized_tag(self, category, tag):
-        result = set()
         if category not in self.archive.tags_by_type:
-            print(f'warning: {category} is not a valid tag type... use one of {self.archive.tags_by_type.keys()}')
-            return result
+            metrics.warn('tag_type', f'warning: {category} is not a valid tag type... use one of {self.archive.tags_by_type.keys()}')
+            return set()
 
-        relevant_tags = self.archive.tags_by_type[category]
         pattern = tag.lower()
-
-        found_match = False
-        for tag_id, tag_name in self.archive.tags_by_type[category].items():
-            if pattern in tag_name:
-                found_match = True
-                result.add(tag_id)
+        result = set(self.archive.tag_name_index.search(pattern, category))
     
-        if not found_match:
-            print(f'warning: no match for tag pattern {category}:{pattern}')
+        if not result:
+            metrics.warn('unmatched_tag', f'warning: no match for tag pattern {category}:{pattern}')
         
         return result
 
@@ -419,6 +618,9 @@ TEMPLATED_STRING_CUSTOMIZATIONS = r'''
 custom_field : "chapter_text" -> chapter_text
 '''
 
+# load the template parse table at import so template objects are cheap to construct
+create_embed_parser(TEMPLATED_STRING_CUSTOMIZATIONS, require_custom_fn=False)
+
 @v_args(inline=True)
 class TemplatedStoryString(TemplatedString):
     def __init__(self, fimfarchive, consistent_quotes=False):
@@ -427,21 +629,21 @@ class TemplatedStoryString(TemplatedString):
         self.chapter_texts = fimfarchive.chapter_texts
         self.stories = fimfarchive.stories_by_id
 
-    def parse(self, template, story_id):
-        result = super().parse(template, self.stories[str(story_id)])
+    def lookup(self, story_id):
+        return self.stories[str(story_id)]
+
+    def finish(self, text):
         if self.consistent_quotes:
-            result = re.sub(u'[“”„]', '"', result)
-            result = re.sub(u'[‘’]', "'", result)
-        return result
+            text = re.sub(u'[“”„]', '"', text)
+            text = re.sub(u'[‘’]', "'", text)
+        return text
     
     def chapter_text(self):
-        story_id = self.data['id']
-        gen = lambda indexes: read_chapter(self.chapter_texts, story_id, indexes['.chapters'])
+        gen = lambda data, indexes: read_chapter(self.chapter_texts, data['id'], indexes['.chapters'])
         requirements = {'.chapters.text'}
         return gen, requirements
 
 def read_chapter(chapter_texts, story_id, chapter):
     story_id = str(story_id)
     chapter_path = os.path.join('txt', story_id, f'{chapter}.txt')
-    with chapter_texts.openfile(chapter_path) as inp:
-        return inp.read().decode('utf-8')
+    return chapter_texts.read_text(chapter_path)
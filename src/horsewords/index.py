@@ -0,0 +1,552 @@
+from collections import OrderedDict
+from collections.abc import ItemsView, Mapping, ValuesView
+import atexit
+import hashlib
+import io
+import json
+import mmap
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .columns import ColumnBuilder, StoryColumns
+
+SNAPSHOT_VERSION = 5
+SNAPSHOT_DIRNAME = 'index-snapshot'
+STREAM_CHUNK_SIZE = 1 << 20
+STORY_CACHE_SIZE = 256
+TAG_GRAM_SIZE = 3
+TAG_SEARCH_CACHE_SIZE = 4096
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def chapters_hash(story_data):
+    # changes whenever a chapter is added, removed, moved or modified
+    chapters = [[x.get('id'), x.get('date_modified')] for x in story_data.get('chapters', [])]
+    encoded = json.dumps(chapters, separators=(',', ':')).encode('utf8')
+    return int.from_bytes(hashlib.blake2b(encoded, digest_size=8).digest(), 'little')
+
+
+WHITESPACE = ' \t\n\r'
+DECODER = json.JSONDecoder()
+
+
+def iter_stories(index_path, fields=None, chunk_size=STREAM_CHUNK_SIZE):
+    # Yields (story_id, story_data) from index.json one story at a time, keeping only the
+    # top-level fields in `fields` if it's given. Only the current chunk of the file is in
+    # memory, so a pass over every story runs in constant memory.
+    with open(index_path, encoding='utf8') as f:
+        buffer = ''
+        position = 0
+        eof = False
+
+        def skip_whitespace():
+            nonlocal buffer, position, eof
+            while True:
+                while position < len(buffer) and buffer[position] in WHITESPACE:
+                    position += 1
+                if position < len(buffer) or eof:
+                    return
+                buffer, position = f.read(chunk_size), 0
+                eof = not buffer
+
+        def decode_value(delimiters):
+            # decodes the value at position; it only counts once the delimiter after it
+            # has been read too, since a number or a literal could continue past the
+            # end of the buffer
+            nonlocal buffer, position, eof
+            size = chunk_size
+            while True:
+                try:
+                    value, end = DECODER.raw_decode(buffer, position)
+                    while end < len(buffer) and buffer[end] in WHITESPACE:
+                        end += 1
+                    if end < len(buffer) and buffer[end] in delimiters:
+                        position = end
+                        return value
+                    if eof:
+                        raise json.JSONDecodeError('expected one of ' + delimiters, buffer, end)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                more = f.read(size)
+                eof = not more
+                # drop what's been consumed before growing the buffer
+                buffer = buffer[position:] + more
+                position = 0
+                size *= 2
+
+        skip_whitespace()
+        if buffer[position:position + 1] != '{':
+            raise json.JSONDecodeError('expected an object', buffer, position)
+        position += 1
+        skip_whitespace()
+        if buffer[position:position + 1] == '}':
+            return
+
+        while True:
+            story_id = decode_value(':')
+            position += 1
+            skip_whitespace()
+            story_data = decode_value(',}')
+            if fields is not None:
+                story_data = dict((x, story_data[x]) for x in fields if x in story_data)
+            yield story_id, story_data
+
+            delimiter = buffer[position]
+            position += 1
+            if delimiter == '}':
+                return
+            skip_whitespace()
+
+
+class IndexBuilder:
+    def __init__(self, blob=None, fields=None, tags=True):
+        # story records are written to the blob as they arrive so the builder never
+        # holds more than one decoded story at a time. fields limits which top-level
+        # fields the records keep, and tags=False skips the tag tables entirely.
+        self.blob = blob if blob is not None else io.BytesIO()
+        self.fields = fields
+        self.include_tags = tags
+        self.story_ids = []
+        self.story_offsets = [0]
+        self.chapter_hashes = []
+        self.chapter_counts = []
+        self.tags = []
+        self.tag_ordinals = {}
+        self.postings = []
+        self.columns = ColumnBuilder()
+
+    def add(self, story_id, story_data):
+        ordinal = len(self.story_ids)
+        self.story_ids.append(int(story_id))
+        self.chapter_hashes.append(chapters_hash(story_data))
+        self.chapter_counts.append(len(story_data.get('chapters', [])))
+
+        self.columns.add(story_data)
+        record = story_data
+        if self.fields is not None:
+            record = dict((x, story_data[x]) for x in self.fields if x in story_data)
+        encoded = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf8')
+        self.blob.write(encoded)
+        self.story_offsets.append(self.story_offsets[-1] + len(encoded))
+
+        if not self.include_tags:
+            return
+        for tag_data in story_data['tags']:
+            tag_id = tag_data['id']
+            tag_ordinal = self.tag_ordinals.get(tag_id)
+            if tag_ordinal is None:
+                tag_ordinal = len(self.tags)
+                self.tag_ordinals[tag_id] = tag_ordinal
+                self.tags.append(tag_data)
+                self.postings.append([])
+            else:
+                self.tags[tag_ordinal] = tag_data
+
+            posting = self.postings[tag_ordinal]
+            if not posting or posting[-1] != ordinal:
+                posting.append(ordinal)
+
+    def arrays(self):
+        story_ids = np.array(self.story_ids, dtype=np.int64)
+        story_id_order = np.argsort(story_ids, kind='stable')
+        tag_offsets = np.zeros(len(self.postings) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in self.postings], out=tag_offsets[1:])
+
+        tag_postings = np.zeros(tag_offsets[-1], dtype=np.uint32)
+        for tag_ordinal, posting in enumerate(self.postings):
+            tag_postings[tag_offsets[tag_ordinal]:tag_offsets[tag_ordinal + 1]] = posting
+
+        return {
+            'story_ids': story_ids,
+            'story_ids_sorted': story_ids[story_id_order],
+            'story_id_order': story_id_order,
+            'story_offsets': np.array(self.story_offsets, dtype=np.int64),
+            'chapter_hashes': np.array(self.chapter_hashes, dtype=np.uint64),
+            'chapter_counts': np.array(self.chapter_counts, dtype=np.uint32),
+            'tag_offsets': tag_offsets,
+            'tag_postings': tag_postings,
+        }
+
+    def finish(self):
+        return ArchiveIndex(self.arrays(), self.blob.getvalue(), self.tags, self.columns.finish())
+
+    def save(self, path, source=None):
+        # the story records were already written to path/stories.bin through the blob
+        write_index(path, self.arrays(), self.tags, self.columns, source)
+
+
+class ArchiveIndex:
+    ARRAYS = ['story_ids', 'story_ids_sorted', 'story_id_order', 'story_offsets', 'chapter_hashes',
+              'chapter_counts', 'tag_offsets', 'tag_postings']
+
+    def __init__(self, arrays, story_blob, tags, columns, path=None):
+        self.path = path
+        self.story_blob = story_blob
+        self.columns = columns
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+        self.tags = tags
+        self.tags_by_id = {}
+        self.tags_by_type = {}
+        self.tags_by_name = {}
+        self.tag_ordinals = {}
+        for tag_ordinal, tag_data in enumerate(tags):
+            tag_id = tag_data['id']
+            tag_name = tag_data['name'].lower()
+            tag_type = tag_data['type'].lower()
+
+            self.tags_by_type.setdefault(tag_type, {})[tag_id] = tag_name
+            self.tags_by_name.setdefault(tag_name, set()).add(tag_id)
+            self.tags_by_id[tag_id] = tag_data
+            self.tag_ordinals[tag_id] = tag_ordinal
+
+        self.tag_names = TagNameIndex(self.tags_by_type)
+        self.stories = StoryMapping(self)
+        self.stories_by_tag = StoriesByTag(self)
+        self._story_cache = OrderedDict()
+
+    @classmethod
+    def load(cls, path):
+        arrays = {}
+        for name in cls.ARRAYS:
+            arrays[name] = np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+
+        with open(os.path.join(path, 'tags.json'), encoding='utf8') as f:
+            tags = json.load(f)
+
+        story_blob = map_file(os.path.join(path, 'stories.bin'))
+        return cls(arrays, story_blob, tags, StoryColumns.load(path), path)
+
+    @classmethod
+    def from_json(cls, index_path, fields=None, tags=True):
+        # streams index.json, so the whole file is never decoded at once. With fields
+        # and tags=False, only part of each story is kept.
+        builder = IndexBuilder(fields=fields, tags=tags)
+        for story_id, story_data in iter_stories(index_path):
+            builder.add(story_id, story_data)
+        return builder.finish()
+
+    def __reduce__(self):
+        # memory maps can't be pickled, so snapshot-backed indexes are reopened by path
+        if self.path is not None:
+            return (ArchiveIndex.load, (self.path,))
+        return (ArchiveIndex, (self.arrays(), self.story_blob, self.tags, self.columns))
+
+    def arrays(self):
+        return dict((name, getattr(self, name)) for name in self.ARRAYS)
+
+    def save(self, path):
+        # writes the index in the snapshot layout, which load() maps back in. The
+        # result has no source, so it's never mistaken for a current snapshot.
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'stories.bin'), 'wb') as f:
+            f.write(self.story_blob)
+        write_index(path, self.arrays(), self.tags, self.columns)
+
+    def __len__(self):
+        return len(self.story_ids)
+
+    def story_ordinal(self, story_id):
+        try:
+            value = int(story_id)
+        except (TypeError, ValueError):
+            raise KeyError(story_id)
+
+        position = int(np.searchsorted(self.story_ids_sorted, value))
+        if position >= len(self.story_ids_sorted) or self.story_ids_sorted[position] != value:
+            raise KeyError(story_id)
+        return int(self.story_id_order[position])
+
+    def story_key(self, ordinal):
+        return str(int(self.story_ids[ordinal]))
+
+    def story_keys(self, chunk_size=65536):
+        for start in range(0, len(self.story_ids), chunk_size):
+            for story_id in self.story_ids[start:start + chunk_size].tolist():
+                yield str(story_id)
+
+    def story(self, ordinal):
+        cached = self._story_cache.get(ordinal)
+        if cached is not None:
+            self._story_cache.move_to_end(ordinal)
+            return cached
+
+        start = int(self.story_offsets[ordinal])
+        end = int(self.story_offsets[ordinal + 1])
+        result = json.loads(bytes(self.story_blob[start:end]).decode('utf8'))
+
+        self._story_cache[ordinal] = result
+        if len(self._story_cache) > STORY_CACHE_SIZE:
+            self._story_cache.popitem(last=False)
+        return result
+
+    def tag_story_ordinals(self, tag_id):
+        tag_ordinal = self.tag_ordinals[tag_id]
+        return self.tag_postings[self.tag_offsets[tag_ordinal]:self.tag_offsets[tag_ordinal + 1]]
+
+    def stories_for_tags(self, tag_ids):
+        postings = [self.tag_story_ordinals(x) for x in tag_ids]
+        if not postings:
+            return np.zeros(0, dtype=np.uint32)
+        return np.concatenate(postings)
+
+
+def tag_grams(name):
+    return set(name[i:i + TAG_GRAM_SIZE] for i in range(len(name) - TAG_GRAM_SIZE + 1))
+
+
+class TagNameIndex:
+    # Trigram index over lowercased tag names, partitioned by tag type. Substring
+    # lookups intersect the postings for the pattern's trigrams and only check the
+    # surviving candidates with `in`.
+    def __init__(self, tags_by_type):
+        self.entries = []
+        self.entries_by_type = {}
+        self.grams = {}
+        self.cache = {}
+
+        for tag_type, bucket in tags_by_type.items():
+            type_entries = self.entries_by_type.setdefault(tag_type, set())
+            for tag_id, tag_name in bucket.items():
+                entry = len(self.entries)
+                self.entries.append((tag_id, tag_name))
+                type_entries.add(entry)
+                for gram in tag_grams(tag_name):
+                    self.grams.setdefault(gram, set()).add(entry)
+
+    def candidates(self, pattern, category):
+        if len(pattern) < TAG_GRAM_SIZE:
+            if category is None:
+                return range(len(self.entries))
+            return self.entries_by_type.get(category, set())
+
+        postings = sorted((self.grams.get(x, set()) for x in tag_grams(pattern)), key=len)
+        if category is not None:
+            postings.insert(0, self.entries_by_type.get(category, set()))
+        return set.intersection(*postings)
+
+    def search(self, pattern, category=None):
+        key = (pattern, category)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        entries = self.entries
+        result = [entries[x][0] for x in sorted(self.candidates(pattern, category)) if pattern in entries[x][1]]
+        if len(self.cache) >= TAG_SEARCH_CACHE_SIZE:
+            self.cache.clear()
+        self.cache[key] = result
+        return result
+
+
+class StoryMapping(Mapping):
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, story_id):
+        return self.index.story(self.index.story_ordinal(story_id))
+
+    def __contains__(self, story_id):
+        try:
+            self.index.story_ordinal(story_id)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return self.index.story_keys()
+
+    def __len__(self):
+        return len(self.index)
+
+    def ordinal(self, story_id):
+        return self.index.story_ordinal(story_id)
+
+    def key(self, ordinal):
+        return self.index.story_key(ordinal)
+
+    def keys_for(self, ordinals):
+        return [str(x) for x in self.index.story_ids[ordinals].tolist()]
+
+    def values_for(self, ordinals):
+        return (self.index.story(x) for x in ordinals.tolist())
+
+    def items(self):
+        return StoryItems(self)
+
+    def values(self):
+        return StoryValues(self)
+
+
+class StoryItems(ItemsView):
+    def __iter__(self):
+        index = self._mapping.index
+        for ordinal, story_id in enumerate(index.story_keys()):
+            yield story_id, index.story(ordinal)
+
+
+class StoryValues(ValuesView):
+    def __iter__(self):
+        index = self._mapping.index
+        for ordinal in range(len(index)):
+            yield index.story(ordinal)
+
+
+class StoriesByTag(Mapping):
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, tag_id):
+        ordinals = self.index.tag_story_ordinals(tag_id)
+        return set(str(x) for x in self.index.story_ids[ordinals].tolist())
+
+    def __iter__(self):
+        return iter(self.index.tag_ordinals)
+
+    def __len__(self):
+        return len(self.index.tag_ordinals)
+
+
+def map_file(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_meta(path):
+    try:
+        with open(os.path.join(path, 'meta.json'), encoding='utf8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_meta(path, meta):
+    tmp_path = os.path.join(path, f'meta.json.{os.getpid()}')
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(path, 'meta.json'))
+
+
+def write_index(path, arrays, tags, columns, source=None):
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f'{name}.npy'), array)
+
+    with open(os.path.join(path, 'tags.json'), 'w', encoding='utf8') as f:
+        json.dump(tags, f, ensure_ascii=False)
+    columns.save(path)
+
+    # meta.json goes last: a directory without it is incomplete
+    meta = {'version': SNAPSHOT_VERSION, 'source': source, 'num_stories': len(arrays['story_ids'])}
+    write_meta(path, meta)
+
+
+def build_snapshot(index_path, snapshot_path, digest=None):
+    if digest is None:
+        digest = hash_file(index_path)
+    source = dict(file_signature(index_path), sha256=digest)
+
+    # build next to the final location and swap it in so readers never see a partial snapshot
+    tmp_path = f'{snapshot_path}.tmp-{os.getpid()}'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    with open(os.path.join(tmp_path, 'stories.bin'), 'wb') as blob:
+        builder = IndexBuilder(blob)
+        for story_id, story_data in iter_stories(index_path):
+            builder.add(story_id, story_data)
+    builder.save(tmp_path, source)
+
+    shutil.rmtree(snapshot_path, ignore_errors=True)
+    try:
+        os.rename(tmp_path, snapshot_path)
+    except OSError:
+        # another process finished first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def snapshot_is_current(index_path, snapshot_path):
+    meta = read_meta(snapshot_path)
+    if not meta or meta.get('version') != SNAPSHOT_VERSION or not meta.get('source'):
+        return False, None
+
+    signature = file_signature(index_path)
+    source = meta['source']
+    if source['mtime_ns'] == signature['mtime_ns'] and source['size'] == signature['size']:
+        return True, source['sha256']
+
+    # the file was touched; only rebuild if the contents actually changed
+    digest = hash_file(index_path)
+    if digest != source['sha256']:
+        return False, digest
+
+    meta['source'] = dict(signature, sha256=digest)
+    write_meta(snapshot_path, meta)
+    return True, digest
+
+
+def open_snapshot(index_path, snapshot_path=None):
+    if snapshot_path is None:
+        snapshot_path = os.path.join(os.path.dirname(index_path), SNAPSHOT_DIRNAME)
+
+    current, digest = snapshot_is_current(index_path, snapshot_path)
+    if not current:
+        build_snapshot(index_path, snapshot_path, digest)
+    return ArchiveIndex.load(snapshot_path)
+
+
+# Indexes published for other processes. Every process that attaches to one maps the
+# same files read-only, so the page cache holds a single copy however many workers there
+# are, and only the small tag tables are rebuilt per process.
+SHARED_INDEX_ROOT = '/dev/shm' if os.path.isdir('/dev/shm') else None
+ATTACHED_INDEXES = {}
+
+
+def publish_index(index, path=None):
+    # Returns index itself if it's already backed by files, or a copy written to path (by
+    # default a new directory in /dev/shm, removed when this process exits).
+    if index.path is not None:
+        return index
+    if path is None:
+        path = tempfile.mkdtemp(prefix='horsewords-index-', dir=SHARED_INDEX_ROOT)
+        atexit.register(remove_published, path, os.getpid())
+    index.save(path)
+    return attach_index(path)
+
+
+def remove_published(path, owner_pid):
+    # forked children inherit atexit handlers; only the publisher removes the files
+    if os.getpid() == owner_pid:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def attach_index(path):
+    # opens a published index or snapshot, reusing this process's earlier attachment as
+    # long as the files haven't been replaced since
+    signature = file_signature(os.path.join(path, 'meta.json'))
+    attached = ATTACHED_INDEXES.get(path)
+    if attached is not None and attached[0] == signature:
+        return attached[1]
+
+    index = ArchiveIndex.load(path)
+    ATTACHED_INDEXES[path] = (signature, index)
+    return index
@@ -0,0 +1,263 @@
+import cProfile
+import functools
+import glob
+import os
+import pstats
+import threading
+import time
+import zlib
+
+# Process-wide timers, counters and byte meters, keyed by stage names like 'epub.read'.
+# Nothing is recorded until enable() is called; before that every call returns right
+# away, and timer() hands back a shared no-op context manager.
+#
+# Pool workers collect() their metrics and send them back with their results, and the
+# parent merge()s them, so a snapshot covers the whole pipeline.
+
+ENABLED = False
+TIMERS = {}
+COUNTERS = {}
+BYTES = {}
+LOCK = threading.Lock()
+
+# cProfile sampling: stories whose key hashes to 0 mod PROFILE_EVERY run under the profiler
+PROFILE_EVERY = 0
+PROFILE_PATH = None
+PROFILER = None
+PROFILING = threading.local()
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *args):
+        record_time(self.name, time.perf_counter_ns() - self.start)
+        return False
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    with LOCK:
+        TIMERS.clear()
+        COUNTERS.clear()
+        BYTES.clear()
+
+
+def record_time(name, nanoseconds, calls=1):
+    with LOCK:
+        entry = TIMERS.get(name)
+        if entry is None:
+            TIMERS[name] = [calls, nanoseconds, nanoseconds]
+        else:
+            entry[0] += calls
+            entry[1] += nanoseconds
+            entry[2] = max(entry[2], nanoseconds)
+
+
+def timer(name):
+    if not ENABLED:
+        return NULL_TIMER
+    return Timer(name)
+
+
+def timed(name):
+    # decorator version of timer()
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            with Timer(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    if not ENABLED:
+        return
+    with LOCK:
+        COUNTERS[name] = COUNTERS.get(name, 0) + value
+
+
+def add_bytes(name, value):
+    if not ENABLED:
+        return
+    with LOCK:
+        BYTES[name] = BYTES.get(name, 0) + value
+
+
+def warn(name, *message):
+    # prints a diagnostic and counts it under warnings.<name>
+    count(f'warnings.{name}')
+    print(*message)
+
+
+def snapshot():
+    with LOCK:
+        return {
+            'timers': dict((name, {'calls': calls, 'seconds': total / 1e9, 'max_seconds': longest / 1e9})
+                           for name, (calls, total, longest) in TIMERS.items()),
+            'counters': dict(COUNTERS),
+            'bytes': dict(BYTES),
+        }
+
+
+def merge(other):
+    # adds a snapshot (usually from a pool worker) into this process's metrics
+    if not other:
+        return
+    with LOCK:
+        for name, stats in other['timers'].items():
+            nanoseconds = int(stats['seconds'] * 1e9)
+            entry = TIMERS.get(name)
+            if entry is None:
+                TIMERS[name] = [stats['calls'], nanoseconds, int(stats['max_seconds'] * 1e9)]
+            else:
+                entry[0] += stats['calls']
+                entry[1] += nanoseconds
+                entry[2] = max(entry[2], int(stats['max_seconds'] * 1e9))
+        for name, value in other['counters'].items():
+            COUNTERS[name] = COUNTERS.get(name, 0) + value
+        for name, value in other['bytes'].items():
+            BYTES[name] = BYTES.get(name, 0) + value
+
+
+def collect():
+    # snapshot() and reset(), for workers handing their metrics to the parent. Returns
+    # None when metrics are off.
+    if not ENABLED:
+        return None
+    result = snapshot()
+    reset()
+    if PROFILER is not None and PROFILE_PATH is not None:
+        PROFILER.dump_stats(f'{PROFILE_PATH}.worker-{os.getpid()}')
+    return result
+
+
+def prometheus_name(name):
+    return ''.join(x if x.isalnum() else '_' for x in name)
+
+
+def prometheus(prefix='horsewords'):
+    # the current metrics in Prometheus' text exposition format
+    metrics = snapshot()
+    lines = [
+        f'# HELP {prefix}_stage_seconds_total Time spent in each stage.',
+        f'# TYPE {prefix}_stage_seconds_total counter',
+    ]
+    for name, stats in sorted(metrics['timers'].items()):
+        lines.append(f'{prefix}_stage_seconds_total{{stage="{name}"}} {stats["seconds"]:.9f}')
+    lines.append(f'# HELP {prefix}_stage_calls_total Number of times each stage ran.')
+    lines.append(f'# TYPE {prefix}_stage_calls_total counter')
+    for name, stats in sorted(metrics['timers'].items()):
+        lines.append(f'{prefix}_stage_calls_total{{stage="{name}"}} {stats["calls"]}')
+    lines.append(f'# HELP {prefix}_stage_max_seconds Longest single run of each stage.')
+    lines.append(f'# TYPE {prefix}_stage_max_seconds gauge')
+    for name, stats in sorted(metrics['timers'].items()):
+        lines.append(f'{prefix}_stage_max_seconds{{stage="{name}"}} {stats["max_seconds"]:.9f}')
+    for name, value in sorted(metrics['counters'].items()):
+        metric = f'{prefix}_{prometheus_name(name)}_total'
+        lines.append(f'# TYPE {metric} counter')
+        lines.append(f'{metric} {value}')
+    for name, value in sorted(metrics['bytes'].items()):
+        metric = f'{prefix}_{prometheus_name(name)}_bytes_total'
+        lines.append(f'# TYPE {metric} counter')
+        lines.append(f'{metric} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def config():
+    # what pool workers need to collect the same metrics as the parent
+    return ENABLED, PROFILE_EVERY, PROFILE_PATH
+
+
+def configure(enabled, profile_every=0, profile_path=None):
+    # for pool workers; the parent has already removed old worker profiles
+    global ENABLED
+    ENABLED = enabled
+    set_profiling(profile_every, profile_path)
+
+
+def enable_profiling(every=100, path=None):
+    # profiles roughly one in `every` stories (the same ones every run). Workers write
+    # their profiles to path.worker-<pid>, which profile_stats() picks up; ones left over
+    # from earlier runs are removed first.
+    if path is not None:
+        for stale in glob.glob(f'{path}.worker-*'):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+    set_profiling(every, path)
+
+
+def set_profiling(every, path):
+    global PROFILE_EVERY, PROFILE_PATH, PROFILER
+    PROFILE_EVERY = every
+    PROFILE_PATH = path
+    PROFILER = cProfile.Profile() if every else None
+
+
+def sampled(key):
+    return PROFILE_EVERY and zlib.crc32(str(key).encode('utf-8')) % PROFILE_EVERY == 0
+
+
+class Profiled:
+    def __enter__(self):
+        PROFILING.active = True
+        PROFILER.enable()
+        return self
+
+    def __exit__(self, *args):
+        PROFILER.disable()
+        PROFILING.active = False
+        return False
+
+
+def profile(key):
+    # runs the block under cProfile if key is in the sample
+    if not PROFILE_EVERY or getattr(PROFILING, 'active', False) or not sampled(key):
+        return NULL_TIMER
+    return Profiled()
+
+
+def profile_stats():
+    # pstats.Stats for everything profiled so far, including worker profiles, or None
+    stats = None
+    if PROFILER is not None and PROFILER.getstats():
+        stats = pstats.Stats(PROFILER)
+    if PROFILE_PATH is not None:
+        for path in sorted(glob.glob(f'{PROFILE_PATH}.worker-*')):
+            if stats is None:
+                stats = pstats.Stats(path)
+            else:
+                stats.add(path)
+    return stats
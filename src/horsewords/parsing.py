@@ -0,0 +1,17 @@
+import lark
+
+PARSERS = {}
+
+
+def get_parser(grammar, **options):
+    # Lark parsers are stateless between parse calls, so every filter and template built
+    # from the same grammar shares one instance. LALR parse tables are also serialized
+    # to lark's on-disk cache so new processes load them instead of rebuilding them.
+    key = (grammar, tuple(sorted(options.items())))
+    parser = PARSERS.get(key)
+    if parser is None:
+        if options.get('parser') == 'lalr':
+            options.setdefault('cache', True)
+        parser = lark.Lark(grammar, **options)
+        PARSERS[key] = parser
+    return parser
@@ -0,0 +1,166 @@
+import multiprocessing
+import os
+import time
+import warnings
+
+from tqdm import tqdm
+
+from . import metrics
+
+JOURNAL_FILENAME = 'cache-journal.txt'
+
+# each pool worker loads the archive once in init_worker instead of receiving it with
+# every task
+WORKER_ARCHIVE = None
+
+
+def init_worker(unpacked_path, use_snapshot, fast_text, downloader, metrics_config=(False,), index_fields=None,
+                index_tags=True, shared_index=None):
+    global WORKER_ARCHIVE
+    from .fimfarchive import Fimfarchive
+
+    metrics.configure(*metrics_config)
+    # forked workers start with a copy of the parent's metrics, which it already has
+    metrics.reset()
+
+    # EbookLib is very noisy with this warning caused by library-internal issues
+    warnings.filterwarnings(
+        "ignore",
+        category=FutureWarning,
+        module="ebooklib.epub",
+        message='This search incorrectly ignores the root element'
+    )
+    WORKER_ARCHIVE = Fimfarchive(unpacked_path, use_snapshot, fast_text=fast_text, downloader=downloader,
+                                 index_fields=index_fields, index_tags=index_tags, shared_index=shared_index)
+
+
+def worker_initargs(archive, workers):
+    # workers split the download limits so the pool as a whole stays within them, and
+    # attach to the parent's index instead of loading their own
+    return (archive.unpacked_path, archive.use_snapshot, archive.fast_text, archive.downloader.split(workers),
+            metrics.config(), archive.index_fields, archive.index_tags, archive.share_index())
+
+
+def merged_results(results):
+    # worker tasks return (result, metrics.collect()); this merges the metrics into the
+    # parent's and yields the results
+    for result, collected in results:
+        metrics.merge(collected)
+        yield result
+
+
+class Journal:
+    # append-only list of finished story ids, so an interrupted build can resume
+    def __init__(self, path):
+        self.path = path
+
+    def completed(self):
+        try:
+            with open(self.path, encoding='utf8') as f:
+                return set(line.strip() for line in f if line.strip())
+        except FileNotFoundError:
+            return set()
+
+    def record(self, story_ids):
+        if not story_ids:
+            return
+        with open(self.path, 'a', encoding='utf8') as f:
+            f.write(''.join(f'{x}\n' for x in story_ids))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def cached_story_bytes(archive, story_id):
+    # returns None if any chapter is missing from the txt cache
+    total = 0
+    for chapter_index in range(len(archive.stories_by_id[story_id]['chapters'])):
+        path = os.path.join(archive.unpacked_path, 'txt', story_id, f'{chapter_index}.txt')
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            return None
+    return total
+
+
+def cache_story(archive, story_id):
+    try:
+        archive.cache_chapters(story_id)
+    except Exception as e:
+        return story_id, False, 0, repr(e)
+
+    size = cached_story_bytes(archive, story_id)
+    if size is None:
+        return story_id, False, 0, 'missing chapters after caching'
+    return story_id, True, size, None
+
+
+def cache_story_chunk(story_ids):
+    return [cache_story(WORKER_ARCHIVE, x) for x in story_ids], metrics.collect()
+
+
+def chunked(items, chunk_size):
+    for start in range(0, len(items), chunk_size):
+        yield items[start:start + chunk_size]
+
+
+def build_cache(archive, workers=None, chunk_size=64, story_ids=None, journal_path=None):
+    if story_ids is None:
+        story_ids = list(archive.stories_by_id)
+    if journal_path is None:
+        journal_path = os.path.join(archive.unpacked_path, JOURNAL_FILENAME)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    journal = Journal(journal_path)
+    completed = journal.completed()
+    remaining = [str(x) for x in story_ids if str(x) not in completed]
+
+    failures = {}
+    num_cached = 0
+    num_bytes = 0
+    start_time = time.monotonic()
+
+    pool = None
+    if workers == 1 or not remaining:
+        results = ([cache_story(archive, x) for x in chunk] for chunk in chunked(remaining, chunk_size))
+    else:
+        pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=worker_initargs(archive, workers))
+        results = merged_results(pool.imap_unordered(cache_story_chunk, chunked(remaining, chunk_size)))
+
+    try:
+        with tqdm(total=len(remaining), unit='story') as progress:
+            for chunk_results in results:
+                finished = []
+                for story_id, ok, size, error in chunk_results:
+                    if ok:
+                        finished.append(story_id)
+                        num_cached += 1
+                        num_bytes += size
+                    else:
+                        failures[story_id] = error
+                journal.record(finished)
+                progress.update(len(chunk_results))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = time.monotonic() - start_time
+    summary = {
+        'skipped': len(story_ids) - len(remaining),
+        'cached': num_cached,
+        'failed': failures,
+        'bytes': num_bytes,
+        'seconds': elapsed,
+        'stories_per_second': num_cached / elapsed if elapsed else 0.0,
+        'mb_per_second': num_bytes / elapsed / 1e6 if elapsed else 0.0,
+    }
+
+    print(f"cached {num_cached} stories ({summary['skipped']} already done) in {elapsed:.1f}s: "
+          f"{summary['stories_per_second']:.1f} stories/s, {summary['mb_per_second']:.2f} MB/s")
+    if failures:
+        print(f'{len(failures)} stories failed:')
+        for story_id, error in failures.items():
+            print(f' -- {story_id}: {error}')
+
+    return summary
@@ -1,6 +1,19 @@
-from lark import Lark, Transformer, v_args
+from lark import Transformer, Tree, v_args
+from lark.exceptions import VisitError
 import ast
+from collections.abc import Set
+import heapq
 import json
+import multiprocessing
+import os
+import re
+
+import numpy as np
+
+from . import metrics, pipeline
+from .cache import LRUCache
+from .columns import SORTED_COLUMNS, missing_values, parse_date
+from .parsing import get_parser
 
 query = r'''
 %import common.WS
@@ -9,26 +22,43 @@ query = r'''
 %import common.ESCAPED_STRING
 %import common.CNAME
 
-?query : negation
+// "|" binds tighter than ",", and both group to the left
+?query : alternatives
        | intersection
-       | union
-       | grouped
-       {include_flags}
-       {include_features}
-       | comparison
+intersection : query "," alternatives
 
-negation : "-" grouped
-         {flag_negation}
+?alternatives : term
+              | union
+union : alternatives "|" term
+
+?term : negation
+      | grouped
+      {include_flags}
+      {include_features}
 
-intersection : query "," query
-union :  query "|" query
+negation : _NEGATE grouped
+         {flag_negation}
 
 ?grouped : "(" query ")"
+
+?request : query
+         | query limit -> ordered_query
+         {include_order}
+
+limit : "limit" INT
+
+// a "-" is a negation unless it's the sign of a number that something is compared to
+_NEGATE.3 : /-(?!\s*(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?[\s)]*[-+*\/^<>=])/
+
+%import common.INT
 '''
 
 feature_addons = r'''
 comparison : feature_shift comparator feature_shift
 
+order : "order" "by" feature_shift ORDER_DIRECTION?
+ORDER_DIRECTION : "asc" | "desc"
+
 ?feature_list : feature_shift
               | feature_shift "," feature_list
 
@@ -73,69 +103,654 @@ OPERATORS = {
     '==': lambda x,y: x == y
 }
 
+# ordinals per partition when per-item comparisons are split across a worker pool
+PARTITION_SIZE = 16384
+
+OPERATOR_NAMES = dict((fn, name) for name, fn in OPERATORS.items())
+RANGE_COMPARATORS = {'>': '<', '>=': '<=', '<': '>', '<=': '>=', '=': '=', '==': '='}
+
+QUERY_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*"|\s+|[^"\s]+|"')
+# Whitespace after these can't belong to a tag pattern, and neither can whitespace around
+# a comparator. Whitespace before other operators can (in "comedy | x" the pattern is
+# "comedy "), so it is kept.
+SPACE_BEFORE_TOKEN = ',|(:'
+COMPARATOR_CHARS = '<>='
+
+
+def normalize_query(query_string):
+    # the plan cache key: the query with the whitespace that can't change its parse removed
+    parts = QUERY_TOKENS.findall(query_string)
+    normalized = []
+    for i, part in enumerate(parts):
+        if part.isspace():
+            last = normalized[-1][-1] if normalized else ''
+            following = parts[i + 1][0] if i + 1 < len(parts) else ' '
+            if (not last or last in SPACE_BEFORE_TOKEN or
+                    # without joining "> =" into ">="
+                    (last in COMPARATOR_CHARS) != (following in COMPARATOR_CHARS) or
+                    (last in ')"' and not following.isalnum() and following != '_')):
+                continue
+        normalized.append(part)
+    return ''.join(normalized)
+
+
+# Column expressions stop at anything that would raise for a single item (x / 0,
+# overflow), so the per-item path runs instead and raises the same error.
+ARRAY_ERRORS = {'divide': 'raise', 'over': 'raise', 'invalid': 'raise', 'under': 'ignore'}
+ARRAY_FALLBACK_ERRORS = (TypeError, ValueError, FloatingPointError)
+
+
 def get_field(key, data):
     for field in key.split('.')[1:]:
         data = data[field]
     return data
 
 
+class Feature:
+    # A compiled feature expression. It can be called on a single item like the plain
+    # lambdas it replaces, and if every leaf maps to a column, vector_fn evaluates the
+    # whole expression over the columns at once.
+    def __init__(self, fn, vector_fn=None, column=None):
+        self.fn = fn
+        self.vector_fn = vector_fn
+        # set when the feature is just a column, so comparisons can use its sorted index
+        self.column = column
+
+    def __call__(self, element):
+        return self.fn(element)
+
+    @property
+    def vectorized(self):
+        return self.vector_fn is not None
+
+
+class Constant(Feature):
+    def __init__(self, value):
+        super().__init__(lambda x: value, lambda columns: value)
+        self.value = value
+
+
+def as_feature(fn):
+    if isinstance(fn, Feature):
+        return fn
+    return Feature(fn)
+
+
+def combine_features(item_fn, vector_fn, *features):
+    features = [as_feature(f) for f in features]
+    item = lambda x: item_fn(*[f(x) for f in features])
+    if not all(f.vectorized for f in features):
+        return Feature(item)
+    vector = lambda columns: vector_fn(*[f.vector_fn(columns) for f in features])
+    return Feature(item, vector)
+
+
+def column_feature(name):
+    return Feature(lambda x: x[name], lambda columns: columns.values(name), name)
+
+
+def coerce_dates(value, other):
+    # date columns hold datetime64 values, so string constants compared against them
+    # need to be converted first
+    if not isinstance(value, str) or not isinstance(other, np.ndarray):
+        return value
+    if not np.issubdtype(other.dtype, np.datetime64):
+        return value
+
+    seconds = parse_date(value)
+    if seconds is None:
+        return np.datetime64(value, 's')
+    return np.datetime64(seconds, 's')
+
+
+class KeyIndex:
+    # Dense ordinals for the keys of a plain dict dataset. Datasets that already know
+    # their ordinals (like the archive's StoryMapping) provide the same methods.
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.positions = dict((key, ordinal) for ordinal, key in enumerate(self.keys))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def ordinal(self, key):
+        return self.positions[key]
+
+    def key(self, ordinal):
+        return self.keys[ordinal]
+
+    def keys_for(self, ordinals):
+        keys = self.keys
+        return [keys[i] for i in ordinals]
+
+
+class QueryResult(Set):
+    # A query result stored as a boolean mask over dataset ordinals. Set operations
+    # between results from the same dataset stay as mask operations; keys are only
+    # produced when the result is iterated.
+    def __init__(self, mask, keyspace):
+        self.mask = mask
+        self.keyspace = keyspace
+
+    @classmethod
+    def from_ordinals(cls, ordinals, keyspace):
+        mask = np.zeros(len(keyspace), dtype=bool)
+        mask[ordinals] = True
+        return cls(mask, keyspace)
+
+    @classmethod
+    def from_keys(cls, keys, keyspace):
+        ordinals = []
+        for key in keys:
+            try:
+                ordinals.append(keyspace.ordinal(key))
+            except KeyError:
+                continue
+        return cls.from_ordinals(np.array(ordinals, dtype=np.int64), keyspace)
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def ordinals(self):
+        return np.flatnonzero(self.mask)
+
+    def __contains__(self, key):
+        try:
+            return bool(self.mask[self.keyspace.ordinal(key)])
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        ordinals = self.ordinals()
+        for start in range(0, len(ordinals), 65536):
+            yield from self.keyspace.keys_for(ordinals[start:start + 65536])
+
+    def __len__(self):
+        return int(np.count_nonzero(self.mask))
+
+    def __repr__(self):
+        return f'QueryResult({len(self)} of {len(self.mask)})'
+
+    def compatible(self, other):
+        return isinstance(other, QueryResult) and other.keyspace is self.keyspace
+
+    def __and__(self, other):
+        if self.compatible(other):
+            return QueryResult(self.mask & other.mask, self.keyspace)
+        return super().__and__(other)
+
+    def __or__(self, other):
+        if self.compatible(other):
+            return QueryResult(self.mask | other.mask, self.keyspace)
+        return super().__or__(other)
+
+    def __sub__(self, other):
+        if self.compatible(other):
+            return QueryResult(self.mask & ~other.mask, self.keyspace)
+        return super().__sub__(other)
+
+    def __xor__(self, other):
+        if self.compatible(other):
+            return QueryResult(self.mask ^ other.mask, self.keyspace)
+        return super().__xor__(other)
+
+    __rand__ = __and__
+    __ror__ = __or__
+    __rxor__ = __xor__
+
+    def __invert__(self):
+        return QueryResult(~self.mask, self.keyspace)
+
+    def as_result(self, other):
+        if self.compatible(other):
+            return other
+        return QueryResult.from_keys(other, self.keyspace)
+
+    def intersection(self, *others):
+        result = self
+        for other in others:
+            result = result & self.as_result(other)
+        return result
+
+    def union(self, *others):
+        result = self
+        for other in others:
+            result = result | self.as_result(other)
+        return result
+
+    def difference(self, *others):
+        result = self
+        for other in others:
+            result = result - self.as_result(other)
+        return result
+
+
+class RankedResult(QueryResult):
+    # A query result with an order, from "order by" and "limit". It iterates in that
+    # order, and set operations on it give plain unordered results.
+    def __init__(self, ranked, keyspace):
+        self.ranked = ranked
+        mask = np.zeros(len(keyspace), dtype=bool)
+        mask[ranked] = True
+        super().__init__(mask, keyspace)
+
+    def ordinals(self):
+        return self.ranked
+
+    def __len__(self):
+        return len(self.ranked)
+
+    def __repr__(self):
+        return f'RankedResult({len(self)} of {len(self.mask)})'
+
+
+def missing_key(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def top_ordinals(values, ordinals, descending, limit):
+    # values[i] belongs to ordinals[i]; returns the ordinals by value, missing values last
+    # and ties in ordinal order. With a limit, only the values that can make the cut are
+    # sorted.
+    values = np.asarray(values)
+    missing = missing_values(values)
+    present, absent = ordinals[~missing], ordinals[missing]
+    keys = values[~missing]
+    if np.issubdtype(keys.dtype, np.datetime64):
+        keys = keys.view(np.int64)
+    if descending:
+        keys = -keys.astype(np.float64) if keys.dtype.kind in 'ub' else -keys
+
+    if limit is not None and limit < len(keys):
+        if limit == 0:
+            return present[:0]
+        cutoff = np.partition(keys, limit - 1)[limit - 1]
+        keep = keys <= cutoff
+        present, keys = present[keep], keys[keep]
+
+    ranked = np.concatenate([present[np.lexsort((present, keys))], absent])
+    return ranked[:limit]
+
+
+def top_items(items, descending, limit):
+    # the per-item version of top_ordinals for features that can't be vectorized; items
+    # are (value, ordinal) pairs
+    present = [x for x in items if not missing_key(x[0])]
+    absent = [x for x in items if missing_key(x[0])]
+    if descending:
+        key = lambda item: (item[0], -item[1])
+        if limit is None:
+            present = sorted(present, key=key, reverse=True)
+        else:
+            present = heapq.nlargest(limit, present, key=key)
+    elif limit is None:
+        present = sorted(present)
+    else:
+        present = heapq.nsmallest(limit, present)
+
+    ranked = [ordinal for _, ordinal in present + absent]
+    return np.array(ranked[:limit], dtype=np.int64)
+
+
+# each query pool worker's copy of the filter, set by init_query_worker
+WORKER_FILTER = None
+
+
+def init_query_worker(query_filter, metrics_config=(False,)):
+    global WORKER_FILTER
+    metrics.configure(*metrics_config)
+    # forked workers start with a copy of the parent's metrics, which it already has
+    metrics.reset()
+    WORKER_FILTER = query_filter
+
+
+def match_partition(task):
+    # evaluates a subtree on one partition of ordinals; returns the matching ordinals
+    tree, ordinals = task
+    scope = np.zeros(len(WORKER_FILTER.keyspace), dtype=bool)
+    scope[ordinals] = True
+    try:
+        result = WORKER_FILTER.evaluate(tree, scope)
+    except VisitError as e:
+        # VisitErrors can't be unpickled, so the parent wraps the original error again
+        raise e.orig_exc
+    return np.flatnonzero(result.mask), metrics.collect()
+
+
 @v_args(inline=True)
 class QueryFilter(Transformer):
-    def __init__(self, query_customization, dataset, require_flags=True, require_features=True):
+    def __init__(self, query_customization, dataset, require_flags=True, require_features=True, columns=None,
+                 plan_cache_size=1024, result_cache_size=64 << 20):
         if not require_flags and not require_features:
             raise Exception('cannot construct parser with neither require_flags nor require_features')
 
-        self.dataset = dataset
-        self.universe = set(dataset.keys())
+        # parse trees are the compiled plans; equal trees share a result entry even if
+        # the query strings differ
+        self.plan_cache = LRUCache(plan_cache_size)
+        self.result_cache = LRUCache(result_cache_size, size_fn=lambda result: result.mask.nbytes)
+        self.pool = None
+        self.pool_workers = None
+        self.partition_size = PARTITION_SIZE
+        self.reset(dataset, columns)
         
         include_flags = '| flag' if require_flags else ''
-        flag_negation = '| "-" flag' if require_flags else ''
+        flag_negation = '| _NEGATE flag' if require_flags else ''
         include_features = '| comparison' if require_features else ''
+        include_order = ('| query order -> ordered_query\n'
+                         '         | query order limit -> ordered_query') if require_features else ''
         addons = feature_addons if require_features else ""
 
-        template = query.format(include_flags=include_flags, include_features=include_features, flag_negation=flag_negation)
-        grammar = f'{template}\n{query_customization}\n{addons}'
+        template = query.format(include_flags=include_flags, include_features=include_features,
+                                flag_negation=flag_negation, include_order=include_order)
+        self.grammar = f'{template}\n{query_customization}\n{addons}'
+        self._query_parser = None
+
+    @property
+    def query_parser(self):
+        # built on first use and shared between filters; the LALR table is cached on disk
+        if self._query_parser is None:
+            self._query_parser = get_parser(self.grammar, parser='lalr', start='request')
+        return self._query_parser
+
+    def reset(self, dataset, columns=None):
+        self.dataset = dataset
+        self.columns = columns
+        self._keyspace = None
+        self.result_cache.clear()
+        if self.pool is not None:
+            # the workers hold a copy of the old dataset
+            self.open_pool(self.pool_workers, self.partition_size)
+
+    def open_pool(self, workers=None, partition_size=PARTITION_SIZE):
+        # From now on, comparisons that have to look at every item are split into
+        # partitions of partition_size ordinals and matched across a pool of `workers`
+        # processes, each with its own copy of this filter. Call close_pool() when done.
+        self.close_pool()
+        self.pool_workers = workers or os.cpu_count() or 1
+        self.partition_size = partition_size
+        self.pool = multiprocessing.Pool(self.pool_workers, initializer=init_query_worker,
+                                         initargs=(self, metrics.config()))
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def cache_stats(self):
+        return {'plans': self.plan_cache.stats(), 'results': self.result_cache.stats()}
+
+    @property
+    def keyspace(self):
+        if self._keyspace is None:
+            if hasattr(self.dataset, 'keys_for'):
+                self._keyspace = self.dataset
+            else:
+                self._keyspace = KeyIndex(self.dataset.keys())
+        return self._keyspace
 
-        self.query_parser = Lark(grammar, start="query")
+    @property
+    def universe(self):
+        return QueryResult(np.ones(len(self.keyspace), dtype=bool), self.keyspace)
+
+    def to_result(self, value):
+        if isinstance(value, QueryResult):
+            return value
+        return QueryResult.from_keys(value, self.keyspace)
+
+    def result_from_ordinals(self, ordinals):
+        return QueryResult.from_ordinals(ordinals, self.keyspace)
 
     def __call__(self, query_string):
-        parse_tree = self.query_parser.parse(query_string)
-        return self.transform(parse_tree)
+        metrics.count('query.calls')
+        plan_key = normalize_query(query_string)
+        parse_tree = self.plan_cache.get(plan_key)
+        if parse_tree is None:
+            with metrics.timer('query.parse'):
+                parse_tree = self.query_parser.parse(query_string)
+            self.plan_cache.put(plan_key, parse_tree)
+
+        result = self.result_cache.get(parse_tree)
+        if result is None:
+            with metrics.timer('query.evaluate'):
+                result = self.to_result(self.evaluate(parse_tree))
+            result.mask.flags.writeable = False
+            self.result_cache.put(parse_tree, result)
+        return result
+
+    def evaluate(self, tree, scope=None):
+        # Evaluates a parse tree top-down. scope is a mask of the ordinals still in
+        # question (None for all of them) and results are only computed inside it: the
+        # second side of an intersection only looks at what the first side matched and
+        # is skipped when that's nothing, and likewise for unions with what's left
+        # unmatched. The side with fewer per-item comparisons goes first. With a pool
+        # open, subtrees that need per-item comparisons go to parallel_evaluate instead.
+        rule = tree.data
+        if rule == 'ordered_query':
+            clauses = [self.transform(x) for x in tree.children[1:]]
+            child = self.evaluate(tree.children[0], scope)
+            return self.call_rule(tree, self.ordered_query, child, *clauses)
+
+        if rule == 'negation':
+            return self.scoped(~self.evaluate(tree.children[0], scope), scope)
+
+        if self.pool is not None and rule in ('intersection', 'union', 'comparison') and self.item_cost(tree):
+            ordinals = np.arange(len(self.keyspace)) if scope is None else np.flatnonzero(scope)
+            if len(ordinals) > self.partition_size:
+                return self.call_rule(tree, self.parallel_evaluate, tree, ordinals)
+
+        if rule in ('intersection', 'union'):
+            first, second = tree.children
+            if self.item_cost(second) < self.item_cost(first):
+                first, second = second, first
+            result = self.evaluate(first, scope)
+            remaining = result.mask if rule == 'intersection' else self.scoped(~result, scope).mask
+            if not remaining.any():
+                metrics.count('query.skipped_subtrees')
+                return result
+            other = self.evaluate(second, remaining)
+            return result & other if rule == 'intersection' else result | other
+
+        if rule == 'comparison':
+            return self.scoped_comparison(tree, scope)
+        return self.scoped(self.to_result(self.transform(tree)), scope)
+
+    def call_rule(self, tree, fn, *args):
+        # errors from rules evaluated outside the transformer come out wrapped the same way
+        try:
+            return fn(*args)
+        except VisitError:
+            raise
+        except Exception as e:
+            raise VisitError(tree.data, tree, e)
+
+    def scoped(self, result, scope):
+        if scope is None:
+            return result
+        return QueryResult(result.mask & scope, self.keyspace)
+
+    def item_cost(self, tree):
+        # the number of comparisons under tree that have to look at every item
+        if not isinstance(tree, Tree):
+            return 0
+        if tree.data == 'comparison':
+            left_fn, _, right_fn = self.comparison_args(tree)
+            return 0 if self.columns is not None and left_fn.vectorized and right_fn.vectorized else 1
+        if tree.data in ('negation', 'intersection', 'union'):
+            return sum(self.item_cost(x) for x in tree.children)
+        return 0
 
     def negation(self, child):
-        return self.universe - child
+        return ~self.to_result(child)
     
     def intersection(self, left, right):
-        return left.intersection(right)
+        return self.to_result(left) & self.to_result(right)
     
     def union(self, left, right):
-        return left.union(right)
+        return self.to_result(left) | self.to_result(right)
     
     def operator(self, op):
         return OPERATORS[op]
 
     def comparison(self, left_fn, operator, right_fn):
-        result = set()
-        for id, element in self.dataset.items():
-            if operator(left_fn(element), right_fn(element)):
-                result.add(id)
-        
+        left_fn = as_feature(left_fn)
+        right_fn = as_feature(right_fn)
+
+        result = self.column_comparison(left_fn, operator, right_fn)
+        if result is None:
+            # every item gets decoded, so this is the path to watch
+            metrics.count('query.item_comparisons')
+            ordinals = np.arange(len(self.keyspace))
+            result = self.result_from_ordinals(self.item_comparison(left_fn, operator, right_fn, ordinals))
         return result
+
+    def comparison_args(self, tree):
+        left_fn, operator, right_fn = [self.transform(x) for x in tree.children]
+        return as_feature(left_fn), operator, as_feature(right_fn)
+
+    def scoped_comparison(self, tree, scope):
+        left_fn, operator, right_fn = self.comparison_args(tree)
+        result = self.column_comparison(left_fn, operator, right_fn)
+        if result is not None:
+            return self.scoped(result, scope)
+
+        metrics.count('query.item_comparisons')
+        ordinals = np.arange(len(self.keyspace)) if scope is None else np.flatnonzero(scope)
+        matched = self.call_rule(tree, self.item_comparison, left_fn, operator, right_fn, ordinals)
+        return self.result_from_ordinals(matched)
+
+    def column_comparison(self, left_fn, operator, right_fn):
+        # returns None if the comparison has to look at every item
+        ordinals = self.range_comparison(left_fn, operator, right_fn)
+        if ordinals is not None:
+            metrics.count('query.range_comparisons')
+            return self.result_from_ordinals(ordinals)
+
+        mask = self.vectorized_comparison(left_fn, operator, right_fn)
+        if mask is None:
+            return None
+        return QueryResult(np.array(mask), self.keyspace)
+
+    def items_for(self, ordinals):
+        if hasattr(self.dataset, 'values_for'):
+            return self.dataset.values_for(ordinals)
+        dataset = self.dataset
+        return (dataset[key] for key in self.keyspace.keys_for(ordinals))
+
+    def item_comparison(self, left_fn, operator, right_fn, ordinals):
+        # the ordinals whose items satisfy the comparison; each of them gets decoded
+        metrics.count('query.items_compared', len(ordinals))
+        matched = []
+        for ordinal, element in zip(ordinals.tolist(), self.items_for(ordinals)):
+            if operator(left_fn(element), right_fn(element)):
+                matched.append(ordinal)
+        return np.array(matched, dtype=np.int64)
+
+    def parallel_evaluate(self, tree, ordinals):
+        # Splits the ordinals in scope at partition boundaries and evaluates the whole
+        # subtree on every partition in the pool, so both sides of an intersection or
+        # union run in the workers at once. Each partition is still scoped on its own: an
+        # intersection skips its second side on partitions where the first matched
+        # nothing. Partitions with nothing in scope aren't sent at all.
+        boundaries = np.arange(self.partition_size, len(self.keyspace), self.partition_size)
+        partitions = [x for x in np.split(ordinals, np.searchsorted(ordinals, boundaries)) if len(x)]
+        metrics.count('query.partitions', len(partitions))
+        tasks = [(tree, x) for x in partitions]
+        matched = list(pipeline.merged_results(self.pool.imap_unordered(match_partition, tasks)))
+        return self.result_from_ordinals(np.concatenate(matched))
+
+    def range_comparison(self, left_fn, operator, right_fn):
+        # column-vs-constant comparisons on sorted columns are binary searches
+        if self.columns is None:
+            return None
+        comparator = OPERATOR_NAMES[operator]
+        if isinstance(left_fn, Constant):
+            left_fn, right_fn = right_fn, left_fn
+            comparator = RANGE_COMPARATORS[comparator]
+        if not isinstance(right_fn, Constant) or left_fn.column not in SORTED_COLUMNS:
+            return None
+
+        column = self.columns[left_fn.column]
+        try:
+            value = coerce_dates(right_fn.value, column)
+        except ARRAY_FALLBACK_ERRORS:
+            # e.g. a string that isn't a date; the per-item path decides what it means
+            return None
+        if np.issubdtype(column.dtype, np.datetime64):
+            if not isinstance(value, np.datetime64):
+                return None
+        elif isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None
+        return self.columns.range_ordinals(left_fn.column, comparator, value)
+
+    def vectorized_comparison(self, left_fn, operator, right_fn):
+        if self.columns is None or not (left_fn.vectorized and right_fn.vectorized):
+            return None
+
+        try:
+            with np.errstate(**ARRAY_ERRORS):
+                left = left_fn.vector_fn(self.columns)
+                right = right_fn.vector_fn(self.columns)
+                left, right = coerce_dates(left, right), coerce_dates(right, left)
+                mask = operator(left, right)
+        except ARRAY_FALLBACK_ERRORS:
+            # let the per-item path decide whether this is really an error
+            return None
+
+        return np.broadcast_to(np.asarray(mask, dtype=bool), (len(self.columns),))
     
-    def feature_list(self, *args):
-        return args
+    def ordered_query(self, child, *clauses):
+        result = self.to_result(child)
+        feature, descending, limit = None, False, None
+        for clause in clauses:
+            if clause[0] == 'order':
+                _, feature, descending = clause
+            else:
+                limit = clause[1]
+
+        ordinals = result.ordinals()
+        if feature is None:
+            return RankedResult(ordinals[:limit], self.keyspace)
+        feature = as_feature(feature)
+
+        if self.columns is not None and feature.vectorized:
+            try:
+                with np.errstate(**ARRAY_ERRORS):
+                    values = np.broadcast_to(feature.vector_fn(self.columns), (len(self.columns),))
+                if values.dtype.kind in 'iufbM':
+                    ranked = top_ordinals(values[ordinals], ordinals, descending, limit)
+                    return RankedResult(ranked, self.keyspace)
+            except ARRAY_FALLBACK_ERRORS:
+                pass
+
+        keys = self.keyspace.keys_for(ordinals)
+        items = [(feature(self.dataset[key]), ordinal) for key, ordinal in zip(keys, ordinals)]
+        return RankedResult(top_items(items, descending, limit), self.keyspace)
+
+    def order(self, feature, direction=None):
+        return ('order', feature, direction == 'desc')
+
+    def limit(self, count):
+        return ('limit', int(count))
+
+    def feature_list(self, first, rest):
+        if isinstance(rest, tuple):
+            return (first,) + rest
+        return (first, rest)
     
     def number(self, value):
-        n = float(value)
-        return lambda x: n
+        return Constant(float(value))
     
     def string(self, value):
-        value = ast.literal_eval(value)
-        return lambda x: value
+        return Constant(ast.literal_eval(value))
 
     def feature_op(self, left_fn, operator, right_fn):
         op_fn = OPERATORS[operator]
-        return lambda x: op_fn(left_fn(x), right_fn(x))
+        return combine_features(op_fn, op_fn, left_fn, right_fn)
     
     def json_feature(self, key_path):
-        return lambda x: get_field(key_path, x)
+        name = key_path[1:]
+        if self.columns is not None and name in self.columns:
+            return Feature(lambda x: get_field(key_path, x), lambda columns: columns.values(name), name)
+        return Feature(lambda x: get_field(key_path, x))
@@ -0,0 +1,296 @@
+import glob
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from . import metrics
+from .index import map_file
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Packed chapter store. Chapter texts are appended to segment files, and every segment has
+# an append-only .idx file of fixed-size records saying where each chapter landed. Readers
+# merge the .idx files into one index sorted by (story_id, chapter_index) and memory map
+# the segments, so a lookup is a binary search plus a slice. With compression, chapters are
+# buffered into chunks of about CHUNK_SIZE bytes that are compressed together, and each
+# record points at its chunk plus where the chapter starts inside it.
+
+STORE_DIRNAME = 'chapter-store'
+STORE_META = 'store.json'
+STORE_VERSION = 2
+MERGED_INDEX = 'index.npy'
+SEGMENT_SIZE = 1 << 30
+CHUNK_SIZE = 256 << 10
+
+CODEC_RAW = 0
+CODEC_ZSTD = 1
+
+RECORD_DTYPE = np.dtype([
+    ('key', '<u8'),
+    ('offset', '<u8'),
+    ('length', '<u4'),
+    ('start', '<u4'),
+    ('raw_length', '<u4'),
+    ('codec', 'u1'),
+])
+INDEX_DTYPE = np.dtype([
+    ('key', '<u8'),
+    ('segment', '<u4'),
+    ('offset', '<u8'),
+    ('length', '<u4'),
+    ('start', '<u4'),
+    ('raw_length', '<u4'),
+    ('codec', 'u1'),
+])
+
+
+def chapter_key(story_id, chapter_index):
+    return (int(story_id) << 24) | int(chapter_index)
+
+
+def split_key(key):
+    return int(key) >> 24, int(key) & 0xffffff
+
+
+def is_store(path):
+    return os.path.exists(os.path.join(path, STORE_META))
+
+
+def create_store(path):
+    os.makedirs(path, exist_ok=True)
+    if not is_store(path):
+        with open(os.path.join(path, STORE_META), 'w', encoding='utf8') as f:
+            json.dump({'version': STORE_VERSION}, f)
+
+
+class ChapterStoreWriter:
+    # Appends chapters to a new segment owned by this writer, so any number of processes
+    # can write to the same store at once. Data is flushed before its index records are
+    # written, and readers ignore records that point past the end of a segment. Compressed
+    # chapters are only written once their chunk fills up or the writer is closed.
+    def __init__(self, path, compression=None, level=3, segment_size=SEGMENT_SIZE, chunk_size=CHUNK_SIZE):
+        if compression not in (None, 'zstd'):
+            raise Exception(f'unknown chapter compression: {compression}')
+        if compression == 'zstd' and zstandard is None:
+            raise Exception('zstd compression requires the zstandard package')
+
+        create_store(path)
+        self.path = path
+        self.compressor = zstandard.ZstdCompressor(level=level) if compression else None
+        self.segment_size = segment_size
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.data = None
+        self.records = None
+        self.offset = 0
+        self.chunk = []
+        self.chunk_bytes = 0
+
+    def open_segment(self):
+        self.close_files()
+        name = f'segment-{time.time_ns():020d}-{os.getpid()}'
+        self.data = open(os.path.join(self.path, f'{name}.bin'), 'ab')
+        self.records = open(os.path.join(self.path, f'{name}.idx'), 'ab')
+        self.offset = 0
+
+    def put(self, story_id, chapter_index, text):
+        raw = text.encode('utf-8') if isinstance(text, str) else bytes(text)
+        key = chapter_key(story_id, chapter_index)
+        with self.lock:
+            if self.compressor is None:
+                self.write_chunk([(key, raw)], raw, CODEC_RAW)
+                return
+            self.chunk.append((key, raw))
+            self.chunk_bytes += len(raw)
+            if self.chunk_bytes >= self.chunk_size:
+                self.flush_chunk()
+
+    def flush_chunk(self):
+        if self.chunk:
+            data = self.compressor.compress(b''.join(raw for _, raw in self.chunk))
+            self.write_chunk(self.chunk, data, CODEC_ZSTD)
+        self.chunk = []
+        self.chunk_bytes = 0
+
+    def write_chunk(self, chapters, data, codec):
+        if self.data is None or self.offset >= self.segment_size:
+            self.open_segment()
+        records = np.empty(len(chapters), dtype=RECORD_DTYPE)
+        start = 0
+        for i, (key, raw) in enumerate(chapters):
+            records[i] = (key, self.offset, len(data), start, len(raw), codec)
+            start += len(raw)
+        self.data.write(data)
+        self.data.flush()
+        self.records.write(records.tobytes())
+        self.records.flush()
+        self.offset += len(data)
+
+    def close_files(self):
+        for f in [self.data, self.records]:
+            if f is not None:
+                f.close()
+        self.data = self.records = None
+
+    def close(self):
+        with self.lock:
+            if self.compressor is not None:
+                self.flush_chunk()
+            self.close_files()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def segment_names(path):
+    return sorted(os.path.basename(x)[:-len('.idx')] for x in glob.glob(os.path.join(path, 'segment-*.idx')))
+
+
+def store_signature(path, names):
+    return [[x, os.path.getsize(os.path.join(path, f'{x}.idx'))] for x in names]
+
+
+def merge_store_index(path, names):
+    parts = []
+    for segment, name in enumerate(names):
+        segment_bytes = os.path.getsize(os.path.join(path, f'{name}.bin'))
+        with open(os.path.join(path, f'{name}.idx'), 'rb') as f:
+            data = f.read()
+        # a writer that died mid-record leaves a partial record, and one that died between
+        # the data and the record leaves unindexed bytes; both are skipped
+        data = data[:len(data) - len(data) % RECORD_DTYPE.itemsize]
+        records = np.frombuffer(data, dtype=RECORD_DTYPE)
+        records = records[records['offset'] + records['length'] <= segment_bytes]
+
+        part = np.empty(len(records), dtype=INDEX_DTYPE)
+        for field in RECORD_DTYPE.names:
+            part[field] = records[field]
+        part['segment'] = segment
+        parts.append(part)
+
+    index = np.concatenate(parts) if parts else np.empty(0, dtype=INDEX_DTYPE)
+    # later writes of the same chapter win
+    order = np.lexsort((np.arange(len(index)), index['key']))
+    index = index[order]
+    last = np.ones(len(index), dtype=bool)
+    last[:-1] = index['key'][1:] != index['key'][:-1]
+    return index[last]
+
+
+def open_store_index(path):
+    # the merged index is saved next to the segments and rebuilt when any .idx file grows
+    names = segment_names(path)
+    signature = store_signature(path, names)
+    meta_path = os.path.join(path, STORE_META)
+    with open(meta_path, encoding='utf8') as f:
+        meta = json.load(f)
+    if meta.get('version') != STORE_VERSION:
+        raise Exception(f'unsupported chapter store version {meta.get("version")} in {path}; delete it and pack again')
+
+    if meta.get('segments') == signature:
+        try:
+            return names, np.load(os.path.join(path, MERGED_INDEX), mmap_mode='r')
+        except OSError:
+            pass
+
+    index = merge_store_index(path, names)
+    try:
+        tmp_path = os.path.join(path, f'{MERGED_INDEX}.{os.getpid()}.npy')
+        np.save(tmp_path, index)
+        os.replace(tmp_path, os.path.join(path, MERGED_INDEX))
+        meta['segments'] = signature
+        tmp_path = f'{meta_path}.{os.getpid()}'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+    except OSError as e:
+        metrics.warn('store_index_write', 'failed to write chapter store index:', e)
+    return names, index
+
+
+class ChapterStore:
+    def __init__(self, path):
+        self.path = path
+        self.segment_names, self.index = open_store_index(path)
+        self.keys = self.index['key']
+        self.segments = [map_file(os.path.join(path, f'{x}.bin')) for x in self.segment_names]
+        # the last decompressed chunk, since neighboring chapters are usually read together
+        self.last_chunk = (None, None)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, item):
+        try:
+            self.position(*item)
+        except KeyError:
+            return False
+        return True
+
+    @property
+    def compression(self):
+        return 'zstd' if (self.index['codec'] == CODEC_ZSTD).any() else None
+
+    def position(self, story_id, chapter_index):
+        key = chapter_key(story_id, chapter_index)
+        position = int(np.searchsorted(self.keys, key))
+        if position >= len(self.keys) or self.keys[position] != key:
+            raise KeyError((story_id, chapter_index))
+        return position
+
+    def location(self, story_id, chapter_index):
+        # (segment, offset, length) of the stored bytes
+        entry = self.index[self.position(story_id, chapter_index)]
+        return int(entry['segment']), int(entry['offset']), int(entry['length'])
+
+    def read_entry(self, entry):
+        segment, offset, length = int(entry['segment']), int(entry['offset']), int(entry['length'])
+        data = memoryview(self.segments[segment])[offset:offset + length]
+        if entry['codec'] == CODEC_RAW:
+            return data
+        start = int(entry['start'])
+        return self.read_chunk(segment, offset, data)[start:start + int(entry['raw_length'])]
+
+    def read_chunk(self, segment, offset, data):
+        key, chunk = self.last_chunk
+        if key == (segment, offset):
+            return chunk
+        if zstandard is None:
+            raise Exception('reading zstd compressed chapters requires the zstandard package')
+        # decompressors can't be shared between threads, and they're cheap to create
+        chunk = memoryview(zstandard.ZstdDecompressor().decompress(data))
+        self.last_chunk = ((segment, offset), chunk)
+        return chunk
+
+    def read(self, story_id, chapter_index):
+        return self.read_entry(self.index[self.position(story_id, chapter_index)])
+
+
+def pack_chapters(chapter_texts, store_path, stories, compression=None, existing=None):
+    # copies cached chapters into a chapter store; stories is a list of
+    # (story_id, num_chapters). Chapters missing from chapter_texts or already in the
+    # existing ChapterStore are skipped.
+    num_chapters = 0
+    num_bytes = 0
+    with ChapterStoreWriter(store_path, compression) as writer:
+        for story_id, count in stories:
+            for chapter_index in range(count):
+                if existing is not None and (story_id, chapter_index) in existing:
+                    continue
+                try:
+                    data = chapter_texts.read(os.path.join('txt', story_id, f'{chapter_index}.txt'))
+                except (KeyError, OSError):
+                    continue
+                writer.put(story_id, chapter_index, data)
+                num_chapters += 1
+                num_bytes += len(data)
+    return num_chapters, num_bytes
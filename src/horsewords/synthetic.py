@@ -0,0 +1,362 @@
+from datetime import datetime, timedelta, timezone
+import html
+import io
+import json
+import os
+import random
+import re
+import tarfile
+import zipfile
+
+from ebooklib import epub
+import numpy as np
+
+from . import extract
+from .epubs import BOOK
+from .fimfarchive import epub_item_to_text
+
+# Writes a fake unpacked fimfarchive for benchmarks: index.json, one epub per story laid out
+# like fimfiction's, the html chapter cache fetch_chapters would download, and txt.tar with
+# the text extracted from the epub chapters, as the chapter cache would hold it. Everything
+# comes from the seed, so the same arguments always produce the same bytes.
+
+MANIFEST_FILENAME = 'synthetic.json'
+GENERATOR_VERSION = 2
+
+# zip and tar entries get a fixed timestamp so output doesn't depend on the clock
+TIMESTAMP = (2024, 3, 1, 0, 0, 0)
+EPOCH = datetime(2011, 7, 1, tzinfo=timezone.utc)
+
+TAG_NAMES = {
+    'genre': ['Comedy', 'Sad', 'Slice of Life', 'Adventure', 'Romance', 'Drama', 'Dark', 'Random',
+              'Alternate Universe', 'Human', 'Mystery', 'Horror', 'Thriller', 'Tragedy', 'Sci-Fi'],
+    'character': ['Twilight Sparkle', 'Rainbow Dash', 'Pinkie Pie', 'Rarity', 'Applejack', 'Fluttershy',
+                  'Spike', 'Princess Celestia', 'Princess Luna', 'Starlight Glimmer', 'Trixie',
+                  'Sunset Shimmer', 'Derpy Hooves', 'Lyra', 'Bon Bon', 'Discord', 'Scootaloo'],
+    'series': ['My Little Pony: Friendship is Magic', 'My Little Pony: Equestria Girls'],
+    'content': ['Sex', 'Gore', 'Crossover', 'Anthro', 'Second Person', 'Fan Fiction'],
+    'warning': ['Gore', 'Sex', 'Violence', 'Profanity'],
+}
+STATUSES = [('complete', 0.45), ('incomplete', 0.35), ('hiatus', 0.12), ('cancelled', 0.08)]
+RATINGS = [('everyone', 0.6), ('teen', 0.3), ('mature', 0.1)]
+
+WORDS = '''
+the and a to of was she he it her in that his i you with as on had but for at said they
+pony not be what all from were there one so this would could out up an back into them if
+just like about no eyes over me my then time head more before only down even some know did
+been looked get around who where me your we can going now away little how back as here felt
+think something way again right through thought still why well never hoof hooves mane tail
+wings horn magic friend friends princess castle library apple cake sky cloud clouds forest
+town night day morning light door room voice smile face moment breath long small last
+'''.split()
+NAMES = ['Twilight', 'Rainbow', 'Pinkie', 'Rarity', 'Applejack', 'Fluttershy', 'Spike', 'Celestia',
+         'Luna', 'Starlight', 'Trixie', 'Ponyville', 'Canterlot', 'Equestria', 'Everfree']
+CONTRACTIONS = ['don’t', 'can’t', 'it’s', 'I’m', 'wasn’t', 'she’d', 'you’re', 'didn’t']
+TITLE_WORDS = ['The', 'Last', 'Night', 'Of', 'Harmony', 'Friendship', 'Storm', 'Letters', 'Home',
+               'Little', 'Cupcakes', 'Shadow', 'Moon', 'Sun', 'Apples', 'Dream', 'Song', 'Road']
+
+XHTML_HEADER = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n')
+CONTAINER_XML = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                 '<rootfiles><rootfile full-path="book.opf" media-type="application/oebps-package+xml"/>'
+                 '</rootfiles></container>')
+
+
+def slug(text):
+    return re.sub(r'[^a-z0-9]+', '-', text.lower()).strip('-')
+
+
+def date_string(seconds):
+    return (EPOCH + timedelta(seconds=int(seconds))).isoformat()
+
+
+def weighted(rng, choices):
+    return rng.choices([x for x, _ in choices], [w for _, w in choices])[0]
+
+
+def make_tags(rng, tags_per_type=40):
+    # the real tag names plus numbered filler tags, so tag patterns match more than a few
+    tags = []
+    for tag_type, names in TAG_NAMES.items():
+        names = list(names) + [f'{tag_type.title()} {i}' for i in range(tags_per_type - len(names))]
+        for name in names:
+            tag_id = len(tags) + 1
+            tags.append({'id': tag_id, 'name': name, 'old_id': f'{tag_type}:{tag_id}', 'type': tag_type,
+                         'url': f'https://www.fimfiction.net/tag/{slug(name)}'})
+    return tags
+
+
+class TextGenerator:
+    # words are drawn from a zipf-ish distribution in bulk with numpy, then cut into
+    # sentences and paragraphs
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.np_rng = np.random.default_rng(seed)
+        self.vocabulary = np.array(WORDS + NAMES + CONTRACTIONS, dtype=object)
+        weights = 1.0 / np.arange(1, len(self.vocabulary) + 1)
+        self.weights = weights / weights.sum()
+
+    def paragraphs(self, num_words):
+        words = self.np_rng.choice(self.vocabulary, size=num_words, p=self.weights)
+        lengths = self.np_rng.integers(4, 22, size=num_words // 4 + 1)
+        sentences = []
+        position = 0
+        for length in lengths:
+            if position >= num_words:
+                break
+            sentence = ' '.join(words[position:position + length])
+            position += length
+            sentence = sentence[0].upper() + sentence[1:]
+            if self.rng.random() < 0.25:
+                sentences.append(f'“{sentence}!” {self.rng.choice(NAMES)} said.')
+            else:
+                sentences.append(sentence + self.rng.choice('...?!.'))
+
+        result = []
+        while sentences:
+            count = self.rng.randint(1, 7)
+            result.append(' '.join(sentences[:count]))
+            sentences = sentences[count:]
+        return result
+
+
+def chapter_xhtml(title, paragraphs, authors_note=None):
+    # the layout of a chapter document in fimfiction's epubs
+    body = [f'<h1>{html.escape(title)}</h1>']
+    body.extend(f'<p>{html.escape(x)}</p>' for x in paragraphs)
+    if authors_note:
+        body.append("<h1>Author's Note</h1>")
+        body.append(f'<div id="authors-note"><p>{html.escape(authors_note)}</p></div>')
+    return (f'{XHTML_HEADER}<html xmlns="http://www.w3.org/1999/xhtml"><head><title>{html.escape(title)}</title>'
+            f'</head><body>{"".join(body)}</body></html>')
+
+
+def cached_text(document):
+    # EbookLib rewrites chapter documents when their content is read, so the text goes
+    # through the same epub item and extractor the chapter cache uses
+    item = epub.EpubHtml(content=document.encode('utf-8'))
+    item.book = BOOK
+    return epub_item_to_text(item, extract.FAST_TEXT_SUPPORTED)
+
+
+def chapter_html(story, chapter, paragraphs):
+    # the layout of a chapter downloaded from fimfiction's /chapters/download page
+    body = ''.join(f'<p>{html.escape(x)}</p>' for x in paragraphs)
+    return (f'<!DOCTYPE html><html><head><meta charset="utf-8"/></head><body>'
+            f'<h1><a href="{story["url"]}">{html.escape(story["title"])}</a></h1>'
+            f'<h2>by <a href="{story["author"]["url"]}">{html.escape(story["author"]["name"])}</a></h2>'
+            f'<h3>{html.escape(chapter["title"])}</h3><div id="chapter_container">{body}</div></body></html>')
+
+
+def opf_document(story, chapters):
+    manifest = ['<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>',
+                '<item id="title" href="title.html" media-type="application/xhtml+xml"/>',
+                '<item id="toc" href="toc.html" media-type="application/xhtml+xml"/>']
+    spine = ['<itemref idref="title"/>', '<itemref idref="toc"/>']
+    for chapter in chapters:
+        number = chapter['chapter_number']
+        manifest.append(f'<item id="chapter-{number}" href="chapter-{number}.html" media-type="application/xhtml+xml"/>')
+        spine.append(f'<itemref idref="chapter-{number}"/>')
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="uid">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+            f'<dc:identifier id="uid">{story["url"]}</dc:identifier>'
+            f'<dc:title>{html.escape(story["title"])}</dc:title>'
+            f'<dc:creator>{html.escape(story["author"]["name"])}</dc:creator><dc:language>en</dc:language>'
+            f'</metadata><manifest>{"".join(manifest)}</manifest><spine toc="ncx">{"".join(spine)}</spine></package>')
+
+
+def ncx_document(story, chapters):
+    points = [('title', 'Title Page', 'title.html'), ('toc', 'Contents', 'toc.html')]
+    points += [(f'chapter-{x["chapter_number"]}', x['title'], f'chapter-{x["chapter_number"]}.html') for x in chapters]
+    nav_points = ''.join(
+        f'<navPoint id="{uid}" playOrder="{i + 1}"><navLabel><text>{html.escape(label)}</text></navLabel>'
+        f'<content src="{href}"/></navPoint>'
+        for i, (uid, label, href) in enumerate(points))
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+            f'<head><meta name="dtb:uid" content="{story["url"]}"/></head>'
+            f'<docTitle><text>{html.escape(story["title"])}</text></docTitle>'
+            f'<navMap>{nav_points}</navMap></ncx>')
+
+
+def write_zip_member(zip_file, name, data, compress=True):
+    info = zipfile.ZipInfo(name, TIMESTAMP)
+    info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    zip_file.writestr(info, data)
+
+
+def write_epub(path, story, chapters, documents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    title_page = (f'{XHTML_HEADER}<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Title</title></head>'
+                  f'<body><h1>{html.escape(story["title"])}</h1><p>{html.escape(story["short_description"])}</p>'
+                  '</body></html>')
+    contents = ''.join(f'<li>{html.escape(x["title"])}</li>' for x in chapters)
+    toc_page = (f'{XHTML_HEADER}<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Contents</title></head>'
+                f'<body><h1>Contents</h1><ol>{contents}</ol></body></html>')
+
+    with zipfile.ZipFile(path, 'w') as zip_file:
+        write_zip_member(zip_file, 'mimetype', 'application/epub+zip', compress=False)
+        write_zip_member(zip_file, 'META-INF/container.xml', CONTAINER_XML)
+        write_zip_member(zip_file, 'book.opf', opf_document(story, chapters))
+        write_zip_member(zip_file, 'toc.ncx', ncx_document(story, chapters))
+        write_zip_member(zip_file, 'title.html', title_page)
+        write_zip_member(zip_file, 'toc.html', toc_page)
+        for chapter, document in zip(chapters, documents):
+            write_zip_member(zip_file, f'chapter-{chapter["chapter_number"]}.html', document)
+
+
+def add_tar_member(tar_file, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = datetime(*TIMESTAMP, tzinfo=timezone.utc).timestamp()
+    tar_file.addfile(info, io.BytesIO(data))
+
+
+def make_story(rng, story_id, tags, authors, words_per_chapter):
+    author = rng.choice(authors)
+    title = ' '.join(rng.sample(TITLE_WORDS, rng.randint(1, 4)))
+    published = rng.randint(0, 12 * 365 * 86400)
+
+    num_chapters = min(1 + int(rng.expovariate(1 / 4)), 60)
+    chapters = []
+    modified = published
+    for number in range(1, num_chapters + 1):
+        chapter_published = modified + rng.randint(0, 30 * 86400)
+        modified = chapter_published + (rng.randint(0, 90 * 86400) if rng.random() < 0.2 else 0)
+        num_words = max(50, int(rng.lognormvariate(0, 0.8) * words_per_chapter))
+        chapters.append({
+            'chapter_number': number,
+            'date_modified': date_string(modified),
+            'date_published': date_string(chapter_published),
+            'id': story_id * 100 + number,
+            'num_views': int(rng.paretovariate(1.2) * 50),
+            'num_words': num_words,
+            'published': True,
+            'title': f'Chapter {number}' if rng.random() < 0.5 else ' '.join(rng.sample(TITLE_WORDS, 2)),
+            'url': f'https://www.fimfiction.net/story/{story_id}/{number}/{slug(title)}',
+        })
+
+    story_tags = []
+    for tag_type, count in [('series', 1), ('genre', rng.randint(1, 3)), ('character', rng.randint(0, 4)),
+                            ('content', rng.randint(0, 1)), ('warning', int(rng.random() < 0.1))]:
+        candidates = [x for x in tags if x['type'] == tag_type]
+        story_tags.extend(rng.sample(candidates, count))
+
+    num_likes = int(rng.paretovariate(1.1) * 5) - 1
+    status = weighted(rng, STATUSES)
+    return {
+        'archive': {
+            'date_checked': date_string(modified + 86400),
+            'date_created': date_string(published),
+            'date_fetched': date_string(modified + 86400),
+            'date_updated': date_string(modified),
+            'path': f'epub/{slug(author["name"])[0]}/{slug(author["name"])}-{author["id"]}/{slug(title)}-{story_id}.epub',
+        },
+        'author': author,
+        'chapters': chapters,
+        'color': {'hex': f'{rng.randrange(1 << 24):06x}', 'rgb': [rng.randrange(256) for _ in range(3)]},
+        'completion_status': status,
+        'content_rating': weighted(rng, RATINGS),
+        'cover_image': None,
+        'date_modified': date_string(modified),
+        'date_published': date_string(published),
+        'date_updated': date_string(modified) if status != 'complete' or rng.random() < 0.5 else None,
+        'description_html': f'<p>{html.escape(title)} is a story about {rng.choice(NAMES)}.</p>',
+        'id': story_id,
+        'num_chapters': num_chapters,
+        'num_comments': rng.randint(0, 200),
+        'num_dislikes': max(0, int(num_likes * rng.random() * 0.2)),
+        'num_likes': num_likes,
+        'num_views': sum(x['num_views'] for x in chapters),
+        'num_words': sum(x['num_words'] for x in chapters),
+        'prequel': None,
+        'published': True,
+        'rating': rng.randint(0, 100),
+        'short_description': f'{rng.choice(NAMES)} and {rng.choice(NAMES)} {rng.choice(WORDS)}.',
+        'status': 'visible',
+        'submitted': True,
+        'tags': story_tags,
+        'title': title,
+        'total_num_views': sum(x['num_views'] for x in chapters),
+        'url': f'https://www.fimfiction.net/story/{story_id}/{slug(title)}',
+    }
+
+
+def generate_archive(path, num_stories=1000, seed=0, words_per_chapter=1500, epubs=True, html_cache=True,
+                     txt_tar=True):
+    # Returns the manifest written to synthetic.json. txt.tar holds what the chapter cache
+    # would hold after extracting the epubs, so the chapter documents are run through the
+    # extractor.
+    rng = random.Random(seed)
+    text = TextGenerator(seed)
+    tags = make_tags(rng)
+    authors = []
+    for author_id in range(1, max(2, num_stories // 5) + 1):
+        name = f'{rng.choice(NAMES)} {rng.choice(TITLE_WORDS)} {author_id}'
+        authors.append({'id': author_id, 'name': name, 'url': f'https://www.fimfiction.net/user/{author_id}/{slug(name)}'})
+
+    os.makedirs(path, exist_ok=True)
+    tar_file = tarfile.open(os.path.join(path, 'txt.tar'), 'w') if txt_tar else None
+    index = {}
+    num_chapters = 0
+    num_words = 0
+    num_bytes = 0
+    try:
+        for story_id in range(1, num_stories + 1):
+            # ids are sparse like the real archive's
+            story_id = story_id * 7 + rng.randrange(7)
+            story = make_story(rng, story_id, tags, authors, words_per_chapter)
+            index[str(story_id)] = story
+
+            documents = []
+            for position, chapter in enumerate(story['chapters']):
+                paragraphs = text.paragraphs(chapter['num_words'])
+                note = f'Thanks for reading, {rng.choice(NAMES)}!' if rng.random() < 0.1 else None
+                documents.append(chapter_xhtml(chapter['title'], paragraphs, note))
+                chapter_text = cached_text(documents[-1]).encode('utf-8')
+                num_chapters += 1
+                num_words += chapter['num_words']
+                num_bytes += len(chapter_text)
+
+                if html_cache:
+                    html_path = os.path.join(path, 'html', str(story_id), f'{chapter["chapter_number"]}.html')
+                    os.makedirs(os.path.dirname(html_path), exist_ok=True)
+                    with open(html_path, 'w', encoding='utf8') as f:
+                        f.write(chapter_html(story, chapter, paragraphs))
+                if tar_file is not None:
+                    add_tar_member(tar_file, f'txt/{story_id}/{position}.txt', chapter_text)
+
+            if epubs:
+                write_epub(os.path.join(path, story['archive']['path']), story, story['chapters'], documents)
+    finally:
+        if tar_file is not None:
+            tar_file.close()
+
+    with open(os.path.join(path, 'index.json'), 'w', encoding='utf8') as f:
+        json.dump(index, f, indent=4)
+
+    manifest = {
+        'version': GENERATOR_VERSION,
+        'seed': seed,
+        'num_stories': num_stories,
+        'words_per_chapter': words_per_chapter,
+        'epubs': epubs,
+        'html_cache': html_cache,
+        'txt_tar': txt_tar,
+        'chapters': num_chapters,
+        'words': num_words,
+        'text_bytes': num_bytes,
+    }
+    with open(os.path.join(path, MANIFEST_FILENAME), 'w', encoding='utf8') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST_FILENAME), encoding='utf8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
@@ -1,6 +1,11 @@
 import ast
 import lark
 import itertools
+import re
+
+from . import metrics
+from .cache import LRUCache
+from .parsing import get_parser
 
 embed_header = r'''
 %ignore " "
@@ -38,6 +43,9 @@ COUNT : /\d+/
 REST : /.+/s
 '''
 
+# an embed runs from its "{" to the first "}" outside a string literal
+EMBED_SPAN = re.compile(r'(?:"(?:[^"\\]|\\.)*"|[^"}])*}', re.S)
+
 def create_embed_parser(embed_customizations, require_custom_fn=True, require_custom_field=True):
     grammar_parts = [embed_header, embed_def]
     if require_custom_fn:
@@ -50,52 +58,53 @@ def create_embed_parser(embed_customizations, require_custom_fn=True, require_cu
     grammar_parts.append(standard_data)
 
     grammar = ''.join(grammar_parts)
-    return lark.Lark(grammar, parser='earley')
-    
-@lark.v_args(inline=True)
-class TemplatedString(lark.Transformer):
-    def __init__(self, customizations, require_custom_fn=True, require_custom_field=True):
-        self.data = None
-        self.requirements = None
-        self.parser = create_embed_parser(customizations, require_custom_fn, require_custom_field)
-        self.endpos = -1
+    return get_parser(grammar, parser='lalr')
     
-    def parse(self, template, data):
+class CompiledTemplate:
+    # A template parsed once and rendered many times. Embeds are parsed lazily by
+    # position, so rendering only walks the cached pieces and calls the compiled embed
+    # functions on each item's data.
+    def __init__(self, renderer, template):
+        self.renderer = renderer
+        self.template = template
+        self.texts = {}
+        self.embeds = {}
+
+    def text_before(self, startpos):
+        result = self.texts.get(startpos)
+        if result is None:
+            next_candidate = self.template.find('{', startpos)
+            if next_candidate == -1:
+                result = (self.template[startpos:], None)
+            else:
+                result = (self.template[startpos:next_candidate], next_candidate)
+            self.texts[startpos] = result
+        return result
+
+    def embed_at(self, startpos):
+        result = self.embeds.get(startpos)
+        if result is None:
+            result = self.renderer.compile_embed(self.template, startpos)
+            self.embeds[startpos] = result
+        return result
+
+    def fill(self, data):
+        template = self.template
         startpos = 0
         result = []
         while startpos < len(template) - 1:
-            # find the start of the template piece
-            try:
-                next_candidate = startpos + template[startpos:].index('{')
-            except:
-                result.append(template[startpos:])
-                break
-            
             # add all the crud before the template directly to the output
-            if next_candidate != startpos:
-                result.append(template[startpos:next_candidate])
-                startpos = next_candidate
-
-            # convert the template piece into a string
-            try:
-                self.data = data
-                self.requirements = set()
-                parsed_template = self.parser.parse(template[startpos:])
-                fill_text = self.transform(parsed_template)
-
-                # find the end of the template
-                if len(parsed_template.children) == 1:
-                    endpos = len(template) - 1
-                else:
-                    endpos = startpos + parsed_template.children[1].start_pos
-                while template[endpos] != '}':
-                    endpos -= 1
-            except lark.exceptions.UnexpectedCharacters as e:
-                print('lark exception:', e)
-                fill_text = None
-                endpos = 0
+            text, next_candidate = self.text_before(startpos)
+            if next_candidate is None:
+                result.append(text)
+                break
+            if text:
+                result.append(text)
+            startpos = next_candidate
 
             # append the templated string and move the cursor to the next character
+            gen, endpos = self.embed_at(startpos)
+            fill_text = gen(data) if gen else None
             if fill_text:
                 result.append(fill_text)
                 startpos = endpos + 1
@@ -105,39 +114,91 @@ class TemplatedString(lark.Transformer):
 
         return ''.join(result)
 
+    def render(self, item):
+        with metrics.timer('template.render'):
+            return self.renderer.finish(self.fill(self.renderer.lookup(item)))
+
+    def render_many(self, items):
+        for item in items:
+            yield self.render(item)
+
+
+@lark.v_args(inline=True)
+class TemplatedString(lark.Transformer):
+    def __init__(self, customizations, require_custom_fn=True, require_custom_field=True):
+        self.requirements = None
+        self.parser = create_embed_parser(customizations, require_custom_fn, require_custom_field)
+        self.compiled = LRUCache(64)
+        self.endpos = -1
+    
+    def compile(self, template):
+        return CompiledTemplate(self, template)
+
+    def parse(self, template, data):
+        compiled = self.compiled.get(template)
+        if compiled is None:
+            metrics.count('template.compiled')
+            compiled = self.compile(template)
+            self.compiled.put(template, compiled)
+        return compiled.render(data)
+
+    def lookup(self, item):
+        return item
+
+    def finish(self, text):
+        return text
+
+    def compile_embed(self, template, startpos):
+        # convert the template piece starting at startpos into a function of the data.
+        # Only the embed's own span is parsed, so compiling stays linear in the template.
+        metrics.count('template.embeds_compiled')
+        span = EMBED_SPAN.match(template, startpos + 1)
+        if span is None:
+            metrics.warn('template_parse', 'unterminated template embed at', startpos)
+            return None, None
+        endpos = span.end() - 1
+        try:
+            self.requirements = set()
+            gen = self.transform(self.parser.parse(template[startpos:endpos + 1]))
+        except lark.exceptions.UnexpectedInput as e:
+            metrics.warn('template_parse', 'lark exception:', e)
+            return None, None
+
+        return gen, endpos
+
     def start(self, embed, rest=None):
-        return embed[0]({})
+        return lambda data: embed[0](data, {})
     
     def join(self, data, string):
         requirements = data[1].union(string[1])
-        iterator = create_iterator(self.data, requirements)
 
-        join_pieces = []
-        for indexes in iterator:
-            join_pieces.append(str(data[0](indexes)))
-        
-        result = string[0]({}).join(join_pieces)
-        return lambda indexes: result, set()
+        def gen(item, indexes):
+            join_pieces = []
+            for join_indexes in create_iterator(item, requirements):
+                join_pieces.append(str(data[0](item, join_indexes)))
+            return string[0](item, {}).join(join_pieces)
+
+        return gen, set()
         
     def string(self, atom, rest):
-        gen = lambda indexes: f'{atom[0](indexes)}{rest[0](indexes)}'
+        gen = lambda data, indexes: f'{atom[0](data, indexes)}{rest[0](data, indexes)}'
         requirements = atom[1].union(rest[1])
         return gen, requirements
     
     def field(self, key_path):
-        gen = lambda indexes: get_field(key_path, self.data, indexes)
+        gen = lambda data, indexes: get_field(key_path, data, indexes)
         requirements = {key_path}
         return gen, requirements
     
     def esc_string(self, value):
         result = ast.literal_eval(value)
-        gen = lambda indexes: result
+        gen = lambda data, indexes: result
         requirements = set()
         return gen, requirements
     
     def prod(self, string, count):
         result = ast.literal_eval(string) * int(count)
-        gen = lambda indexes: result
+        gen = lambda data, indexes: result
         requirements = set()
         return gen, requirements
 
@@ -0,0 +1,407 @@
+from array import array
+import hashlib
+import heapq
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+from . import metrics, pipeline
+from .index import map_file
+
+# Positional inverted index over chapter text. Documents are stories, identified by their
+# ordinal in the archive index. For each term there are two varint streams:
+#  - docs.bin: (doc delta, position count, position bytes) per story containing the term
+#  - positions.bin: position deltas within each story, restarting at every story
+# so story-level queries never decode positions, and phrase queries only decode the
+# positions of stories that contain every term. Chapters are numbered into one position
+# space with a gap between them, so phrases never match across chapters.
+#
+# Terms are stored sorted and newline-separated in terms.bin, with offsets for binary
+# search. The index is built in runs over ranges of story ordinals, one per pool task,
+# and the runs are merged term by term.
+
+TEXT_INDEX_DIRNAME = 'text-index'
+TEXT_INDEX_VERSION = 1
+TOKEN_PATTERN = re.compile(r"\w+(?:['’]\w+)*")
+LEXICON_ARRAYS = ['term_offsets', 'docs_offsets', 'positions_offsets', 'num_docs', 'first_doc', 'last_doc']
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def encode_varints(values):
+    # LEB128; returns the encoded bytes and the encoded length of each value
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        lengths += rest > 0
+        rest >>= np.uint64(7)
+
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    result = np.empty(int(ends[-1]) if len(ends) else 0, dtype=np.uint8)
+    for k in range(int(lengths.max()) if len(lengths) else 0):
+        selected = lengths > k
+        chunk = (values[selected] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        chunk |= np.where(lengths[selected] > k + 1, 0x80, 0).astype(np.uint64)
+        result[starts[selected] + k] = chunk
+    return result.tobytes(), lengths
+
+
+def decode_varints(data):
+    data = np.frombuffer(data, dtype=np.uint8)
+    if not len(data):
+        return np.empty(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    shifts = (np.arange(ends[-1] + 1) - np.repeat(starts, ends - starts + 1)) * 7
+    chunks = (data[:ends[-1] + 1] & 0x7f).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.add.reduceat(chunks, starts)
+
+
+def read_varint(data, offset=0):
+    # returns (value, encoded length) of one varint
+    value = 0
+    shift = 0
+    position = offset
+    while True:
+        byte = data[position]
+        value |= (byte & 0x7f) << shift
+        position += 1
+        if byte < 0x80:
+            return value, position - offset
+        shift += 7
+
+
+def starts_to_groups(counts):
+    # start offset of each group in a flat array, given group sizes
+    starts = np.zeros(len(counts), dtype=np.int64)
+    starts[1:] = np.cumsum(counts)[:-1]
+    return starts
+
+
+class PostingsBuilder:
+    def __init__(self):
+        self.postings = {}
+
+    def add(self, doc, chapters):
+        positions = {}
+        position = 0
+        for text in chapters:
+            for token in tokenize(text):
+                term_positions = positions.get(token)
+                if term_positions is None:
+                    positions[token] = [position]
+                else:
+                    term_positions.append(position)
+                position += 1
+            position += 1
+
+        for term, term_positions in positions.items():
+            entry = self.postings.get(term)
+            if entry is None:
+                self.postings[term] = ([doc], [term_positions])
+            else:
+                entry[0].append(doc)
+                entry[1].append(term_positions)
+
+    def save(self, path):
+        # every stream is encoded with one vectorized pass over the whole run
+        os.makedirs(path, exist_ok=True)
+        terms = sorted(self.postings)
+        docs = []
+        position_lists = []
+        docs_per_term = []
+        for term in terms:
+            term_docs, term_positions = self.postings[term]
+            docs.extend(term_docs)
+            position_lists.extend(term_positions)
+            docs_per_term.append(len(term_docs))
+
+        docs_per_term = np.array(docs_per_term, dtype=np.int64)
+        docs = np.array(docs, dtype=np.int64)
+        counts = np.array([len(x) for x in position_lists], dtype=np.int64)
+        positions = np.fromiter((p for x in position_lists for p in x), dtype=np.int64, count=int(counts.sum()))
+
+        position_starts = starts_to_groups(counts)
+        position_deltas = np.diff(positions, prepend=0)
+        position_deltas[position_starts] = positions[position_starts]
+        position_bytes, position_lengths = encode_varints(position_deltas)
+        position_bytes_per_doc = np.add.reduceat(position_lengths, position_starts) if len(counts) else counts
+
+        term_starts = starts_to_groups(docs_per_term)
+        doc_deltas = np.diff(docs, prepend=0)
+        doc_deltas[term_starts] = docs[term_starts]
+        triples = np.stack([doc_deltas, counts, position_bytes_per_doc], axis=1).reshape(-1)
+        doc_bytes, doc_lengths = encode_varints(triples)
+        doc_bytes_per_term = np.add.reduceat(doc_lengths, term_starts * 3) if len(terms) else docs_per_term
+
+        term_text = '\n'.join(terms).encode('utf-8')
+        term_lengths = np.array([len(x.encode('utf-8')) for x in terms], dtype=np.int64)
+        arrays = {
+            'term_offsets': offsets_from_lengths(term_lengths + 1),
+            'docs_offsets': offsets_from_lengths(doc_bytes_per_term),
+            'positions_offsets': offsets_from_lengths(
+                np.add.reduceat(position_bytes_per_doc, term_starts) if len(terms) else docs_per_term),
+            'num_docs': docs_per_term.astype(np.uint32),
+            'first_doc': docs[term_starts].astype(np.uint32),
+            'last_doc': docs[term_starts + docs_per_term - 1].astype(np.uint32),
+        }
+        write_index_files(path, term_text, doc_bytes, position_bytes, arrays)
+
+
+def offsets_from_lengths(lengths):
+    result = np.zeros(len(lengths) + 1, dtype=np.uint64)
+    np.cumsum(lengths, out=result[1:])
+    return result
+
+
+def write_index_files(path, term_text, doc_bytes, position_bytes, arrays):
+    for name, data in [('terms.bin', term_text), ('docs.bin', doc_bytes), ('positions.bin', position_bytes)]:
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(data)
+    for name in LEXICON_ARRAYS:
+        np.save(os.path.join(path, f'{name}.npy'), arrays[name])
+
+
+def build_run(archive, path, start, end):
+    # returns the run's path and the stories left out because their chapters aren't cached
+    builder = PostingsBuilder()
+    missing = []
+    keys = [archive.index.story_key(x) for x in range(start, end)]
+    for ordinal, (story_id, chapters) in zip(range(start, end), archive.get_chapters_batch(keys, order='requested')):
+        if chapters is None:
+            missing.append(story_id)
+        else:
+            builder.add(ordinal, chapters)
+    builder.save(path)
+    return path, missing
+
+
+def build_run_worker(args):
+    return build_run(pipeline.WORKER_ARCHIVE, *args), metrics.collect()
+
+
+def run_terms(path, run_number):
+    with open(os.path.join(path, 'terms.bin'), 'rb') as f:
+        data = f.read()
+    if not data:
+        return
+    for row, term in enumerate(data.split(b'\n')):
+        yield term, run_number, row
+
+
+def merge_runs(run_paths, path):
+    # postings for a term are concatenated run by run; only the first doc delta of each run
+    # has to be re-encoded relative to the previous run's last doc
+    runs = [dict((name, np.load(os.path.join(x, f'{name}.npy'))) for name in LEXICON_ARRAYS) for x in run_paths]
+    run_docs = [map_file(os.path.join(x, 'docs.bin')) for x in run_paths]
+    run_positions = [map_file(os.path.join(x, 'positions.bin')) for x in run_paths]
+
+    lexicon = dict((name, array('Q', [0]) if name.endswith('offsets') else array('L')) for name in LEXICON_ARRAYS)
+    with open(os.path.join(path, 'terms.bin'), 'wb') as terms_file, \
+            open(os.path.join(path, 'docs.bin'), 'wb') as docs_file, \
+            open(os.path.join(path, 'positions.bin'), 'wb') as positions_file:
+        merged = heapq.merge(*[run_terms(x, i) for i, x in enumerate(run_paths)])
+        current = None
+        last_doc = None
+        for term, run_number, row in merged:
+            run = runs[run_number]
+            docs_start, docs_end = int(run['docs_offsets'][row]), int(run['docs_offsets'][row + 1])
+            positions_start, positions_end = int(run['positions_offsets'][row]), int(run['positions_offsets'][row + 1])
+            data = run_docs[run_number][docs_start:docs_end]
+
+            if term != current:
+                if current is not None:
+                    lexicon['last_doc'].append(last_doc)
+                    lexicon['term_offsets'].append(lexicon['term_offsets'][-1] + len(current) + 1)
+                    lexicon['docs_offsets'].append(docs_file.tell())
+                    lexicon['positions_offsets'].append(positions_file.tell())
+                    terms_file.write(current + b'\n')
+                current = term
+                lexicon['num_docs'].append(0)
+                lexicon['first_doc'].append(int(run['first_doc'][row]))
+            else:
+                first_doc, length = read_varint(data)
+                data = encode_varints([first_doc - last_doc])[0] + data[length:]
+
+            docs_file.write(data)
+            positions_file.write(run_positions[run_number][positions_start:positions_end])
+            lexicon['num_docs'][-1] += int(run['num_docs'][row])
+            last_doc = int(run['last_doc'][row])
+
+        if current is not None:
+            lexicon['last_doc'].append(last_doc)
+            lexicon['term_offsets'].append(lexicon['term_offsets'][-1] + len(current) + 1)
+            lexicon['docs_offsets'].append(docs_file.tell())
+            lexicon['positions_offsets'].append(positions_file.tell())
+            terms_file.write(current + b'\n')
+
+    for name in LEXICON_ARRAYS:
+        dtype = np.uint64 if name.endswith('offsets') else np.uint32
+        np.save(os.path.join(path, f'{name}.npy'), np.frombuffer(lexicon[name], dtype=np.dtype(lexicon[name].typecode)).astype(dtype))
+
+
+def index_signature(index):
+    # doc ids are story ordinals, so the text index is only valid for the same story order,
+    # and for the same chapters in every story
+    digest = hashlib.sha256(np.ascontiguousarray(index.story_ids).tobytes())
+    digest.update(np.ascontiguousarray(index.chapter_hashes).tobytes())
+    return digest.hexdigest()
+
+
+def build_text_index(archive, path, workers=None, stories_per_run=200):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    start_time = time.monotonic()
+
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(os.path.join(tmp_path, 'runs'))
+
+    num_stories = len(archive.index)
+    tasks = []
+    for i, start in enumerate(range(0, num_stories, stories_per_run)):
+        run_path = os.path.join(tmp_path, 'runs', f'run-{i:06d}')
+        tasks.append((run_path, start, min(start + stories_per_run, num_stories)))
+
+    pool = None
+    if workers == 1 or len(tasks) <= 1:
+        results = (build_run(archive, *x) for x in tasks)
+    else:
+        initargs = pipeline.worker_initargs(archive, workers)
+        pool = multiprocessing.Pool(workers, initializer=pipeline.init_worker, initargs=initargs)
+        results = pipeline.merged_results(pool.imap(build_run_worker, tasks))
+
+    try:
+        runs = list(tqdm(results, total=len(tasks), unit='run'))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    missing = [story_id for _, run_missing in runs for story_id in run_missing]
+    if missing:
+        metrics.count('text_index.missing_stories', len(missing))
+        metrics.warn('text_index_incomplete', f'{len(missing)} stories have no cached chapters and were left out of'
+                     ' the text index; it goes stale once they are cached')
+
+    merge_runs([run_path for run_path, _ in runs], tmp_path)
+    shutil.rmtree(os.path.join(tmp_path, 'runs'))
+    with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf8') as f:
+        json.dump({'version': TEXT_INDEX_VERSION, 'stories': index_signature(archive.index), 'missing': missing}, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    print(f'indexed {num_stories} stories in {time.monotonic() - start_time:.1f}s')
+
+
+class TextIndex:
+    def __init__(self, path):
+        self.path = path
+        self.terms = map_file(os.path.join(path, 'terms.bin'))
+        self.docs = map_file(os.path.join(path, 'docs.bin'))
+        self.positions = map_file(os.path.join(path, 'positions.bin'))
+        for name in LEXICON_ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.num_docs)
+
+    def term(self, row):
+        start, end = int(self.term_offsets[row]), int(self.term_offsets[row + 1]) - 1
+        return self.terms[start:end]
+
+    def lookup(self, term):
+        # binary search over the sorted terms; returns the row or None
+        key = term.encode('utf-8')
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.term(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self.term(low) == key:
+            return low
+        return None
+
+    def postings(self, row):
+        # (doc ids, offset of each doc's positions in positions.bin)
+        start, end = int(self.docs_offsets[row]), int(self.docs_offsets[row + 1])
+        triples = decode_varints(self.docs[start:end]).reshape(-1, 3).astype(np.int64)
+        docs = np.cumsum(triples[:, 0])
+        position_offsets = int(self.positions_offsets[row]) + starts_to_groups(triples[:, 2])
+        return docs, np.stack([position_offsets, position_offsets + triples[:, 2]], axis=1)
+
+    def doc_positions(self, position_range):
+        start, end = position_range
+        return np.cumsum(decode_varints(self.positions[start:end]).astype(np.int64))
+
+    def search(self, text):
+        # story ordinals containing the words of text as a phrase
+        tokens = tokenize(text)
+        if not tokens:
+            return np.empty(0, dtype=np.int64)
+
+        rows = [self.lookup(x) for x in tokens]
+        if any(x is None for x in rows):
+            return np.empty(0, dtype=np.int64)
+
+        # rarest terms first, so the candidate set shrinks as fast as possible
+        order = sorted(range(len(rows)), key=lambda i: int(self.num_docs[rows[i]]))
+        postings = {}
+        candidates = None
+        for i in order:
+            postings[i] = self.postings(rows[i])
+            docs = postings[i][0]
+            candidates = docs if candidates is None else np.intersect1d(candidates, docs, assume_unique=True)
+            if not len(candidates):
+                return candidates
+        if len(rows) == 1:
+            return candidates
+
+        matches = []
+        lookups = dict((i, np.searchsorted(postings[i][0], candidates)) for i in order)
+        for n, doc in enumerate(candidates.tolist()):
+            starts = None
+            for i in order:
+                positions = self.doc_positions(postings[i][1][lookups[i][n]]) - i
+                starts = positions if starts is None else np.intersect1d(starts, positions, assume_unique=True)
+                if not len(starts):
+                    break
+            if len(starts):
+                matches.append(doc)
+        return np.array(matches, dtype=np.int64)
+
+
+def open_text_index(path, index, chapter_texts):
+    # returns None if there's no index yet, it was built for a different index.json, or
+    # stories it left out for lack of cached chapters have been cached since
+    meta_path = os.path.join(path, 'meta.json')
+    try:
+        with open(meta_path, encoding='utf8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != TEXT_INDEX_VERSION or meta.get('stories') != index_signature(index):
+        metrics.warn('text_index_stale', 'text index is out of date; rebuild it with build_text_index()')
+        return None
+
+    for story_id in meta.get('missing', []):
+        num_chapters = int(index.chapter_counts[index.story_ordinal(story_id)])
+        if all(chapter_texts.exists(os.path.join('txt', story_id, f'{i}.txt')) for i in range(num_chapters)):
+            metrics.warn('text_index_stale', 'text index is missing stories cached since it was built; rebuild it'
+                         ' with build_text_index()')
+            return None
+    return TextIndex(path)
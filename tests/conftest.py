@@ -0,0 +1,55 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from horsewords import metrics, synthetic
+from horsewords.download import Downloader
+
+NUM_STORIES = 40
+
+# nothing listens here, so any download fails straight away
+OFFLINE = Downloader('http://127.0.0.1:9', retries=0, timeout=1)
+
+
+@pytest.fixture(scope='session')
+def synthetic_path(tmp_path_factory):
+    # a small generated archive shared by the whole session; tests that change files use
+    # archive_path instead
+    path = str(tmp_path_factory.mktemp('synthetic') / 'archive')
+    synthetic.generate_archive(path, NUM_STORIES, seed=1, words_per_chapter=120)
+    return path
+
+
+@pytest.fixture
+def archive_path(synthetic_path, tmp_path):
+    path = str(tmp_path / 'archive')
+    shutil.copytree(synthetic_path, path)
+    return path
+
+
+@pytest.fixture
+def uncached_path(archive_path):
+    # the same archive with no chapter cache, so chapters have to be extracted
+    os.remove(os.path.join(archive_path, 'txt.tar'))
+    return archive_path
+
+
+def read_index(path):
+    with open(os.path.join(path, 'index.json'), encoding='utf8') as f:
+        return json.load(f)
+
+
+def write_index(path, stories):
+    with open(os.path.join(path, 'index.json'), 'w', encoding='utf8') as f:
+        json.dump(stories, f, indent=4)
+
+
+@pytest.fixture
+def enabled_metrics():
+    metrics.reset()
+    metrics.enable()
+    yield metrics
+    metrics.disable()
+    metrics.reset()
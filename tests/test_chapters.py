@@ -0,0 +1,151 @@
+import os
+import sys
+import tarfile
+
+import pytest
+
+from conftest import read_index, write_index
+from horsewords import fimfarchive
+from horsewords.chapters import TAR_INDEX_SUFFIX, CachedChapters, ChapterCache
+
+
+def tar_members(tar_path):
+    with tarfile.open(tar_path) as archive:
+        return dict((member.name, archive.extractfile(member).read()) for member in archive if member.isfile())
+
+
+def test_tar_reads_match_members(synthetic_path):
+    tar_path = os.path.join(synthetic_path, 'txt.tar')
+    members = tar_members(tar_path)
+    chapters = CachedChapters(tar_path)
+    assert os.path.exists(tar_path + TAR_INDEX_SUFFIX)
+
+    for name, data in members.items():
+        view = chapters.read(name)
+        assert isinstance(view, memoryview)
+        assert bytes(view) == data
+        assert chapters.read_text('./' + name) == data.decode('utf-8')
+    with pytest.raises(KeyError):
+        chapters.read('txt/0/0.txt')
+
+
+def test_tar_index_rebuilt_when_tar_changes(archive_path):
+    tar_path = os.path.join(archive_path, 'txt.tar')
+    name = next(iter(tar_members(tar_path)))
+    CachedChapters(tar_path)
+
+    with tarfile.open(tar_path, 'a') as archive:
+        info = tarfile.TarInfo('txt/0/0.txt')
+        info.size = 5
+        with open(os.path.join(archive_path, 'extra.txt'), 'w+b') as f:
+            f.write(b'extra')
+            f.seek(0)
+            archive.addfile(info, f)
+    index_path = tar_path + TAR_INDEX_SUFFIX
+    os.utime(index_path, (0, 0))
+
+    chapters = CachedChapters(tar_path)
+    assert bytes(chapters.read('txt/0/0.txt')) == b'extra'
+    assert bytes(chapters.read(name)) == tar_members(tar_path)[name]
+
+
+@pytest.mark.parametrize('store_bytes', [False, True])
+def test_chapter_cache_evicts_by_bytes(store_bytes):
+    texts = dict((f'txt/1/{i}.txt', f'chapter {i} é' * 50) for i in range(4))
+    text = texts['txt/1/0.txt']
+    size = len(text.encode('utf-8')) if store_bytes else sys.getsizeof(text)
+    # room for two chapters
+    cache = ChapterCache(max_bytes=size * 5 // 2, store_bytes=store_bytes)
+    loads = []
+
+    def get(path):
+        return cache.get_text(path, lambda: loads.append(path) or texts[path].encode('utf-8'))
+
+    assert get('txt/1/0.txt') == texts['txt/1/0.txt']
+    assert get('txt/1/1.txt') == texts['txt/1/1.txt']
+    assert get('txt/1/0.txt') == texts['txt/1/0.txt']
+    # the least recently used chapter goes first
+    assert get('txt/1/2.txt') == texts['txt/1/2.txt']
+    assert get('txt/1/0.txt') == texts['txt/1/0.txt']
+    assert get('txt/1/1.txt') == texts['txt/1/1.txt']
+    assert loads == ['txt/1/0.txt', 'txt/1/1.txt', 'txt/1/2.txt', 'txt/1/1.txt']
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (2, 4, 2)
+    assert stats['entries'] == 2 and 0 < stats['bytes'] <= stats['max_bytes']
+
+
+def test_archive_reads_through_chapter_cache(synthetic_path):
+    cache = ChapterCache()
+    archive = fimfarchive.Fimfarchive(synthetic_path, chapter_cache=cache)
+    story_id = next(iter(archive.stories_by_id))
+    first = archive.get_cached_chapters(story_id)
+    misses = cache.stats()['misses']
+    assert misses == len(first)
+
+    assert archive.get_cached_chapters(story_id) == first
+    assert cache.stats()['hits'] == misses and cache.stats()['misses'] == misses
+
+
+@pytest.mark.parametrize('layout', ['tar', 'directory', 'store', 'zstd'])
+def test_chapters_batch_matches_single_reads(archive_path, layout, enabled_metrics):
+    tar_path = os.path.join(archive_path, 'txt.tar')
+    if layout == 'directory':
+        with tarfile.open(tar_path) as archive:
+            archive.extractall(archive_path, filter='data')
+        os.remove(tar_path)
+    archive = fimfarchive.Fimfarchive(archive_path)
+    if layout in ('store', 'zstd'):
+        archive.pack_chapters(compression='zstd' if layout == 'zstd' else None)
+
+    story_ids = list(archive.stories_by_id)[::-1]
+    expected = dict((x, archive.get_cached_chapters(x)) for x in story_ids)
+    missing = story_ids[3]
+    archive.stories_by_id[missing]['chapters'].append({'id': 0})
+    expected[missing] = None
+
+    enabled_metrics.reset()
+    requested = list(archive.get_chapters_batch(story_ids, order='requested', window=7))
+    assert requested == [(x, expected[x]) for x in story_ids]
+    snapshot = enabled_metrics.snapshot()
+    assert snapshot['bytes']['chapters.read'] >= sum(len(''.join(x)) for x in expected.values() if x)
+    assert snapshot['timers']['chapters.decode']['calls'] == len(story_ids) - 1
+    if layout in ('tar', 'store'):
+        # each window is one contiguous read, plus looking for the missing chapter in txt/
+        # next to the store
+        loose_reads = 1 if layout == 'store' else 0
+        assert snapshot['timers']['chapters.read']['calls'] == (len(story_ids) + 6) // 7 + loose_reads
+
+    physical = list(archive.get_chapters_batch(story_ids, window=7))
+    assert sorted(physical) == sorted(requested)
+
+
+def test_chapter_cache_dropped_when_chapters_change(synthetic_path, archive_path):
+    previous = fimfarchive.Fimfarchive(synthetic_path)
+    stories = read_index(archive_path)
+    moved = next(x for x, story in stories.items() if len(story['chapters']) > 1)
+    stories[moved]['chapters'].reverse()
+    write_index(archive_path, stories)
+
+    cache = ChapterCache()
+    archive = fimfarchive.Fimfarchive(archive_path, chapter_cache=cache)
+    archive.pack_chapters()
+    assert archive.get_cached_chapters(moved) == previous.get_cached_chapters(moved)
+    archive.update_from(synthetic_path, workers=1)
+    assert archive.get_cached_chapters(moved) == previous.get_cached_chapters(moved)[::-1]
+
+    # another archive sharing the cache gets its own texts
+    other = fimfarchive.Fimfarchive(synthetic_path, chapter_cache=cache)
+    assert other.get_cached_chapters(moved) == previous.get_cached_chapters(moved)
+
+
+def test_cached_reads_record_metrics(synthetic_path, enabled_metrics):
+    archive = fimfarchive.Fimfarchive(synthetic_path, chapter_cache=ChapterCache())
+    story_id = next(iter(archive.stories_by_id))
+    texts = archive.get_cached_chapters(story_id)
+    archive.get_cached_chapters(story_id)
+
+    snapshot = enabled_metrics.snapshot()
+    assert snapshot['bytes']['chapters.read'] == sum(len(x.encode('utf-8')) for x in texts)
+    # only misses are read and decoded
+    assert snapshot['timers']['chapters.decode']['calls'] == len(texts)
@@ -0,0 +1,28 @@
+import numpy as np
+
+from conftest import read_index
+from horsewords import fimfarchive
+from horsewords.columns import ColumnBuilder, parse_date
+
+
+def test_columns_match_story_fields(synthetic_path):
+    stories = list(read_index(synthetic_path).values())
+    for use_snapshot in [True, False]:
+        columns = fimfarchive.Fimfarchive(synthetic_path, use_snapshot=use_snapshot).story_columns
+        assert len(columns) == len(stories)
+        assert columns['num_likes'].tolist() == [float(x['num_likes']) for x in stories]
+        assert columns.values('completion_status').tolist() == [x['completion_status'] for x in stories]
+        published = columns['date_published'].astype(np.int64).tolist()
+        assert published == [parse_date(x['date_published']) for x in stories]
+
+
+def test_missing_values():
+    builder = ColumnBuilder()
+    builder.add({'num_likes': 5, 'date_published': '2020-01-02T03:04:05+00:00', 'content_rating': 'teen'})
+    builder.add({'num_likes': None, 'date_published': None})
+    columns = builder.finish()
+
+    assert columns['num_likes'][0] == 5 and np.isnan(columns['num_likes'][1])
+    assert not np.isnat(columns['date_published'][0]) and np.isnat(columns['date_published'][1])
+    assert columns.values('content_rating').tolist() == ['teen', None]
+    assert columns.code('content_rating', 'mature') == len(columns.labels['content_rating'])
@@ -0,0 +1,68 @@
+import copy
+import os
+
+from conftest import OFFLINE, read_index, write_index
+from horsewords import fimfarchive
+from horsewords.delta import read_manifest
+
+
+def test_update_from_recomputes_only_changes(synthetic_path, uncached_path, enabled_metrics):
+    previous = fimfarchive.Fimfarchive(synthetic_path)
+    stories = read_index(uncached_path)
+    multi = [x for x, story in stories.items() if len(story['chapters']) > 1]
+    removed, changed, moved, template = list(stories)[0], multi[0], multi[1], multi[2]
+
+    del stories[removed]
+    stories[changed]['chapters'][1]['date_modified'] = '2030-01-01T00:00:00+00:00'
+    stories[moved]['chapters'].reverse()
+    added = copy.deepcopy(stories[template])
+    added['id'] = 900000
+    for chapter in added['chapters']:
+        chapter['id'] += 900000
+    stories['900000'] = added
+    write_index(uncached_path, stories)
+
+    archive = fimfarchive.Fimfarchive(uncached_path, downloader=OFFLINE)
+    manifest = archive.update_from(synthetic_path, workers=1)
+    assert manifest == read_manifest(uncached_path)
+    assert manifest['counts'] == {'added': 1, 'changed': 2, 'removed': 1}
+    assert manifest['stories'][changed] == {'status': 'changed', 'chapters': [1]}
+    assert manifest['stories'][moved] == {'status': 'changed', 'chapters': []}
+    assert manifest['stories']['900000'] == {'status': 'added', 'chapters': list(range(len(added['chapters'])))}
+    assert manifest['stories'][removed] == {'status': 'removed', 'chapters': []}
+    assert manifest['chapters_recomputed'] == 1 + len(added['chapters'])
+    # stories with the same chapter hashes aren't decoded to be compared
+    assert enabled_metrics.snapshot()['counters']['delta.stories_decoded'] == 2
+
+    assert not os.path.exists(os.path.join(uncached_path, 'txt', removed))
+    for story_id in stories:
+        texts = archive.get_cached_chapters(story_id)
+        if story_id == moved:
+            assert texts == previous.get_cached_chapters(story_id)[::-1]
+        elif story_id == '900000':
+            assert texts == previous.get_cached_chapters(template)
+        else:
+            assert texts == previous.get_cached_chapters(story_id)
+
+
+def test_update_from_appends_changed_stories_to_tar(synthetic_path, archive_path):
+    previous = fimfarchive.Fimfarchive(synthetic_path)
+    stories = read_index(archive_path)
+    moved = next(x for x, story in stories.items() if len(story['chapters']) > 1)
+    stories[moved]['chapters'].reverse()
+    write_index(archive_path, stories)
+
+    archive = fimfarchive.Fimfarchive(archive_path)
+    assert archive.chapter_texts.cache_path.endswith('txt.tar')
+    assert archive.get_cached_chapters(moved) == previous.get_cached_chapters(moved)
+
+    manifest = archive.update_from(synthetic_path, workers=1)
+    assert manifest['stories'] == {moved: {'status': 'changed', 'chapters': []}}
+    expected = previous.get_cached_chapters(moved)[::-1]
+    assert archive.get_cached_chapters(moved) == expected
+    reopened = fimfarchive.Fimfarchive(archive_path)
+    assert reopened.chapter_texts.cache_path.endswith('txt.tar')
+    assert reopened.get_cached_chapters(moved) == expected
+    for story_id in stories:
+        if story_id != moved:
+            assert reopened.get_cached_chapters(story_id) == previous.get_cached_chapters(story_id)
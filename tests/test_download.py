@@ -0,0 +1,129 @@
+import glob
+import http.server
+import os
+import pickle
+import threading
+import time
+
+import pytest
+
+from horsewords import download
+from horsewords.download import Downloader
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            script = server.responses.get(self.path, [])
+            status, headers = script.pop(0) if len(script) > 1 else (script or [(404, {})])[0]
+        try:
+            time.sleep(server.delay)
+            body = f'body of {self.path}'.encode('utf-8')
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    # responses maps a path to the (status, headers) it answers with in turn; the last
+    # one repeats
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.responses = {}
+    server.delay = 0
+    server.in_flight = server.max_in_flight = 0
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_retries_429_and_5xx(server, enabled_metrics):
+    server.responses['/a'] = [(503, {}), (429, {}), (502, {}), (200, {})]
+    downloader = Downloader(server.url, requests_per_second=None, retries=3, backoff=0)
+    assert downloader.get(server.url + '/a') == b'body of /a'
+    assert server.requests == ['/a'] * 4
+    assert enabled_metrics.snapshot()['counters']['download.retries'] == 3
+
+    # out of retries, or a status that isn't worth retrying
+    server.responses['/b'] = [(500, {})]
+    assert downloader.get(server.url + '/b') is None
+    assert server.requests.count('/b') == 4
+    server.responses['/c'] = [(404, {})]
+    assert downloader.get(server.url + '/c') is None
+    assert server.requests.count('/c') == 1
+
+
+def test_retry_after(server):
+    server.responses['/a'] = [(429, {'Retry-After': '1'}), (200, {})]
+    downloader = Downloader(server.url, requests_per_second=None, retries=1, backoff=0)
+    start = time.monotonic()
+    assert downloader.get(server.url + '/a') == b'body of /a'
+    assert time.monotonic() - start >= 1
+
+
+def test_retry_after_clamped(server, enabled_metrics):
+    server.responses['/a'] = [(503, {'Retry-After': '86400'}), (200, {})]
+    downloader = Downloader(server.url, requests_per_second=None, retries=1, backoff=0,
+                            max_retry_after=0.2)
+    start = time.monotonic()
+    assert downloader.get(server.url + '/a') == b'body of /a'
+    assert 0.2 <= time.monotonic() - start < 5
+    assert enabled_metrics.snapshot()['counters']['download.retry_after_clamped'] == 1
+
+    # the limit survives pickling and splitting
+    assert pickle.loads(pickle.dumps(downloader)).max_retry_after == 0.2
+    assert downloader.split(2).max_retry_after == 0.2
+
+
+def test_concurrency_cap(server):
+    server.delay = 0.1
+    for i in range(12):
+        server.responses[f'/{i}'] = [(200, {})]
+    downloader = Downloader(server.url, concurrency=3, requests_per_second=None)
+    threads = [threading.Thread(target=downloader.get, args=(f'{server.url}/{i}',)) for i in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(server.requests) == 12
+    assert server.max_in_flight == 3
+
+
+def test_download_all_leaves_no_partial_files(server, tmp_path, monkeypatch):
+    server.responses['/good'] = [(200, {})]
+    server.responses['/bad'] = [(503, {})]
+    downloader = Downloader(server.url, requests_per_second=None, retries=1, backoff=0)
+    jobs = [(server.url + '/good', str(tmp_path / 'good')), (server.url + '/bad', str(tmp_path / 'bad'))]
+    assert downloader.download_all(jobs) == [str(tmp_path / 'good')]
+    assert sorted(os.listdir(tmp_path)) == ['good']
+
+    # existing files aren't fetched again
+    assert downloader.download_all(jobs[:1]) == [str(tmp_path / 'good')]
+    assert server.requests.count('/good') == 1
+
+    # a write that fails part way removes its temp file
+    def fail(*args):
+        raise OSError('disk full')
+    monkeypatch.setattr(download.os, 'replace', fail)
+    with pytest.raises(OSError):
+        downloader.download(server.url + '/good', str(tmp_path / 'again'))
+    assert glob.glob(str(tmp_path / '*.tmp')) == []
+    assert sorted(os.listdir(tmp_path)) == ['good']
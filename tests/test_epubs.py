@@ -0,0 +1,57 @@
+import glob
+import os
+import zipfile
+
+import pytest
+
+from horsewords.epubs import UnsupportedEpub, read_toc_chapters
+from horsewords.fimfarchive import get_epub_chapters, read_epub_chapters
+
+
+def epub_paths(path):
+    return sorted(glob.glob(os.path.join(path, 'epub', '**', '*.epub'), recursive=True))
+
+
+def rewrite_epub(source, target, replace):
+    # copies an epub with every member passed through replace(name, data)
+    with zipfile.ZipFile(source) as zin, zipfile.ZipFile(target, 'w') as zout:
+        for name in zin.namelist():
+            zout.writestr(name, replace(name, zin.read(name)))
+
+
+def test_toc_chapters_match_ebooklib(synthetic_path):
+    paths = epub_paths(synthetic_path)
+    assert paths
+    for path in paths:
+        chapters = read_toc_chapters(path)
+        expected = read_epub_chapters(path)
+        # toc.html resets the list, so the title page isn't a chapter
+        assert [x.id for x in chapters] == [x.id for x in expected]
+        assert 'title' not in [x.id for x in chapters]
+        for chapter, item in zip(chapters, expected):
+            assert not chapter.content
+            assert chapter.get_content() == item.get_content()
+            # the member is only held while get_content() runs
+            assert not chapter.content
+
+
+def test_missing_chapter_member(synthetic_path, tmp_path):
+    source = epub_paths(synthetic_path)[0]
+    target = str(tmp_path / 'missing.epub')
+    with zipfile.ZipFile(source) as zin, zipfile.ZipFile(target, 'w') as zout:
+        for name in zin.namelist():
+            if name != 'chapter-1.html':
+                zout.writestr(name, zin.read(name))
+    assert read_toc_chapters(target) is None
+
+
+def test_epub3_navigation_falls_back(synthetic_path, tmp_path, enabled_metrics):
+    source = epub_paths(synthetic_path)[0]
+    target = str(tmp_path / 'nav.epub')
+    nav_item = b'<manifest><item id="nav" href="toc.html" media-type="application/xhtml+xml" properties="nav"/>'
+    rewrite_epub(source, target, lambda name, data: data.replace(b'<manifest>', nav_item) if name == 'book.opf' else data)
+
+    with pytest.raises(UnsupportedEpub):
+        read_toc_chapters(target)
+    get_epub_chapters(target, [])
+    assert enabled_metrics.snapshot()['counters']['epub.ebooklib_fallback'] == 1
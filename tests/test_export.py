@@ -0,0 +1,48 @@
+import pytest
+
+from horsewords import fimfarchive
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+
+
+def expected_rows(archive, story_ids):
+    rows = []
+    for story_id in sorted(story_ids, key=int):
+        story = archive.stories_by_id[story_id]
+        texts = archive.get_cached_chapters(story_id)
+        chapters = sorted(story['chapters'], key=lambda x: x['chapter_number'])
+        for chapter, text in zip(chapters, texts):
+            rows.append((story_id, chapter['chapter_number'], story['title'], story['num_likes'],
+                         ','.join(x['name'] for x in story['tags']), chapter['date_modified'], text))
+    return rows
+
+
+def exported_rows(table):
+    columns = ['story', 'chapter', 'story_title', 'story_likes', 'story_tags', 'updated', 'text']
+    return list(zip(*[table.column(x).to_pylist() for x in columns]))
+
+
+def test_parquet_export_matches_chapters(synthetic_path, tmp_path):
+    archive = fimfarchive.Fimfarchive(synthetic_path)
+    result = archive.export(str(tmp_path / 'out'), workers=2, stories_per_shard=15, row_group_size=7)
+    assert len(result['paths']) == 3
+    assert result['stories'] == len(archive.stories_by_id)
+
+    tables = [pq.read_table(x) for x in result['paths']]
+    rows = [row for table in tables for row in exported_rows(table)]
+    assert rows == expected_rows(archive, archive.stories_by_id)
+    assert result['rows'] == len(rows)
+    for path in result['paths']:
+        metadata = pq.ParquetFile(path).metadata
+        assert all(metadata.row_group(i).num_rows <= 7 for i in range(metadata.num_row_groups))
+
+
+def test_arrow_export_with_query(synthetic_path, tmp_path):
+    archive = fimfarchive.Fimfarchive(synthetic_path)
+    query = 'genre:comedy'
+    result = archive.export(str(tmp_path / 'out'), query=query, workers=1, format='arrow')
+    assert len(result['paths']) == 1
+    with pa.memory_map(result['paths'][0]) as source:
+        table = pa.ipc.open_file(source).read_all()
+    assert exported_rows(table) == expected_rows(archive, archive.query_stories(query))
@@ -0,0 +1,49 @@
+import pytest
+from bs4 import BeautifulSoup
+
+from horsewords import extract, fimfarchive
+from horsewords.extract import ChapterTextExtractor, html_to_text
+
+NOTE = '<h1>Author\'s Note</h1><div id="authors-note"><p>{}</p></div>'
+
+DOCUMENTS = {
+    'authors_notes': '<h1>Chapter 1</h1>' + NOTE.format('before') + '<p>Story.</p>' + NOTE.format('after'),
+    'authors_note_nested': '<div><h1>Title</h1><section>' + NOTE.format('inner') + '</section><p>text</p></div>',
+    'first_headings': '<h1>A</h1><h2>B</h2><h3>C</h3><p>body</p><h1>D</h1><h2>E</h2><h3>F</h3>',
+    'heading_in_removed_heading': '<h1>A<h2>B</h2></h1><h2>C</h2><p>x</p>',
+    'breaks': '<p>one</p><p>two<br/>three<br>four</p>\n\n<p></p><p>five</p>',
+    'many_breaks': 'a<br><br><br><br><br><br><br>b<p></p><p></p><p></p><p></p><p></p>c',
+    'whitespace': '<p>  spaced   words </p>\n \t<p>\n</p><pre>  kept\n  as is </pre>',
+    'entities': '<p>&amp; &lt;tag&gt; &#8220;quoted&#8221; &nbsp;x&eacute; &#x2014; &bogus; &amp</p>',
+    'malformed': '<p>a<b>bold<p>b</i>c</div><div><p>unclosed <em>tags',
+    'stray_end_tags': '</p></div>text</b><p>x</p></p></h1>',
+    'skipped_content': '<!-- note --><script>x = 1</script><style>p {}</style><p>seen</p><img src="x.png">'
+                       '<![CDATA[cdata]]><template>t</template>',
+    'unquoted_attributes': '<p class=x>a</p><h1>Author\'s Note</h1><div id=authors-note class=n>n</div><p id=q>z',
+    # both ways raise for a note without its heading
+    'note_without_heading': '<div id="authors-note">note<p>y</p></div><p>z',
+    'empty': '',
+}
+
+
+@pytest.mark.parametrize('name', list(DOCUMENTS))
+def test_extractor_matches_clean_story(name):
+    markup = DOCUMENTS[name]
+    soup_text, fast_text = fimfarchive.extract_text_both_ways(markup)
+    assert fast_text == soup_text
+    if not isinstance(soup_text, type):
+        assert fast_text == fimfarchive.chapter_soup_to_text(BeautifulSoup(markup, 'html.parser'))
+        assert html_to_text(markup.encode('utf-8')) == soup_text
+
+
+def test_heading_text_matches_soup():
+    markup = '<h3>The <i>Chapter</i> Title</h3><p>x</p><h3>Other</h3>'
+    assert ChapterTextExtractor().feed(markup).heading_text('h3') == BeautifulSoup(markup, 'html.parser').h3.getText()
+
+
+def test_fast_text_falls_back_to_soup(synthetic_path, monkeypatch):
+    assert extract.FAST_TEXT_SUPPORTED
+    assert fimfarchive.Fimfarchive(synthetic_path, fast_text=True).fast_text
+
+    monkeypatch.setattr(extract, 'FAST_TEXT_SUPPORTED', False)
+    assert not fimfarchive.Fimfarchive(synthetic_path, fast_text=True).fast_text
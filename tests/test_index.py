@@ -0,0 +1,163 @@
+import json
+import multiprocessing
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from conftest import read_index, write_index
+from horsewords import fimfarchive
+from horsewords.index import SNAPSHOT_DIRNAME, TagNameIndex, attach_index, iter_stories, read_meta
+
+TRICKY_STORIES = {
+    '1': {'title': 'Braces } and { "quotes" inside', 'num_likes': 123456789012, 'tags': []},
+    '2': {'title': 'Ünïcode ✨ and \\ escapes\n', 'rating': -0.5e-3, 'flags': [True, False, None]},
+    '30': {'title': '', 'nested': {'a': [1, {'b': '}]'}], 'c': {}}, 'num_likes': 0},
+    '4': {},
+}
+
+
+def test_snapshot_matches_index_json(synthetic_path):
+    stories = read_index(synthetic_path)
+    archive = fimfarchive.Fimfarchive(synthetic_path)
+    assert archive.index.path == os.path.join(synthetic_path, SNAPSHOT_DIRNAME)
+
+    assert list(archive.stories_by_id) == list(stories)
+    for story_id, story in stories.items():
+        assert archive.stories_by_id[story_id] == story
+    assert '0' not in archive.stories_by_id
+
+    direct = fimfarchive.Fimfarchive(synthetic_path, use_snapshot=False)
+    assert direct.index.path is None
+    assert direct.tags_by_id == archive.tags_by_id
+    assert dict(direct.stories_by_tag) == dict(archive.stories_by_tag)
+
+
+def test_snapshot_rebuilt_only_when_contents_change(archive_path):
+    fimfarchive.Fimfarchive(archive_path)
+    snapshot_path = os.path.join(archive_path, SNAPSHOT_DIRNAME)
+    digest = read_meta(snapshot_path)['source']['sha256']
+
+    # touching the file keeps the snapshot
+    stories = read_index(archive_path)
+    write_index(archive_path, stories)
+    fimfarchive.Fimfarchive(archive_path)
+    assert read_meta(snapshot_path)['source']['sha256'] == digest
+
+    story_id = next(iter(stories))
+    stories[story_id]['title'] = 'A Changed Title'
+    write_index(archive_path, stories)
+    archive = fimfarchive.Fimfarchive(archive_path)
+    assert read_meta(snapshot_path)['source']['sha256'] != digest
+    assert archive.stories_by_id[story_id]['title'] == 'A Changed Title'
+
+
+def test_tag_name_search_matches_scan():
+    tags_by_type = {
+        'character': {1: 'pinkie pie', 2: 'pinkamena', 3: 'applejack', 4: 'apple bloom'},
+        'genre': {5: 'comedy', 6: 'dark', 7: 'adventure'},
+        'series': {8: 'pie sisters'},
+    }
+    index = TagNameIndex(tags_by_type)
+    patterns = ['pie', 'pi', 'p', 'apple', 'apple ', 'ppleja', 'e', 'dark', 'nothing', 'pink', 'le b']
+    for category in [None, 'character', 'genre', 'warning']:
+        for pattern in patterns:
+            expected = sorted(tag_id for tag_type, bucket in tags_by_type.items()
+                              for tag_id, name in bucket.items()
+                              if category in (None, tag_type) and pattern in name)
+            assert sorted(index.search(pattern, category)) == expected, (pattern, category)
+            # cached lookups give the same answer
+            assert sorted(index.search(pattern, category)) == expected
+
+
+def test_tag_queries_use_name_index(synthetic_path):
+    archive = fimfarchive.Fimfarchive(synthetic_path)
+    for pattern in ['pie', 'comedy', 'series 1']:
+        tag_ids = set(tag_id for tag_id, tag in archive.tags_by_id.items() if pattern in tag['name'].lower())
+        stories = set(story_id for story_id, story in archive.stories_by_id.items()
+                      if any(tag['id'] in tag_ids for tag in story['tags']))
+        assert set(archive.query_tags(pattern)) == tag_ids
+        assert set(archive.query_stories(pattern)) == stories
+
+
+@pytest.mark.parametrize('indent', [None, 4])
+def test_iter_stories_streams_every_story(tmp_path, indent):
+    path = str(tmp_path / 'index.json')
+    with open(path, 'w', encoding='utf8') as f:
+        json.dump(TRICKY_STORIES, f, indent=indent, ensure_ascii=False)
+
+    for chunk_size in [1, 2, 3, 7, 64, 1 << 20]:
+        assert list(iter_stories(path, chunk_size=chunk_size)) == list(TRICKY_STORIES.items())
+        partial = list(iter_stories(path, fields=['num_likes', 'title'], chunk_size=chunk_size))
+        assert partial == [(x, dict((k, y[k]) for k in ['num_likes', 'title'] if k in y))
+                           for x, y in TRICKY_STORIES.items()]
+
+
+def test_iter_stories_rejects_malformed_index(tmp_path):
+    path = str(tmp_path / 'index.json')
+    for contents, expected in [(' {} ', []), ('[]', None), ('{"1": {"a": 1} "2": {}}', None), ('{"1": {"a": ', None)]:
+        with open(path, 'w', encoding='utf8') as f:
+            f.write(contents)
+        if expected is not None:
+            assert list(iter_stories(path, chunk_size=2)) == expected
+            continue
+        with pytest.raises(json.JSONDecodeError):
+            list(iter_stories(path, chunk_size=2))
+
+
+def test_partial_index(synthetic_path):
+    stories = read_index(synthetic_path)
+    assert list(fimfarchive.iter_index(synthetic_path)) == list(stories.items())
+
+    archive = fimfarchive.Fimfarchive(synthetic_path, index_fields=['title', 'num_likes'], index_tags=False)
+    assert archive.index.path is None
+    assert archive.tags_by_id == {}
+    for story_id, story in stories.items():
+        assert archive.stories_by_id[story_id] == {'title': story['title'], 'num_likes': story['num_likes']}
+    full = fimfarchive.Fimfarchive(synthetic_path)
+    assert set(archive.query_stories('.likes > 100')) == set(full.query_stories('.likes > 100'))
+
+
+def query_in_worker(args):
+    archive, query = args
+    return archive.index.path, sorted(archive.query_stories(query))
+
+
+def test_shared_index_attaches_in_workers(synthetic_path, tmp_path):
+    stories = read_index(synthetic_path)
+    query = 'genre:comedy, .likes > 100'
+    archive = fimfarchive.Fimfarchive(synthetic_path, use_snapshot=False)
+    expected = sorted(archive.query_stories(query))
+    assert archive.index.path is None
+    # pickling doesn't publish the index by itself
+    with pytest.raises(Exception):
+        pickle.dumps(archive)
+    assert archive.index.path is None
+
+    path = archive.share_index(str(tmp_path / 'shared'))
+    assert archive.index.path == path
+    assert archive.share_index() == path
+    assert isinstance(archive.index.story_ids, np.memmap)
+    assert sorted(archive.query_stories(query)) == expected
+
+    copy = pickle.loads(pickle.dumps(archive))
+    assert copy.index is attach_index(path)
+    assert pickle.loads(pickle.dumps(archive)) is copy
+    assert list(copy.stories_by_id.items()) == list(stories.items())
+    assert sorted(copy.query_stories(query)) == expected
+
+    with multiprocessing.Pool(2) as pool:
+        results = pool.map(query_in_worker, [(archive, query)] * 4)
+    assert results == [(path, expected)] * 4
+
+
+def test_attached_archives_keyed_by_options(synthetic_path):
+    path = fimfarchive.Fimfarchive(synthetic_path).share_index()
+    full = fimfarchive.attach_archive(path, synthetic_path)
+    assert fimfarchive.attach_archive(path, synthetic_path) is full
+    partial = fimfarchive.attach_archive(path, synthetic_path, index_fields=['title'], index_tags=False)
+    assert partial is not full
+    assert (partial.index_fields, partial.index_tags) == (['title'], False)
+    assert fimfarchive.attach_archive(path, synthetic_path, index_fields=('title',), index_tags=False) is partial
+    assert fimfarchive.attach_archive(path, synthetic_path, index_tags=False) not in (full, partial)
@@ -0,0 +1,83 @@
+import os
+import shutil
+
+from conftest import OFFLINE
+from horsewords import fimfarchive
+from horsewords.pipeline import JOURNAL_FILENAME
+
+
+def cached_texts(path):
+    texts = {}
+    for folder, _, files in os.walk(os.path.join(path, 'txt')):
+        for name in files:
+            with open(os.path.join(folder, name), encoding='utf8') as f:
+                texts[os.path.relpath(os.path.join(folder, name), path)] = f.read()
+    return texts
+
+
+def journal(path):
+    with open(os.path.join(path, JOURNAL_FILENAME), encoding='utf8') as f:
+        return f.read().split()
+
+
+def test_build_cache_resumes_from_journal(uncached_path):
+    archive = fimfarchive.Fimfarchive(uncached_path, downloader=OFFLINE)
+    story_ids = list(archive.stories_by_id)
+
+    summary = archive.build_cache(workers=1, chunk_size=4, story_ids=story_ids[:10])
+    assert (summary['cached'], summary['skipped'], summary['failed']) == (10, 0, {})
+    assert summary['bytes'] > 0
+    assert sorted(journal(uncached_path)) == sorted(story_ids[:10])
+
+    summary = archive.build_cache(workers=1, chunk_size=4)
+    assert (summary['cached'], summary['skipped']) == (len(story_ids) - 10, 10)
+    summary = archive.build_cache(workers=1)
+    assert (summary['cached'], summary['skipped']) == (0, len(story_ids))
+    assert sorted(journal(uncached_path)) == sorted(story_ids)
+
+    for story_id in story_ids:
+        assert len(archive.get_cached_chapters(story_id)) == len(archive.stories_by_id[story_id]['chapters'])
+
+
+def test_build_cache_pool_matches_serial(uncached_path, tmp_path):
+    pooled_path = str(tmp_path / 'pooled')
+    shutil.copytree(uncached_path, pooled_path)
+    serial = fimfarchive.Fimfarchive(uncached_path, downloader=OFFLINE)
+    serial.build_cache(workers=1)
+
+    # a story with no epub and no downloaded html fails, and stays out of the journal
+    pooled = fimfarchive.Fimfarchive(pooled_path, downloader=OFFLINE)
+    broken = next(iter(pooled.stories_by_id))
+    os.remove(os.path.join(pooled_path, pooled.stories_by_id[broken]['archive']['path']))
+    shutil.rmtree(os.path.join(pooled_path, 'html', broken), ignore_errors=True)
+
+    summary = pooled.build_cache(workers=2, chunk_size=3)
+    assert list(summary['failed']) == [broken]
+    assert summary['cached'] == len(pooled.stories_by_id) - 1
+    assert sorted(journal(pooled_path)) == sorted(x for x in pooled.stories_by_id if x != broken)
+
+    expected = dict((name, text) for name, text in cached_texts(uncached_path).items()
+                    if name.split(os.sep)[1] != broken)
+    assert cached_texts(pooled_path) == expected
+
+
+def test_pooled_build_merges_worker_metrics(uncached_path, tmp_path, enabled_metrics):
+    profile_path = str(tmp_path / 'profile')
+    with open(f'{profile_path}.worker-1', 'w') as f:
+        f.write('left over from an earlier run')
+    enabled_metrics.enable_profiling(every=1, path=profile_path)
+    try:
+        archive = fimfarchive.Fimfarchive(uncached_path, downloader=OFFLINE)
+        story_ids = list(archive.stories_by_id)
+        # the parent has counts of its own before the pool forks
+        archive.build_cache(workers=1, story_ids=story_ids[:10])
+        archive.build_cache(workers=2, chunk_size=3)
+
+        snapshot = enabled_metrics.snapshot()
+        assert snapshot['counters']['cache.epub_stories'] == len(story_ids)
+        assert snapshot['timers']['cache.story']['calls'] == len(story_ids)
+        assert not os.path.exists(f'{profile_path}.worker-1')
+        stats = enabled_metrics.profile_stats()
+        assert any(name == 'cache_story_chapters' for _, _, name in stats.stats)
+    finally:
+        enabled_metrics.enable_profiling(0)
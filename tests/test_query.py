@@ -0,0 +1,221 @@
+import pytest
+from lark import Tree
+from lark.exceptions import VisitError
+
+from horsewords import fimfarchive
+from horsewords.query import normalize_query
+
+COMPARISONS = [
+    '.likes > 100',
+    '.likes / (.dislikes + 1) > 5',
+    '.ratio >= 10, .wordcount < 100000',
+    '(.dislikes ^ 2) - .likes * 2 > 0',
+    '.title > "M"',
+    '.date_published > "2015-01-01"',
+    '"2015-01-01" <= .date_published',
+    # strings that aren't dates compare as strings on both paths
+    '.date_published > "abc"',
+    '.date_published < "abc"',
+    '.wordcount > 5000, .wordcount <= 20000',
+]
+
+# the trees the query forms parsed to before the grammar was made LALR
+QUERY_FORMS = [
+    ('genre:comedy',
+     "categorized_tag('genre' 'comedy')"),
+    ('pinkie pie',
+     "standalone_tag('pinkie pie')"),
+    ('"pinkie pie"',
+     'standalone_tag(esc_string(\'"pinkie pie"\'))'),
+    ('text:cupcakes',
+     "text_search('cupcakes')"),
+    ('-genre:sad',
+     "negation(categorized_tag('genre' 'sad'))"),
+    ('-(dark | sad)',
+     "negation(union(standalone_tag('dark ') standalone_tag('sad')))"),
+    ('comedy, -content:sex | character:spike',
+     "intersection(standalone_tag('comedy') union(negation(categorized_tag('content' 'sex ')) categorized_tag('character' 'spike')))"),
+    ('a | b, c',
+     "intersection(union(standalone_tag('a ') standalone_tag('b')) standalone_tag('c'))"),
+    ('(comedy)',
+     "standalone_tag('comedy')"),
+    ('.likes > 100',
+     "comparison(likes_feature() operator('>') number('100'))"),
+    ('.likes / (.dislikes + 1) >= 5',
+     "comparison(feature_op(likes_feature() '/' feature_op(dislikes_feature() '+' number('1'))) operator('>=') number('5'))"),
+    ('1 - 2 ^ 3 * .ratio < 0',
+     "comparison(feature_op(number('1') '-' feature_op(feature_op(number('2') '^' number('3')) '*' ratio_feature())) operator('<') number('0'))"),
+    ('-5 > .likes - .dislikes',
+     "comparison(number('-5') operator('>') feature_op(likes_feature() '-' dislikes_feature()))"),
+    ('.likes > -5',
+     "comparison(likes_feature() operator('>') number('-5'))"),
+    ('.title > "M", .likes.x == 1.5e3',
+     'intersection(comparison(json_feature(\'.title\') operator(\'>\') string(\'"M"\')) comparison(json_feature(\'.likes.x\') operator(\'==\') number(\'1.5e3\')))'),
+    ('max(.likes, .dislikes, 3) > min(.wordcount, 100)',
+     "comparison(max(feature_list(likes_feature() feature_list(dislikes_feature() number('3')))) operator('>') min(feature_list(wordcount_feature() number('100'))))"),
+    ('comedy order by .likes desc limit 10',
+     "ordered_query(standalone_tag('comedy') order(likes_feature() 'desc') limit('10'))"),
+    ('comedy order by .ratio',
+     "ordered_query(standalone_tag('comedy') order(ratio_feature()))"),
+    ('comedy limit 5',
+     "ordered_query(standalone_tag('comedy') limit('5'))"),
+    ('5',
+     "standalone_tag('5')"),
+    ('-5',
+     "negation(standalone_tag('5'))"),
+    ('4th wall',
+     "standalone_tag('4th wall')"),
+    ('max',
+     "standalone_tag('max')"),
+    ('text',
+     "standalone_tag('text')"),
+    ('genre',
+     "standalone_tag('genre')"),
+    ('comedy |x',
+     "union(standalone_tag('comedy ') standalone_tag('x'))"),
+    ('a, b, c',
+     "intersection(intersection(standalone_tag('a') standalone_tag('b')) standalone_tag('c'))"),
+]
+
+
+def shape(tree):
+    if not isinstance(tree, Tree):
+        return repr(str(tree))
+    return f'{tree.data}({" ".join(shape(x) for x in tree.children)})'
+
+
+@pytest.fixture(scope='module')
+def archives(synthetic_path):
+    vectorized = fimfarchive.Fimfarchive(synthetic_path)
+    per_item = fimfarchive.Fimfarchive(synthetic_path)
+    per_item.query_stories.reset(per_item.stories_by_id)
+    return vectorized, per_item
+
+
+def test_vectorized_matches_per_item(archives):
+    vectorized, per_item = archives
+    for query in COMPARISONS:
+        assert set(vectorized.query_stories(query)) == set(per_item.query_stories(query)), query
+
+
+@pytest.mark.parametrize('query, field, descending, limit', [
+    ('comedy order by .likes desc limit 5', 'num_likes', True, 5),
+    ('.wordcount > 1000 order by .wordcount', 'num_words', False, None),
+    ('.likes >= 0 order by .date_published desc limit 7', 'date_published', True, 7),
+])
+def test_ordered_queries_match_sort(archives, query, field, descending, limit):
+    results = [list(archive.query_stories(query)) for archive in archives]
+    matching = set(archives[1].query_stories(query.split(' order by ')[0]))
+    stories = archives[0].stories_by_id
+    expected = sorted((stories[x][field] for x in matching), reverse=descending)[:limit]
+    for result in results:
+        assert [stories[x][field] for x in result] == expected, query
+        assert set(result) <= matching
+
+
+def test_errors_match_per_item(archives):
+    for archive in archives:
+        with pytest.raises(VisitError) as info:
+            archive.query_stories('.dislikes / 0 > 1')
+        assert isinstance(info.value.orig_exc, ZeroDivisionError)
+
+        with pytest.raises(VisitError) as info:
+            archive.query_stories('.title + 1 > 2')
+        assert isinstance(info.value.orig_exc, TypeError)
+
+
+def tagged(archive, category, pattern):
+    return set(story_id for story_id, story in archive.stories_by_id.items()
+               if any(tag['type'] == category and pattern in tag['name'].lower() for tag in story['tags']))
+
+
+def test_tag_set_algebra(archives):
+    archive = archives[0]
+    everything = set(archive.stories_by_id)
+    comedy = tagged(archive, 'genre', 'comedy')
+    spike = tagged(archive, 'character', 'spike')
+    assert comedy and spike and comedy != everything
+
+    assert set(archive.query_stories('genre:comedy')) == comedy
+    assert set(archive.query_stories('-genre:comedy')) == everything - comedy
+    # a space before an operator would be part of the tag pattern
+    assert set(archive.query_stories('-genre:comedy|character:spike')) == (everything - comedy) | spike
+    assert set(archive.query_stories('genre:comedy, -character:spike')) == comedy - spike
+
+    result = archive.query_stories('genre:comedy')
+    assert len(result) == len(comedy)
+    assert all(story_id in result for story_id in comedy)
+    assert 'no such story' not in result
+    # plain sets mix with results and give plain sets back
+    some = set(list(comedy)[:3]) | {'no such story'}
+    assert result & some == some - {'no such story'}
+    assert result.union(spike) == comedy | spike
+
+
+def test_plan_cache_normalizes_whitespace(synthetic_path):
+    archive = fimfarchive.Fimfarchive(synthetic_path)
+    query = archive.query_stories
+    variants = [
+        '.likes>5,genre:comedy',
+        '  .likes > 5, genre:comedy',
+        '.likes >  5,   genre: comedy',
+    ]
+    results = [set(query(x)) for x in variants]
+    assert all(x == results[0] for x in results)
+    assert query.cache_stats()['plans']['entries'] == 1
+    assert query.cache_stats()['plans']['hits'] == 2
+
+    # whitespace that can end a tag pattern is part of the query
+    assert normalize_query('genre:comedy |x') != normalize_query('genre:comedy|x')
+    assert normalize_query('genre:comedy ') == 'genre:comedy '
+    assert normalize_query('.title > "a  b" ') == '.title>"a  b"'
+    for variant in variants + ['( comedy ) | -( pie ) order by .likes desc limit 3']:
+        assert query.query_parser.parse(normalize_query(variant)) == query.query_parser.parse(variant)
+
+
+def test_query_forms_parse(synthetic_path):
+    archive = fimfarchive.Fimfarchive(synthetic_path)
+    for query, expected in QUERY_FORMS:
+        assert shape(archive.query_stories.query_parser.parse(query)) == expected, query
+    assert shape(archive.query_tags.query_parser.parse('genre:comedy, -pie')) == \
+        "intersection(categorized_tag('genre' 'comedy') negation(standalone_tag('pie')))"
+
+
+POOLED_QUERIES = [
+    '.title > "M"',
+    '.title > "M", genre:comedy',
+    'genre:comedy | .author.name < "C"',
+    '.title < "D", .author.name > "T"',
+    '-(.title > "M" | .likes > 100)',
+    '.title > "M", .title < "A"',
+    '.title > "G" order by .likes desc limit 5',
+]
+
+
+def test_pooled_queries_match_serial(synthetic_path, enabled_metrics):
+    serial = fimfarchive.Fimfarchive(synthetic_path)
+    pooled = fimfarchive.Fimfarchive(synthetic_path)
+    expected = [list(serial.query_stories(x)) for x in POOLED_QUERIES]
+    # the parent has counts of its own before the pool forks
+    list(pooled.query_stories('genre:comedy'))
+
+    pooled.query_stories.open_pool(workers=2, partition_size=8)
+    try:
+        enabled_metrics.reset()
+        results = [list(pooled.query_stories(x)) for x in POOLED_QUERIES]
+        with pytest.raises(VisitError) as info:
+            pooled.query_stories('.title > "M", .dislikes / 0 > 1')
+        assert isinstance(info.value.orig_exc, ZeroDivisionError)
+    finally:
+        pooled.query_stories.close_pool()
+
+    for query, result, serial_result in zip(POOLED_QUERIES, results, expected):
+        if 'order by' in query:
+            assert result == serial_result, query
+        else:
+            assert sorted(result) == sorted(serial_result), query
+    counters = enabled_metrics.snapshot()['counters']
+    assert counters['query.calls'] == len(POOLED_QUERIES) + 1
+    assert counters['query.partitions'] >= len(POOLED_QUERIES)
+    # the impossible intersection's second side is skipped on every partition
+    assert counters['query.skipped_subtrees'] > 0
@@ -0,0 +1,50 @@
+import pytest
+
+from conftest import read_index, write_index
+from horsewords import fimfarchive
+from horsewords.store import ChapterStore, ChapterStoreWriter
+
+
+@pytest.mark.parametrize('compression', [None, 'zstd'])
+def test_store_reads_back_chapters(tmp_path, compression):
+    path = str(tmp_path / 'store')
+    texts = dict(((story_id, i), f'story {story_id} chapter {i} ' * (i + 1) + 'ü')
+                 for story_id in range(1, 30) for i in range(5))
+    with ChapterStoreWriter(path, compression, chunk_size=1000) as writer:
+        for (story_id, i), text in texts.items():
+            writer.put(story_id, i, text)
+    # later writes win
+    with ChapterStoreWriter(path, compression, chunk_size=1000) as writer:
+        writer.put(3, 2, 'rewritten')
+    texts[3, 2] = 'rewritten'
+
+    store = ChapterStore(path)
+    assert store.compression == compression
+    assert len(store) == len(texts)
+    for (story_id, i), text in texts.items():
+        assert str(store.read(story_id, i), 'utf-8') == text
+    with pytest.raises(KeyError):
+        store.read(1, 5)
+
+    chunks = set((int(x['segment']), int(x['offset'])) for x in store.index)
+    if compression:
+        assert len(chunks) < len(texts) // 10
+    else:
+        assert len(chunks) == len(texts)
+
+
+def test_update_from_rewrites_packed_chapters(synthetic_path, archive_path):
+    previous = fimfarchive.Fimfarchive(synthetic_path)
+    stories = read_index(archive_path)
+    moved = next(x for x, story in stories.items() if len(story['chapters']) > 1)
+    stories[moved]['chapters'].reverse()
+    write_index(archive_path, stories)
+
+    archive = fimfarchive.Fimfarchive(archive_path)
+    archive.pack_chapters(compression='zstd')
+    assert archive.get_cached_chapters(moved) == previous.get_cached_chapters(moved)
+
+    manifest = archive.update_from(synthetic_path, workers=1)
+    assert manifest['stories'] == {moved: {'status': 'changed', 'chapters': []}}
+    assert archive.get_cached_chapters(moved) == previous.get_cached_chapters(moved)[::-1]
+    assert fimfarchive.Fimfarchive(archive_path).get_cached_chapters(moved) == previous.get_cached_chapters(moved)[::-1]
@@ -0,0 +1,36 @@
+import os
+import tarfile
+
+import pytest
+
+from conftest import OFFLINE
+from horsewords import fimfarchive, synthetic
+
+
+def tar_texts(path):
+    with tarfile.open(os.path.join(path, 'txt.tar')) as archive:
+        return dict((x.name, archive.extractfile(x).read().decode('utf-8')) for x in archive if x.isfile())
+
+
+@pytest.mark.parametrize('fast_text', [False, True])
+def test_txt_tar_matches_extracted_epubs(synthetic_path, uncached_path, fast_text):
+    archive = fimfarchive.Fimfarchive(uncached_path, fast_text=fast_text, downloader=OFFLINE)
+    summary = archive.build_cache(workers=1)
+    assert summary['failed'] == {}
+
+    expected = tar_texts(synthetic_path)
+    manifest = synthetic.read_manifest(synthetic_path)
+    assert manifest['chapters'] == len(expected)
+    assert manifest['text_bytes'] == sum(len(x.encode('utf-8')) for x in expected.values())
+    for story_id, story in archive.stories_by_id.items():
+        texts = archive.get_cached_chapters(story_id)
+        assert len(texts) == len(story['chapters'])
+        for position, text in enumerate(texts):
+            assert text == expected[f'txt/{story_id}/{position}.txt']
+
+
+def test_generator_is_deterministic(tmp_path):
+    first = synthetic.generate_archive(str(tmp_path / 'a'), 5, seed=3, words_per_chapter=50)
+    second = synthetic.generate_archive(str(tmp_path / 'b'), 5, seed=3, words_per_chapter=50)
+    assert first == second
+    assert tar_texts(str(tmp_path / 'a')) == tar_texts(str(tmp_path / 'b'))
@@ -0,0 +1,42 @@
+from horsewords import fimfarchive
+
+TEMPLATE = 'Title: {.title} by {.author.name}\n{join .tags.name with ", "}\n{join "## " .chapters.title with "\\n"} { nope } x'
+
+
+def expected(story):
+    chapters = '\n'.join('## ' + chapter['title'] for chapter in story['chapters'])
+    tags = ', '.join(tag['name'] for tag in story['tags'])
+    return f'Title: {story["title"]} by {story["author"]["name"]}\n{tags}\n{chapters} {{ nope }} x'
+
+
+def test_compiled_template_renders_each_story(synthetic_path, enabled_metrics):
+    archive = fimfarchive.Fimfarchive(synthetic_path)
+    renderer = fimfarchive.TemplatedStoryString(archive)
+    story_ids = list(archive.stories_by_id)[:10]
+
+    compiled = renderer.compile(TEMPLATE)
+    rendered = list(compiled.render_many(story_ids))
+    assert rendered == [expected(archive.stories_by_id[x]) for x in story_ids]
+    assert [renderer.parse(TEMPLATE, x) for x in story_ids] == rendered
+
+    # each embed is parsed once per compiled template, not once per story
+    counters = enabled_metrics.snapshot()['counters']
+    assert counters['template.compiled'] == 1
+    assert counters['template.embeds_compiled'] == 2 * 5
+
+
+def test_embeds_parse_only_their_span(synthetic_path, monkeypatch):
+    archive = fimfarchive.Fimfarchive(synthetic_path)
+    renderer = fimfarchive.TemplatedStoryString(archive)
+    parsed = []
+    parse = renderer.parser.parse
+    monkeypatch.setattr(renderer.parser, 'parse', lambda text: parsed.append(text) or parse(text))
+
+    template = ''.join(f'{{.title}} {i} ' for i in range(200)) + '{join .tags.name with "} {"} { "open'
+    story_id = next(iter(archive.stories_by_id))
+    story = archive.stories_by_id[story_id]
+    tags = '} {'.join(tag['name'] for tag in story['tags'])
+    expected = ''.join(f'{story["title"]} {i} ' for i in range(200)) + tags + ' { "open'
+    assert renderer.parse(template, story_id) == expected
+    assert parsed[-1] == '{join .tags.name with "} {"}'
+    assert max(len(x) for x in parsed) == len(parsed[-1])
@@ -0,0 +1,72 @@
+import pytest
+
+from conftest import OFFLINE, read_index, write_index
+from horsewords import fimfarchive
+from horsewords.textindex import tokenize
+
+
+def contains_phrase(chapters, phrase):
+    words = tokenize(phrase)
+    for text in chapters:
+        tokens = tokenize(text)
+        if any(tokens[i:i + len(words)] == words for i in range(len(tokens) - len(words) + 1)):
+            return True
+    return False
+
+
+def test_text_queries_match_scan(archive_path):
+    archive = fimfarchive.Fimfarchive(archive_path)
+    archive.build_text_index(workers=1, stories_per_run=15)
+    texts = dict((x, archive.get_cached_chapters(x)) for x in archive.stories_by_id)
+
+    story_id, chapters = next((x, y) for x, y in texts.items() if len(y) > 1)
+    first, second = tokenize(chapters[0]), tokenize(chapters[1])
+    phrases = [first[0], ' '.join(first[3:6]), ' '.join(second[:2]), ' '.join(first[-1:] + second[:1]),
+               'not a word in the archive']
+    for phrase in phrases:
+        expected = set(x for x, y in texts.items() if contains_phrase(y, phrase))
+        assert set(archive.query_stories(f'text:"{phrase}"')) == expected, phrase
+
+    phrase = ' '.join(first[3:5])
+    expected = set(x for x, y in texts.items() if contains_phrase(y, phrase))
+    comedy = set(archive.query_stories('genre:comedy'))
+    assert set(archive.query_stories(f'text:"{phrase}", genre:comedy')) == expected & comedy
+    assert set(archive.query_stories(f'-text:"{phrase}"')) == set(texts) - expected
+
+
+def test_text_index_stale_after_chapter_change(archive_path, enabled_metrics):
+    fimfarchive.Fimfarchive(archive_path).build_text_index(workers=1)
+    assert fimfarchive.Fimfarchive(archive_path).text_index is not None
+
+    stories = read_index(archive_path)
+    story = next(iter(stories.values()))
+    story['chapters'][0]['date_modified'] = '2030-01-01T00:00:00+00:00'
+    write_index(archive_path, stories)
+
+    assert fimfarchive.Fimfarchive(archive_path).text_index is None
+    assert enabled_metrics.snapshot()['counters']['warnings.text_index_stale'] == 1
+
+
+def test_text_index_stale_after_missing_stories_cached(uncached_path, enabled_metrics):
+    archive = fimfarchive.Fimfarchive(uncached_path, downloader=OFFLINE)
+    story_ids = list(archive.stories_by_id)
+    archive.build_cache(workers=1, story_ids=story_ids[:10])
+    archive.build_text_index(workers=1, stories_per_run=15)
+
+    counters = enabled_metrics.snapshot()['counters']
+    assert counters['warnings.text_index_incomplete'] == 1
+    assert counters['text_index.missing_stories'] == len(story_ids) - 10
+    word = tokenize(archive.get_cached_chapters(story_ids[0])[0])[0]
+    assert set(archive.query_stories(f'text:"{word}"')) <= set(story_ids[:10])
+    assert fimfarchive.Fimfarchive(uncached_path).text_index is not None
+
+    archive.build_cache(workers=1)
+    assert archive.text_index is None
+    with pytest.raises(Exception):
+        archive.query_stories(f'text:"{word}"')
+    assert fimfarchive.Fimfarchive(uncached_path).text_index is None
+    assert enabled_metrics.snapshot()['counters']['warnings.text_index_stale'] == 2
+
+    archive.build_text_index(workers=1)
+    expected = set(x for x in story_ids if contains_phrase(archive.get_cached_chapters(x), word))
+    assert set(archive.query_stories(f'text:"{word}"')) == expected